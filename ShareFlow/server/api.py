@@ -35,16 +35,20 @@ response including ShareFlows if applicable.
 
 Function Definitions:
 
-1. `batch_steps(user_event_record, url)`
-   - Retrieves a list of user events within the specified time range from
-     `user_event_record`.
+1. `batch_steps(user_event_record, url=None, store=None, page_size=500)`
+   - Retrieves the user events of the recording's session and user within the
+     specified time range, with a paginated range query over the indexed
+     `session_id`, `userid` and `timestamp` fields.
    - Parameters:
      - `user_event_record` (UserEventRecord): The record containing start and end
        timestamps for the desired time range.
      - `url` (str): The URL used for fetching data (not used in the current implementation).
+     - `store`: The event store to query (defaults to `event_store`).
+     - `page_size` (int): Number of events fetched per page.
    - Returns:
-     - List of UserEvent instances within the time range specified by
-       `user_event_record.startstamp` and `user_event_record.endstamp`.
+     - A list with one entry holding the record fields and an iterator over its
+       `steps`, in timestamp order. Events are fetched a page at a time as the
+       iterator is read, so `read` fingerprints them as they stream in.
 
 2. `read(context, request)`
    - Fetches and processes user event records, generates ShareFlows if applicable,
@@ -65,24 +69,230 @@ Function Definitions:
        - `shared`: The shared flag from the `user_event_record`.
        - `dc`: ShareFlows generated from the user events (or None if no events are found).
 
+   - A completed recording whose ShareFlow was materialized with the current
+     process library version is served from `document_store` without running
+     the pipeline.
+   - `?fields=` selects dotted field paths (`KM_Process.name,code,title`, see
+     `shareflow_response`), and `?offset=` / `?limit=` page through the
+     `KM_Process` entries, adding `page` (`offset`, `limit`, `total`) to the
+     body. The body is streamed in chunks. Its `ETag` is derived from the
+     document version and the requested variant, so a matching
+     `If-None-Match` answers `304 Not Modified` before the ShareFlow is
+     generated (or, for a materialized one, before the events are fetched).
+   - Every body carries a `version` token. Polling a live recording with
+     `?since=<version>` returns only the events and `KM_Process` entries that
+     were added or changed since then (with `stepsFrom` and `KM_ProcessFrom`
+     offsets and a new `version`); closed entries are not sent again.
+   - A recording that is still being captured keeps one `LiveShareFlow` per
+     session and process library (`shareflow_live`, at most
+     `SHAREFLOW_LIVE_SESSIONS`). Each read fetches and labels only the events
+     stored since the previous one.
+
+3. `read_job(context, request)`
+   - Returns the status of an asynchronous read. With `?async=1` (or
+     `SHAREFLOW_ASYNC` set), `read` answers a cache miss with `202 Accepted` and a
+     job handle instead of generating the ShareFlow in the request thread; the
+     client polls this endpoint, optionally long-polling with `?wait=<seconds>`
+     (at most 30), until it returns the same body as a synchronous `read`
+     (honouring the same `fields`, `offset`, `limit` and `since`, with the
+     same `ETag`).
+     Concurrent reads of the same recording share one job, and a full queue
+     answers `503` with `Retry-After`. A failed job answers `500` and a timed
+     out one `504`, with the job status as the body. A job is only returned to
+     a caller who can read one of the recordings it was submitted for (shared,
+     or their own); for anyone else it is `404 Not Found`.
+
+4. `cache_stats(context, request)`
+   - Returns the hit/miss/eviction counters of the ShareFlow cache.
+
+5. `metrics(context, request)`
+   - Returns the pipeline metrics (stage timings, event and byte counts,
+     per-pattern hits, NO MATCH ratio, fetch cost) in the Prometheus text
+     format when `SHAREFLOW_METRICS` is set; each read also logs one JSON line
+     with its stage timings (see `shareflow_metrics`).
+
+6. `read_screenshot(context, request)`
+   - Returns the screenshot bytes behind a `sha256:<digest>` reference from the
+     screenshot store (configured with `SHAREFLOW_SCREENSHOT_DIR`).
+
+7. `ingest_events(context, request)`
+   - Stores a JSON array or NDJSON body of TraceData messages in batches (see
+     `shareflow_ingest`) and returns per-request counts and the first
+     validation errors. Events are stored under the authenticated user, and
+     messages naming another `userid` are rejected. Events are de-duplicated
+     by idempotency key, and a request retried by the same user with the same
+     `Idempotency-Key` header gets the same answer.
+
+8. `on_record_completed(record)`
+   - Materializes the ShareFlow of a completed recording in the background (see
+     `shareflow_materialize`).
+
+9. `search(context, request)`
+   - Returns the best matches (`?q=`, at most `?limit=` of 100) among
+     recordings and the processes of their ShareFlows from the in-process
+     `search_index` (see `shareflow_search`), optionally filtered by `kind`,
+     `userid`, `groupid` and `shared`. Private recordings are only returned to
+     their owner. The index is loaded from Redis on the first search and updated
+     whenever a ShareFlow is generated or materialized.
+
+With `SHAREFLOW_MEMORY_BUDGET` set, `read` stays within that many bytes: the
+fetched steps and the ShareFlow generated from them spill to temporary files
+past it (see `shareflow_spill`) and are streamed back into the response.
+
+With `SHAREFLOW_CAPTURE_DIR` set, `read` also snapshots the anonymized events
+it fetched (a `SHAREFLOW_CAPTURE_RATE` share of the reads answered with a
+body, not `304`) for offline replay and profiling with `shareflow_replay.py`.
+Snapshots are written by a background thread.
+
 Dependencies:
 - `shareflows_process` from `shareflow_process`: A function used to generate
   ShareFlows based on the user events.
+- `ShareFlowCache` from `shareflow_cache`: Memoizes the generated ShareFlows so
+  repeated reads of an unchanged recording do not rerun the pipeline.
 - `UserEventRecord`: A class representing the record of user events with
   timestamps and other metadata.
 
+- `ProcessLibraryRegistry` from `process_library`: The versioned process
+  libraries (`SHAREFLOW_PROCESS_LIBRARY_DIR`, default `process_libraries/`);
+  `read` uses the library of the recording's task or group.
+
+- `RedisEventStore` / `SQLiteEventStore` from `event_store`: Paginated range
+  queries over the stored UserEvents.
+
 Notes:
-- The `batch_steps` function is intended to retrieve a list of user events,
-  but the `url` parameter is not used in the current implementation.
+- The `url` parameter of `batch_steps` is not used in the current implementation.
 - The `read` function processes the user event record and generates a response
   that includes ShareFlows if there are any user events in the specified range.
 """
 
+import gc
+import os
+import threading
+
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound, HTTPNotModified, HTTPServiceUnavailable
+from pyramid.response import Response
+
+import shareflow_metrics
+from event_store import RedisEventStore, iter_record_steps
+from process_library import ProcessLibraryRegistry
+from screenshot_store import ScreenshotStore
+from shareflow_cache import ShareFlowCache, StepFingerprint
+from shareflow_ingest import BulkIngester, IdempotentResponses, parse_messages
+from shareflow_jobs import JobQueueFull, ShareFlowJobQueue
+from shareflow_live import LiveShareFlows
+from shareflow_materialize import RedisDocumentStore, materialize_record, record_id
 from shareflow_process import shareflows_process
+from shareflow_replay import TraceCapture
+from shareflow_response import ReadOptions, ResponseOptionsError, etag, iter_json
+from shareflow_search import SearchIndex, populate
+from shareflow_spill import hold_steps, is_spilled
+
+
+# Backend queried by batch_steps; event_store.SQLiteEventStore is a drop-in
+# stand-in for running without Redis.
+event_store = RedisEventStore()
+
+# When configured, screenshots are kept in a content-addressed store and
+# ShareFlows only carry "sha256:<digest>" references to them.
+screenshot_store = (
+    ScreenshotStore(os.environ["SHAREFLOW_SCREENSHOT_DIR"])
+    if os.environ.get("SHAREFLOW_SCREENSHOT_DIR") else None
+)
+
+# Versioned process libraries, reloaded when their files change. Each recording
+# uses the library of its task or group, or the default library.
+process_libraries = ProcessLibraryRegistry(
+    os.environ.get("SHAREFLOW_PROCESS_LIBRARY_DIR")
+    or os.path.join(os.path.dirname(os.path.abspath(__file__)), "process_libraries"),
+    cache_dir=os.environ.get("SHAREFLOW_PROCESS_LIBRARY_CACHE"),
+)
+
+# Generated ShareFlows, keyed by session, record range and event fingerprint.
+# Code that stores new UserEvents should call shareflow_cache.invalidate().
+shareflow_cache = ShareFlowCache()
+
+
+# Background ShareFlow generation used by asynchronous reads (?async=1, or every
+# read when SHAREFLOW_ASYNC is set).
+shareflow_jobs = ShareFlowJobQueue(
+    workers=int(os.environ.get("SHAREFLOW_JOB_WORKERS", 4)),
+    max_pending=int(os.environ.get("SHAREFLOW_JOB_QUEUE", 64)),
+    timeout=float(os.environ.get("SHAREFLOW_JOB_TIMEOUT", 120)),
+)
+ASYNC_READS = bool(os.environ.get("SHAREFLOW_ASYNC"))
+
+# With SHAREFLOW_MEMORY_BUDGET (bytes) set, reads stay within that budget: half
+# of it holds the fetched steps and half the pipeline, past which steps and
+# segments spill to files under SHAREFLOW_SPILL_DIR (see shareflow_spill).
+# Spilled ShareFlows are streamed from disk and not cached.
+MEMORY_BUDGET = int(os.environ["SHAREFLOW_MEMORY_BUDGET"]) if os.environ.get("SHAREFLOW_MEMORY_BUDGET") else None
+STEPS_BUDGET = PIPELINE_BUDGET = MEMORY_BUDGET // 2 if MEMORY_BUDGET is not None else None
+SPILL_DIR = os.environ.get("SHAREFLOW_SPILL_DIR")
 
+# Incremental ShareFlows of live (not yet completed) recordings: each read only
+# fetches and labels the events stored since the previous read of the recording
+# (see shareflow_live). They hold their steps between reads, so reads with
+# SHAREFLOW_MEMORY_BUDGET set do not use them.
+live_shareflows = LiveShareFlows(max_entries=int(os.environ.get("SHAREFLOW_LIVE_SESSIONS", 64)))
 
-def batch_steps(user_event_record, url):
-    return list(UserEvent)[user_event_record.startstamp, user_event_record.endstamp]
+# ShareFlows materialized for completed recordings;
+# shareflow_materialize.SQLiteDocumentStore is a drop-in stand-in.
+document_store = RedisDocumentStore()
+
+# In-process search over recordings and their ShareFlows. It is filled from
+# Redis on the first search and updated as ShareFlows are generated.
+search_index = SearchIndex()
+_search_index_loaded = False
+_search_index_lock = threading.Lock()
+
+# Bulk TraceData ingestion into event_store; stored events invalidate the
+# cached, materialized and indexed ShareFlows of their sessions.
+# With SHAREFLOW_COALESCE_INGEST set, keystroke and scroll runs are coalesced
+# before they are stored. Coalescing is label-equivalent only for the library
+# it used, so the library of each task is resolved as its events arrive (a
+# library selected by group alone is not known at ingest time).
+def _coalesce_options(task_name):
+    library = process_libraries.resolve(None, task_name)
+    return {"mapping": library.action_mapping, "process_map": library.process_map}
+
+
+ingester = BulkIngester(
+    event_store, cache=shareflow_cache, documents=document_store, index=search_index, live=live_shareflows,
+    coalesce=_coalesce_options if os.environ.get("SHAREFLOW_COALESCE_INGEST") else None,
+)
+ingest_responses = IdempotentResponses()
+
+# Opt-in capture of the anonymized batch_steps results of reads, for offline
+# replay and profiling with shareflow_replay.py.
+trace_capture = (
+    TraceCapture(os.environ["SHAREFLOW_CAPTURE_DIR"], rate=float(os.environ.get("SHAREFLOW_CAPTURE_RATE", 1)))
+    if os.environ.get("SHAREFLOW_CAPTURE_DIR") else None
+)
+
+# Longest long-poll wait accepted by read_job, in seconds
+MAX_JOB_WAIT = 30.0
+
+# Most results returned by one search
+MAX_SEARCH_RESULTS = 100
+
+
+def batch_steps(user_event_record, url=None, store=None, page_size=500):
+    record = user_event_record
+    return [_record_body(record, iter_record_steps(store or event_store, record, page_size, screenshot_store))]
+
+
+def _record_body(record, steps):
+    return {
+        "taskName": record.task_name,
+        "sessionId": record.session_id,
+        "timestamp": record.startstamp,
+        "steps": steps,
+        "task_name": record.task_name,
+        "session_id": record.session_id,
+        "userid": record.userid,
+        "groupid": record.groupid,
+        "shared": record.shared,
+    }
 
 
 @api_config(
@@ -93,21 +303,318 @@ def batch_steps(user_event_record, url):
 )
 def read(context, request):
     record = context.user_event_record
-    results = batch_steps(record)
-    if len(results):
-        shareflow = results[0]
-        dc = shareflows_process(results)
-        return {**shareflow, "dc": dc}
+    options = _read_options(request)
+    with shareflow_metrics.request(route="recording.read", session_id=record.session_id):
+        return _read(request, record, options)
+
+
+def _read(request, record, options):
+    library = process_libraries.resolve(record.groupid, record.task_name)
+    stored = None
+    if record.completed:
+        stored = document_store.get(record_id(record))
+        if stored is not None and stored[0] != library.tag:
+            stored = None
+    if stored is not None:
+        # The stored fingerprint identifies the events, so an unchanged
+        # recording is revalidated without fetching them
+        key = shareflow_cache.key(record, None, library.tag, fingerprint=stored[1])
+        tag = etag(key, options)
+        if tag in request.if_none_match:
+            return _not_modified(tag)
+        if stored[3] is not None:
+            # Served from the stored steps, without paging through the events
+            return _respond({**_record_body(record, stored[3]), "dc": stored[2]}, tag, options, library.tag)
+    if not record.completed and MEMORY_BUDGET is None:
+        return _read_live(request, record, options, library)
+    # The cache key is fingerprinted as the steps stream in, not in a second pass
+    fingerprint = StepFingerprint()
+    entry = batch_steps(record)[0]
+    steps = fingerprint.steps(entry["steps"])
+    if STEPS_BUDGET is None:
+        steps = list(steps)
+    else:
+        steps = hold_steps(steps, STEPS_BUDGET, SPILL_DIR)
+    if steps:
+        shareflow = {**entry, "steps": steps}
+        results = [shareflow]
+        if stored is None:
+            key = shareflow_cache.key(record, None, library.tag, fingerprint=fingerprint.hexdigest())
+            tag = etag(key, options)
+            if tag in request.if_none_match:
+                return _not_modified(tag)
+        # Only reads answered with a body are captured, off the request thread
+        if trace_capture is not None:
+            trace_capture.submit(results, library, route="recording.read")
+        if stored is not None:
+            return _respond({**shareflow, "dc": stored[2]}, tag, options, library.tag)
+
+        def compute(data):
+            dc = shareflows_process(data, library=library, memory_budget=PIPELINE_BUDGET, spill_dir=SPILL_DIR)
+            _index_shareflow(record, dc)
+            return dc
+
+        dc = shareflow_cache.get(key)
+        if dc is not None:
+            return _respond({**shareflow, "dc": dc}, tag, options, library.tag)
+        if ASYNC_READS or request.params.get("async") in ("1", "true"):
+            return _submit_job(request, record, key, shareflow, results, compute, options)
+        return _respond(_generate(key, shareflow, results, compute), tag, options, library.tag)
+    else:
+        # A recording without events still gets an entity tag and a version token
+        key = shareflow_cache.key(record, None, library.tag, fingerprint=fingerprint.hexdigest())
+        tag = etag(key, options)
+        if tag in request.if_none_match:
+            return _not_modified(tag)
+        return _respond({**_record_body(record, None), "dc": None}, tag, options, library.tag)
+
+
+def _read_live(request, record, options, library):
+    live = live_shareflows.get(record, library)
+    with live.lock:
+        # Only the events stored since the previous read are fetched and labelled
+        live.poll(event_store, record, screenshots=screenshot_store)
+        key = shareflow_cache.key(record, None, library.tag, fingerprint=live.fingerprint.hexdigest())
+        tag = etag(key, options)
+        if tag in request.if_none_match:
+            return _not_modified(tag)
+        steps = live.snapshot()
+        # Live ShareFlows are indexed once materialized, not on every poll
+        dc = live.document()
+    if not steps:
+        return _respond({**_record_body(record, None), "dc": None}, tag, options, library.tag)
+    shareflow = _record_body(record, steps)
+    if trace_capture is not None:
+        trace_capture.submit([shareflow], library, route="recording.read")
+    return _respond({**shareflow, "dc": dc}, tag, options, library.tag)
+
+
+def on_record_completed(record):
+    """
+    Materialize the ShareFlow of a recording that was just marked completed, in
+    the background. Call this wherever UserEventRecord.completed is set.
+
+    Returns:
+    ShareFlowJob: The materialization job, or None if the queue is full (the
+    document is then generated on first read or by the backfill command).
+    """
+    try:
+        return shareflow_jobs.submit(("materialize", record_id(record)), _materialize, record)
+    except JobQueueFull:
+        return None
+
+
+def _materialize(record):
+    outcome = materialize_record(record, event_store, document_store, process_libraries, screenshot_store)
+    stored = document_store.get(record_id(record))
+    _index_shareflow(record, stored[2] if stored is not None else None)
+    return outcome
+
+
+def _index_shareflow(record, dc):
+    rid = record_id(record)
+    search_index.add_record(rid, record)
+    search_index.add_shareflow(rid, record, dc)
+
+
+def _loaded_search_index():
+    global _search_index_loaded
+    with _search_index_lock:
+        if not _search_index_loaded:
+            from data_models import UserEventRecord
+
+            populate(search_index, UserEventRecord.find().all(), document_store)
+            # Keep full collections from walking the index
+            gc.freeze()
+            _search_index_loaded = True
+    return search_index
+
+
+def _read_options(request):
+    try:
+        return ReadOptions.from_params(request.params)
+    except ResponseOptionsError as e:
+        raise HTTPBadRequest(str(e))
+
+
+def _respond(body, tag, options, library_version):
+    """Stream 'body' as requested by 'options' (see ReadOptions.apply) with its entity tag."""
+    response = Response(app_iter=iter_json(options.apply(body, library_version)),
+                        content_type="application/json", charset="utf-8")
+    response.etag = tag
+    # Clients keep the body but revalidate it on every use
+    response.cache_control = "private, no-cache"
+    return response
+
+
+def _not_modified(tag):
+    response = HTTPNotModified()
+    response.etag = tag
+    response.cache_control = "private, no-cache"
+    return response
+
+
+def _generate(key, shareflow, results, compute):
+    dc = compute(results)
+    if dc is not None and not is_spilled(dc):
+        shareflow_cache.put(key, dc)
+    return {**shareflow, "dc": dc}
+
+
+def _submit_job(request, record, key, shareflow, results, compute, options):
+    try:
+        job = shareflow_jobs.submit(key, _generate, key, shareflow, results, compute, record=record)
+    except JobQueueFull:
+        response = HTTPServiceUnavailable()
+        response.retry_after = 5
+        raise response
+    return _job_response(request, job, options)
+
+
+def _job_response(request, job, options):
+    if job.state == "done":
+        if isinstance(job.result, dict):
+            # Read jobs are keyed like the cache, so the tag matches later reads;
+            # the key ends with the process library version
+            return _respond(job.result, etag(job.key, options), options, job.key[-1])
+        return job.result
+    body = job.to_dict()
+    body["location"] = request.route_url("api.recording.job", job=job.id)
+    if body["status"] in ("queued", "running"):
+        request.response.status = 202
+        request.response.location = body["location"]
+        request.response.headers["Retry-After"] = "1"
+    elif body["status"] == "timeout":
+        request.response.status = 504
+    else:
+        request.response.status = 500
+    return body
+
+
+def _can_read(request, record):
+    # As in search: shared recordings, and private ones to their owner
+    return bool(record.shared) or (
+        request.authenticated_userid is not None and record.userid == request.authenticated_userid
+    )
+
+
+@api_config(
+    route_name="api.recording.job",
+    request_method="GET",
+    link_name="recording.job",
+    description="Poll an asynchronous recording read",
+)
+def read_job(context, request):
+    options = _read_options(request)
+    try:
+        job = shareflow_jobs.get(request.matchdict["job"])
+    except KeyError:
+        raise HTTPNotFound()
+    # Jobs are shared by the reads of one cache key, which may be several
+    # recordings; an unreadable job is reported like an unknown one
+    if not any(_can_read(request, record) for record in job.records):
+        raise HTTPNotFound()
+    try:
+        wait = min(float(request.params.get("wait", 0)), MAX_JOB_WAIT)
+    except ValueError:
+        wait = 0
+    if wait > 0:
+        job.wait(wait)
+    return _job_response(request, job, options)
+
+
+@api_config(
+    route_name="api.recording.cache",
+    request_method="GET",
+    link_name="recording.cache",
+    description="Fetch the ShareFlow cache counters",
+)
+def cache_stats(context, request):
+    return shareflow_cache.stats()
+
+
+@api_config(
+    route_name="api.metrics",
+    request_method="GET",
+    link_name="metrics",
+    description="Fetch the ShareFlow pipeline metrics in the Prometheus text format",
+)
+def metrics(context, request):
+    if not shareflow_metrics.enabled():
+        raise HTTPNotFound()
+    return Response(body=shareflow_metrics.render().encode("utf-8"),
+                    content_type="text/plain", charset="utf-8")
+
+
+@api_config(
+    route_name="api.screenshot",
+    request_method="GET",
+    link_name="screenshot.read",
+    description="Fetch a screenshot by its reference",
+)
+def read_screenshot(context, request):
+    if screenshot_store is None:
+        raise HTTPNotFound()
+    try:
+        data, content_type = screenshot_store.get(request.matchdict["ref"])
+    except KeyError:
+        raise HTTPNotFound()
+    response = Response(body=data, content_type=content_type)
+    # References are content hashes, so the blob behind one never changes
+    response.cache_control = "public, max-age=31536000, immutable"
+    return response
+
+
+@api_config(
+    route_name="api.events.bulk",
+    request_method="POST",
+    link_name="events.bulk",
+    description="Store a batch of TraceData messages",
+)
+def ingest_events(context, request):
+    userid = request.authenticated_userid
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key:
+        summary = ingest_responses.get(userid, idempotency_key)
+        if summary is not None:
+            return summary
+    try:
+        messages = parse_messages(request.body, request.content_type)
+        # Events are stored under the authenticated user, whatever the messages say
+        summary = ingester.ingest(messages, userid=userid)
+    except UnicodeDecodeError:
+        raise HTTPBadRequest("Request body is not UTF-8")
+    if summary["rejected"] and not summary["accepted"] and not summary["duplicates"]:
+        request.response.status = 400
+    elif idempotency_key:
+        ingest_responses.put(userid, idempotency_key, summary)
+    return summary
+
+
+@api_config(
+    route_name="api.search",
+    request_method="GET",
+    link_name="search",
+    description="Search recordings and ShareFlows",
+)
+def search(context, request):
+    query = request.params.get("q", "")
+    try:
+        limit = min(int(request.params.get("limit", 20)), MAX_SEARCH_RESULTS)
+        shared = int(request.params["shared"]) if "shared" in request.params else None
+    except ValueError:
+        raise HTTPBadRequest("limit and shared must be integers")
+    filters = {
+        "kind": request.params.get("kind"),
+        "userid": request.params.get("userid"),
+        "groupid": request.params.get("groupid"),
+        "shared": shared,
+    }
+    # Private recordings are only found by their owner
+    if request.authenticated_userid:
+        visible_to = request.authenticated_userid
     else:
-        return {
-            "taskName": record.task_name,
-            'sessionId': record.session_id,
-            "timestamp": record.startstamp,
-            "steps": None,
-            "task_name": record.task_name,
-            "session_id": record.session_id,
-            "userid": record.userid,
-            "groupid": record.groupid,
-            "shared": record.shared,
-            "dc": None,
-            },
+        visible_to = None
+        filters["shared"] = 1
+    results = _loaded_search_index().search(query, limit, visible_to=visible_to, **filters)
+    return {"query": query, "results": results}
@@ -25,13 +25,16 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
 """
-This file defines the data models for user event tracking, consisting of two
-classes: UserEventRecord and UserEvent.
+This file defines the data models for user event tracking, consisting of the
+classes UserEventRecord, UserEvent and ShareFlowDocument.
 
 The UserEventRecord class represents a session or task and maintains an index
 to a list of UserEvent instances, each capturing specific user interactions
 during that session or task.
 
+A ShareFlowDocument holds the ShareFlow materialized for a completed
+UserEventRecord.
+
 These models are designed for efficient querying, indexing, and full-text
 search of user activity data.
 """
@@ -76,7 +79,7 @@ class UserEvent(JsonModel):
 
     Attributes:
         event_type (str): The type of the event (indexed and searchable).
-        timestamp (int): The timestamp of when the event occurred (indexed).
+        timestamp (int): The timestamp of when the event occurred (indexed and sortable).
         tag_name (str): The name of the HTML tag associated with the event (indexed).
         text_content (str): The textual content involved in the event (indexed).
         base_url (str): The URL where the event took place (indexed).
@@ -96,9 +99,12 @@ class UserEvent(JsonModel):
         height (Optional[int]): The height dimension of the event target, supports full-text search and sorting.
         image (Optional[str]): The image content associated with the event, if any.
         title (Optional[str]): The title of the event or page, supports full-text search and sorting.
+        coalesced (Optional[int]): For a summary of coalesced keystroke or scroll events, the number of events it stands for.
+        end_timestamp (Optional[int]): For a summary of coalesced events, the timestamp of the last of them.
+        extent (Optional[List[float]]): For a summary of coalesced events, their offset extent [min x, min y, max x, max y].
     """
     event_type: str = Field(index=True, full_text_search=True)
-    timestamp: int = Field(index=True)
+    timestamp: int = Field(index=True, sortable=True)
     tag_name: str = Field(index=True)
     text_content: str = Field(index=True)
     base_url: str = Field(index=True)
@@ -117,4 +123,31 @@ class UserEvent(JsonModel):
     width: Optional[int] = Field(full_text_search=True, sortable=True)
     height: Optional[int] = Field(full_text_search=True, sortable=True)
     image: Optional[str]
-    title: Optional[str] = Field(full_text_search=True, sortable=True)
\ No newline at end of file
+    title: Optional[str] = Field(full_text_search=True, sortable=True)
+    coalesced: Optional[int]
+    end_timestamp: Optional[int]
+    extent: Optional[List[float]]
+
+
+class ShareFlowDocument(JsonModel):
+    """
+    The ShareFlow generated for a completed UserEventRecord, stored so reads do
+    not rerun the pipeline.
+
+    Attributes:
+        record_id (str): The primary key of the UserEventRecord (indexed).
+        session_id (str): The session identifier of the record (indexed).
+        version (str): The tag of the process library the document was built with (indexed).
+        fingerprint (str): Fingerprint of the events the document was built from.
+        document (str): The nested ShareFlow document, JSON-encoded.
+        created (int): The timestamp (ms) when the document was generated (indexed).
+        steps (str): The steps of the recording as batch_steps returns them,
+            JSON-encoded, or None for documents stored without them.
+    """
+    record_id: str = Field(index=True)
+    session_id: str = Field(index=True)
+    version: str = Field(index=True)
+    fingerprint: str
+    document: str
+    created: int = Field(index=True)
+    steps: Optional[str] = None
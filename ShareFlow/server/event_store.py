@@ -0,0 +1,315 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Range retrieval of UserEvents for a recording.
+
+Events are fetched with a range query over the indexed session_id, userid and
+timestamp fields, one page at a time, with a keyset cursor (the last timestamp
+returned and the keys already seen at that timestamp), so a request only reads
+the events of its own session.
+
+Two backends share the same interface:
+
+- RedisEventStore queries the UserEvent model through Redis OM.
+- SQLiteEventStore is an in-memory (or file) stand-in with the same indexes,
+  used to exercise the API without a Redis deployment.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+import shareflow_metrics
+from screenshot_store import store_step_images
+
+
+# UserEvent fields kept by the stores, in model order
+USER_EVENT_FIELDS = (
+    'event_type', 'timestamp', 'tag_name', 'text_content', 'base_url', 'userid',
+    'ip_address', 'interaction_context', 'event_source', 'system_time', 'x_path',
+    'offset_x', 'offset_y', 'doc_id', 'region', 'session_id', 'task_name',
+    'width', 'height', 'image', 'title', 'coalesced', 'end_timestamp', 'extent',
+)
+
+
+_encode = json.JSONEncoder(default=str, separators=(',', ':')).encode
+
+
+def _field(event, name, default=None):
+    if isinstance(event, dict):
+        return event.get(name, default)
+    return getattr(event, name, default)
+
+
+def user_event_to_step(event):
+    """
+    Convert a UserEvent (model instance or dict) into a step dictionary in the
+    shape read by shareflows_process.
+    """
+    step = {
+        'type': _field(event, 'event_type', 'No type'),
+        'text': _field(event, 'text_content', '') or '',
+        'url': _field(event, 'base_url', '') or '',
+        'description': _field(event, 'interaction_context', '') or '',
+        'image': _field(event, 'image', '') or '',
+        'title': _field(event, 'title', '') or '',
+        'width': _field(event, 'width'),
+        'height': _field(event, 'height'),
+        'offsetX': _field(event, 'offset_x'),
+        'offsetY': _field(event, 'offset_y'),
+        'timestamp': _field(event, 'timestamp'),
+        'xpath': _field(event, 'x_path', '') or '',
+    }
+    coalesced = _field(event, 'coalesced')
+    if coalesced:
+        # Summary of a coalesced run (see shareflow_coalesce)
+        step['coalesced'] = coalesced
+        step['endTimestamp'] = _field(event, 'end_timestamp')
+        step['extent'] = _field(event, 'extent')
+    return step
+
+
+class RedisEventStore:
+    """
+    Event store backed by the UserEvent Redis OM model.
+
+    Requires the UserEvent.timestamp field to be sortable.
+    """
+
+    def add(self, events, keys=None):
+        """
+        Store UserEvents (dicts of UserEvent fields) in one pipelined round trip.
+
+        With 'keys', each event is saved under its idempotency key as primary
+        key, so storing an event again overwrites it instead of duplicating it.
+
+        Returns:
+        int: Number of events written.
+        """
+        from data_models import UserEvent
+
+        models = []
+        for i, event in enumerate(events):
+            data = {name: _field(event, name) for name in USER_EVENT_FIELDS}
+            if keys is not None:
+                data['pk'] = keys[i]
+            models.append(UserEvent(**data))
+        UserEvent.add(models)
+        return len(models)
+
+    def fetch_page(self, session_id, userid, start, end, cursor=None, limit=500, resume=False):
+        """
+        Return (events, cursor) for the next page of events of 'session_id'
+        (every session when None; and 'userid', when given) with
+        start <= timestamp <= end, ordered by timestamp. The returned cursor is
+        None once the range is exhausted, unless 'resume' is set: the cursor
+        then always follows the last event read, so the range can be read again
+        later for the events stored after it.
+        """
+        from data_models import UserEvent
+
+        after, seen = cursor if cursor else (start, ())
+        expression = (UserEvent.timestamp >= after) & (UserEvent.timestamp <= end)
+        if session_id is not None:
+            expression = (UserEvent.session_id == session_id) & expression
+        if userid:
+            expression = expression & (UserEvent.userid == userid)
+        query = UserEvent.find(expression).sort_by('timestamp')
+
+        seen = set(seen)
+        events = [
+            event for event in query.page(offset=0, limit=limit + len(seen))
+            if not (event.timestamp == after and event.pk in seen)
+        ][:limit]
+        if len(events) < limit and not resume:
+            return events, None
+        if not events:
+            return events, cursor
+        return events, _next_cursor(events, after, seen, key=lambda event: event.pk)
+
+
+class SQLiteEventStore:
+    """
+    SQLite stand-in for the UserEvent store, indexed on
+    (session_id, userid, timestamp) like the Redis OM model.
+    """
+
+    def __init__(self, path=':memory:'):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS user_event ('
+                ' pk INTEGER PRIMARY KEY,'
+                ' session_id TEXT,'
+                ' userid TEXT,'
+                ' timestamp INTEGER,'
+                ' event_key TEXT,'
+                ' data TEXT)'
+            )
+            columns = {row[1] for row in self._connection.execute('PRAGMA table_info(user_event)')}
+            if 'event_key' not in columns:
+                self._connection.execute('ALTER TABLE user_event ADD COLUMN event_key TEXT')
+            self._connection.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS user_event_key ON user_event (event_key)'
+            )
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS user_event_range'
+                ' ON user_event (session_id, userid, timestamp, pk)'
+            )
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS user_event_session'
+                ' ON user_event (session_id, timestamp, pk)'
+            )
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS user_event_time ON user_event (timestamp, pk)'
+            )
+
+    def add(self, events, keys=None):
+        """
+        Store UserEvents (model instances or dicts) in one transaction.
+
+        With 'keys', events whose idempotency key is already stored are skipped.
+
+        Returns:
+        int: Number of events written.
+        """
+        rows = []
+        for i, event in enumerate(events):
+            # Unset fields are left out of the stored JSON; reads default them to None
+            data = {}
+            for name in USER_EVENT_FIELDS:
+                value = _field(event, name)
+                if value is not None:
+                    data[name] = value
+            rows.append((data.get('session_id'), data.get('userid'), data.get('timestamp'),
+                         keys[i] if keys is not None else None,
+                         _encode(data)))
+        with self._lock, self._connection:
+            before = self._connection.total_changes
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO user_event (session_id, userid, timestamp, event_key, data)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                rows,
+            )
+            return self._connection.total_changes - before
+
+    def count(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM user_event').fetchone()[0]
+
+    def fetch_page(self, session_id, userid, start, end, cursor=None, limit=500, resume=False):
+        """
+        Return (events, cursor) for the next page of events of 'session_id'
+        (every session when None; and 'userid', when given) with
+        start <= timestamp <= end, ordered by timestamp. The returned cursor is
+        None once the range is exhausted, unless 'resume' is set: the cursor
+        then always follows the last event read, so the range can be read again
+        later for the events stored after it.
+        """
+        after_timestamp, after_pk = cursor if cursor else (start, -1)
+        sql = ('SELECT pk, timestamp, data FROM user_event'
+               ' WHERE timestamp <= ?'
+               ' AND (timestamp > ? OR (timestamp = ? AND pk > ?))')
+        params = [end, after_timestamp, after_timestamp, after_pk]
+        if session_id is not None:
+            sql += ' AND session_id = ?'
+            params.append(session_id)
+        if userid:
+            sql += ' AND userid = ?'
+            params.append(userid)
+        sql += ' ORDER BY timestamp, pk LIMIT ?'
+        params.append(limit)
+        with self._lock:
+            rows = self._connection.execute(sql, params).fetchall()
+        events = [json.loads(data) for _, _, data in rows]
+        if len(rows) < limit and not resume:
+            return events, None
+        if not rows:
+            return events, cursor
+        return events, (rows[-1][1], rows[-1][0])
+
+
+def _next_cursor(events, after, seen, key):
+    """Cursor for keyset pagination on (timestamp, keys seen at that timestamp)."""
+    last = events[-1].timestamp
+    at_last = {key(event) for event in events if event.timestamp == last}
+    if last == after:
+        at_last |= seen
+    return last, tuple(sorted(at_last))
+
+
+def iter_events(store, session_id, userid, start, end, page_size=500):
+    """
+    Iterate over the events of a session range (of every session when
+    'session_id' is None), fetching one page at a time.
+    """
+    cursor = None
+    while True:
+        events, cursor = store.fetch_page(session_id, userid, start, end, cursor, page_size)
+        yield from events
+        if cursor is None:
+            return
+
+
+def iter_record_steps(store, record, page_size=500, screenshots=None):
+    """
+    Iterate over the steps of the UserEventRecord 'record', in timestamp order.
+
+    With a ScreenshotStore, inline screenshots are stored as they stream past
+    and the steps only carry their references.
+    """
+    for steps, _ in iter_record_pages(store, record, page_size, screenshots):
+        yield from steps
+
+
+def iter_record_pages(store, record, page_size=500, screenshots=None, cursor=None, resume=False):
+    """
+    Iterate over the steps of the UserEventRecord 'record' stored after
+    'cursor', as iter_record_steps does, one page at a time.
+
+    Yields:
+    tuple: (steps, cursor). With 'resume', the cursor follows the last step
+    read so far, and passed back as 'cursor' it reads the steps stored after
+    them; otherwise it is None on the last page.
+    """
+    recorder = shareflow_metrics.recorder()
+    while True:
+        start = time.perf_counter()
+        events, cursor = store.fetch_page(record.session_id, record.userid, record.startstamp,
+                                          record.endstamp, cursor, page_size, resume=resume)
+        steps = [user_event_to_step(event) for event in events]
+        if recorder.enabled:
+            recorder.add('fetch', time.perf_counter() - start, len(steps), shareflow_metrics.payload_bytes(steps))
+        if screenshots is not None:
+            with recorder.stage('screenshots') as stage:
+                if recorder.enabled:
+                    stage.count(events=len(steps), bytes=sum(len(step['image']) for step in steps))
+                store_step_images(steps, screenshots)
+        yield steps, cursor
+        if (not events) if resume else cursor is None:
+            return
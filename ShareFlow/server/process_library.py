@@ -0,0 +1,368 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Versioned process libraries loaded from JSON files.
+
+A process library bundles an action mapping and a process map, identified by a
+name and a version. Libraries live in JSON files (see
+process_libraries/default-v1.json):
+
+    {
+      "name": "default",
+      "version": 1,
+      "applies_to": {"groups": [], "tasks": []},
+      "action_mapping": [{"type": "click", "text": "Search", "action": "Click_Search"},
+                         {"type": "scroll", "action": "Scroll"}, ...],
+      "process_map": [{"name": "AP1. Navigate", "pattern": ["Navigation", "Scroll", ...]},
+                      {"name": "SP3.9a Filling information", "pattern": [...], "enabled": false}, ...]
+    }
+
+Pattern order is declaration order, so the first entry still wins. Entries with
+"enabled": false are kept in the file but not used. Each library is compiled
+into its process matcher once; with a cache directory the compiled matcher is
+stored on disk under the SHA-256 of the file content, so workers starting with
+an unchanged library skip compilation. ProcessLibraryRegistry holds several
+libraries, reloads changed files without a restart and selects the library of
+a group or task. A file that fails to load is logged and its previous version,
+if any, stays in use. Until a default library has loaded, the registry falls
+back to the action mapping and process map of shareflow_process
+(builtin_library).
+
+Cached matchers are pickles, and loading a pickle can run arbitrary code, so
+the cache directory must not be writable by other users. A cached matcher is
+only loaded when the directory and the file belong to the current user and are
+not group- or world-writable, and when the file starts with the content hash
+of the library it was compiled from.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+from shareflow_process import action_mapping, cache_process_matcher, compile_process_map, process_map
+
+
+log = logging.getLogger('shareflow.library')
+
+
+class ProcessLibraryError(ValueError):
+    """Raised when a process library file is invalid."""
+
+
+class ProcessLibrary:
+    """
+    A versioned action mapping and process map.
+
+    Attributes:
+        name (str): Library name.
+        version (int): Library version.
+        action_mapping (dict): Mapping of raw types, or (type, text) pairs, to actions.
+        process_map (dict): Process names mapped to action sequences, in declaration order.
+        groups (list): Group identifiers the library applies to.
+        tasks (list): Task names the library applies to.
+        content_hash (str): SHA-256 of the library file content.
+        path (str): File the library was loaded from, if any.
+    """
+
+    def __init__(self, name, version, action_mapping, process_map, groups=(), tasks=(),
+                 content_hash='', path=None, matcher=None):
+        self.name = name
+        self.version = version
+        self.action_mapping = action_mapping
+        self.process_map = process_map
+        self.groups = list(groups)
+        self.tasks = list(tasks)
+        self.content_hash = content_hash
+        self.path = path
+        self.matcher = matcher if matcher is not None else compile_process_map(process_map)
+        # Labellers called with this process_map reuse the compiled matcher
+        cache_process_matcher(process_map, self.matcher)
+
+    def __setstate__(self, state):
+        # Libraries sent to worker processes bring their compiled matcher along
+        self.__dict__.update(state)
+        cache_process_matcher(self.process_map, self.matcher)
+
+    @property
+    def key(self):
+        """Identifier of this library version, e.g. 'default@1'."""
+        return '%s@%s' % (self.name, self.version)
+
+    @property
+    def tag(self):
+        """Version tag that changes with the library content, e.g. 'default@1:1a2b3c4d5e6f'."""
+        return '%s:%s' % (self.key, self.content_hash[:12])
+
+    def __repr__(self):
+        return 'ProcessLibrary(%r)' % (self.tag,)
+
+
+_builtin = None
+
+
+def builtin_library():
+    """
+    Return the action mapping and process map of shareflow_process as the
+    library 'builtin@0', created once.
+    """
+    global _builtin
+    if _builtin is None:
+        content = json.dumps([
+            [[list(key) if isinstance(key, tuple) else key, value] for key, value in action_mapping.items()],
+            list(process_map.items()),
+        ])
+        _builtin = ProcessLibrary('builtin', 0, action_mapping, process_map,
+                                  content_hash=hashlib.sha256(content.encode('utf-8')).hexdigest())
+    return _builtin
+
+
+def parse_library(document):
+    """
+    Validate a decoded library document.
+
+    Returns:
+    tuple: (name, version, action_mapping, process_map, groups, tasks).
+
+    Raises:
+    ProcessLibraryError: If a required field is missing or malformed.
+    """
+    try:
+        name = document['name']
+        version = document['version']
+        action_mapping = {}
+        for item in document['action_mapping']:
+            if 'text' in item:
+                action_mapping[(item['type'], item['text'])] = item['action']
+            else:
+                action_mapping[item['type']] = item['action']
+        process_map = {}
+        for item in document['process_map']:
+            if not item.get('enabled', True):
+                continue
+            pattern = item['pattern']
+            if not isinstance(pattern, list) or not pattern:
+                raise ProcessLibraryError('Pattern of %r must be a non-empty list' % (item['name'],))
+            # As with the module dict, a repeated name keeps its position and
+            # takes the last pattern
+            process_map[item['name']] = pattern
+        applies_to = document.get('applies_to', {})
+        groups = applies_to.get('groups', [])
+        tasks = applies_to.get('tasks', [])
+    except (KeyError, TypeError) as exc:
+        raise ProcessLibraryError('Invalid process library: %s' % (exc,)) from exc
+    return name, version, action_mapping, process_map, groups, tasks
+
+
+def _trusted(path):
+    # Only the current user may have written it (POSIX only)
+    if not hasattr(os, 'getuid'):
+        return True
+    stat = os.stat(path)
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+
+def _load_cached_matcher(cache_dir, content_hash):
+    if cache_dir is None:
+        return None
+    path = os.path.join(cache_dir, content_hash + '.matcher')
+    try:
+        if not (_trusted(cache_dir) and _trusted(path)):
+            log.warning("Ignoring cached matcher %s: writable by other users", path)
+            return None
+        with open(path, 'rb') as f:
+            content = f.read()
+    except OSError:
+        return None
+    # The file records the library it was compiled from
+    header = content_hash.encode('ascii') + b'\n'
+    if not content.startswith(header):
+        return None
+    try:
+        return pickle.loads(content[len(header):])
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError):
+        return None
+
+
+def _store_cached_matcher(cache_dir, content_hash, matcher):
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content_hash.encode('ascii') + b'\n')
+            pickle.dump(matcher, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, os.path.join(cache_dir, content_hash + '.matcher'))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def load_library(path, cache_dir=None):
+    """
+    Load a process library file, reusing its precompiled matcher from
+    'cache_dir' when the content hash matches.
+
+    Raises:
+    ProcessLibraryError: If the file is not a valid library.
+    """
+    with open(path, 'rb') as f:
+        content = f.read()
+    content_hash = hashlib.sha256(content).hexdigest()
+    try:
+        document = json.loads(content)
+    except ValueError as exc:
+        raise ProcessLibraryError('Invalid JSON in %s: %s' % (path, exc)) from exc
+    name, version, action_mapping, process_map, groups, tasks = parse_library(document)
+
+    matcher = _load_cached_matcher(cache_dir, content_hash)
+    if matcher is None:
+        matcher = compile_process_map(process_map)
+        if cache_dir is not None:
+            _store_cached_matcher(cache_dir, content_hash, matcher)
+    return ProcessLibrary(name, version, action_mapping, process_map, groups, tasks,
+                          content_hash, path, matcher)
+
+
+class ProcessLibraryRegistry:
+    """
+    The process libraries found in a directory.
+
+    Every '*.json' file is a library; the highest version of each name is the
+    current one, older versions stay addressable by version. Changed, added or
+    removed files are picked up by reload(), which get() and resolve() call at
+    most every 'reload_interval' seconds. A file that cannot be loaded is
+    logged and skipped until it changes again; the library previously loaded
+    from it stays in use.
+    """
+
+    def __init__(self, directory, cache_dir=None, default='default', reload_interval=5.0):
+        self.directory = directory
+        self.cache_dir = cache_dir
+        self.default = default
+        self.reload_interval = reload_interval
+        self._files = {}       # path -> (mtime_ns, size, library or None if it never loaded)
+        self._libraries = {}   # name -> {version: library}
+        self._checked = 0.0
+        self._fallback_logged = False
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """
+        Rescan the directory and reload changed libraries.
+
+        Returns:
+        list: Keys of the libraries (re)loaded.
+        """
+        loaded = []
+        with self._lock:
+            # Checked even if the scan fails, so reads are not slowed down retrying it
+            self._checked = time.monotonic()
+            try:
+                entries = [entry for entry in os.scandir(self.directory)
+                           if entry.name.endswith('.json') and entry.is_file()]
+            except OSError:
+                log.exception("Could not scan the process library directory %s", self.directory)
+                return loaded
+            seen = set()
+            for entry in entries:
+                seen.add(entry.path)
+                known = self._files.get(entry.path)
+                stat = None
+                try:
+                    stat = entry.stat()
+                    if known is not None and known[:2] == (stat.st_mtime_ns, stat.st_size):
+                        continue
+                    library = load_library(entry.path, self.cache_dir)
+                except (ProcessLibraryError, OSError):
+                    # Half-written or invalid: keep the previous version until the file changes
+                    log.exception("Could not load the process library %s", entry.path)
+                    if stat is not None:
+                        self._files[entry.path] = (stat.st_mtime_ns, stat.st_size,
+                                                   known[2] if known is not None else None)
+                    continue
+                self._files[entry.path] = (stat.st_mtime_ns, stat.st_size, library)
+                loaded.append(library.key)
+            for path in set(self._files) - seen:
+                del self._files[path]
+
+            libraries = {}
+            for _, _, library in self._files.values():
+                if library is None:
+                    continue
+                libraries.setdefault(library.name, {})[library.version] = library
+            self._libraries = libraries
+        return loaded
+
+    def _maybe_reload(self):
+        if self.reload_interval is not None and time.monotonic() - self._checked >= self.reload_interval:
+            self.reload()
+
+    def names(self):
+        return sorted(self._libraries)
+
+    def get(self, name=None, version=None):
+        """
+        Return a library by name (default library when omitted) and version
+        (latest when omitted). If the default library is not loaded, the
+        latest default is builtin_library().
+
+        Raises:
+        KeyError: If no such library is loaded.
+        """
+        self._maybe_reload()
+        name = name or self.default
+        versions = self._libraries.get(name)
+        if versions is None:
+            if name == self.default and version is None:
+                if not self._fallback_logged:
+                    self._fallback_logged = True
+                    log.error("The default process library %r is not loaded; using %r", name, builtin_library())
+                return builtin_library()
+            raise KeyError(name)
+        if version is None:
+            return versions[max(versions)]
+        return versions[version]
+
+    def resolve(self, groupid=None, task_name=None):
+        """
+        Return the library for a task or group: the latest library listing the
+        task, else the latest listing the group, else the default library.
+        """
+        self._maybe_reload()
+        latest = [versions[max(versions)] for versions in self._libraries.values()]
+        for library in latest:
+            if task_name and task_name in library.tasks:
+                return library
+        for library in latest:
+            if groupid and groupid in library.groups:
+                return library
+        return self.get()
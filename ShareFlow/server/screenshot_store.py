@@ -0,0 +1,190 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Content-addressed storage of screenshots.
+
+Screenshots are captured as base64 strings (optionally data URLs). Storing them
+here decodes them once, writes the bytes under their SHA-256 digest and returns
+a short reference ("sha256:<hex>"), so identical frames are stored once and the
+ShareFlow pipeline and API responses only carry references. The bytes are served
+separately by the screenshot endpoint.
+"""
+
+import base64
+import binascii
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+REF_PREFIX = "sha256:"
+
+_DATA_URL = re.compile(r"^data:(?P<type>[\w.+-]+/[\w.+-]+)?(?:;[\w=-]+)*;base64,")
+_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+# Leading bytes of the image formats produced by the capture client
+_MAGIC = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+    (b"RIFF", "image/webp"),
+)
+
+
+def is_image_ref(value):
+    """Return True if 'value' is a screenshot reference rather than inline image data."""
+    return isinstance(value, str) and value.startswith(REF_PREFIX) and bool(_DIGEST.match(value[len(REF_PREFIX):]))
+
+
+def guess_content_type(data):
+    for magic, content_type in _MAGIC:
+        if data.startswith(magic):
+            return content_type
+    return "application/octet-stream"
+
+
+def decode_image(image):
+    """
+    Decode a base64 screenshot (plain or data URL) into bytes.
+
+    Raises:
+    ValueError: If 'image' is not valid base64.
+    """
+    match = _DATA_URL.match(image)
+    if match:
+        image = image[match.end():]
+    try:
+        return base64.b64decode(image, validate=True)
+    except binascii.Error as exc:
+        raise ValueError("Screenshot is not valid base64") from exc
+
+
+class ScreenshotStore:
+    """
+    On-disk, content-addressed screenshot store.
+
+    Blobs are written to '<root>/<aa>/<bb>/<digest>' atomically, so concurrent
+    writers of the same frame are safe. A bounded in-memory map remembers the
+    references of recently stored strings to skip decoding and hashing repeats.
+
+    Attributes:
+        root (str): Directory holding the blobs.
+        writes (int): Number of blobs written.
+        deduplicated (int): Number of screenshots that were already stored.
+    """
+
+    def __init__(self, root, remember=64):
+        self.root = root
+        self.writes = 0
+        self.deduplicated = 0
+        self._remember = remember
+        self._recent = OrderedDict()  # image string -> reference
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def put(self, image):
+        """
+        Store a screenshot and return its reference. Empty values and values
+        that already are references are returned unchanged.
+        """
+        if not image or is_image_ref(image):
+            return image
+        with self._lock:
+            ref = self._recent.get(image)
+            if ref is not None:
+                self._recent.move_to_end(image)
+                self.deduplicated += 1
+                return ref
+
+        ref = self.put_bytes(decode_image(image))
+        with self._lock:
+            self._recent[image] = ref
+            if len(self._recent) > self._remember:
+                self._recent.popitem(last=False)
+        return ref
+
+    def put_bytes(self, data):
+        """Store raw image bytes and return their reference."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if os.path.exists(path):
+            with self._lock:
+                self.deduplicated += 1
+            return REF_PREFIX + digest
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        with self._lock:
+            self.writes += 1
+        return REF_PREFIX + digest
+
+    def get(self, ref):
+        """
+        Return (bytes, content type) of a stored screenshot.
+
+        Raises:
+        KeyError: If 'ref' is not a valid reference or is not stored.
+        """
+        if not is_image_ref(ref):
+            raise KeyError(ref)
+        try:
+            with open(self._path(ref[len(REF_PREFIX):]), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise KeyError(ref) from None
+        return data, guess_content_type(data)
+
+    def __contains__(self, ref):
+        return is_image_ref(ref) and os.path.exists(self._path(ref[len(REF_PREFIX):]))
+
+
+def store_step_images(steps, store):
+    """
+    Replace the inline 'image' of every step with its screenshot reference.
+    Screenshots that cannot be decoded are dropped.
+    """
+    for step in steps:
+        image = step.get('image')
+        if image:
+            try:
+                step['image'] = store.put(image)
+            except ValueError:
+                step['image'] = ''
+    return steps
@@ -0,0 +1,546 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Columnar on-disk archive of UserEvents.
+
+An archive is a directory of NumPy .npy files holding one column per UserEvent
+field, with the events sorted by session and timestamp:
+
+- fixed-width columns: timestamp, end_timestamp (int64), width, height,
+  coalesced (int32) and offset_x, offset_y (float64); missing values are
+  stored as INT_NULL or NaN,
+- dictionary-encoded columns (event_type and every string field): an int32
+  code per event (-1 for missing) plus the distinct values, stored once as a
+  UTF-8 blob and an int64 offset array. The distinct screenshots (image) are
+  appended to their blob file as they are first seen, and only their SHA-256
+  digests are kept in memory while writing,
+- a session index: the session ids (dictionary-encoded like the strings) and
+  the row offset at which each session starts.
+
+Columns are opened with np.load(mmap_mode='r'), so opening an archive reads
+only the small session index and reading a session touches the pages of its
+own rows. Strings are decoded once per distinct value (screenshots on every
+read).
+
+    python shareflow_archive.py export <dir> [--since <ms>]
+    python shareflow_archive.py import <dir> [--sqlite <path>]
+
+EventArchive also implements fetch_page, so it can stand in for an event store
+wherever one is taken (iter_record_steps, record_sessions), and
+shareflow_batch.archive_sessions reads sessions straight from an archive in
+the worker processes.
+
+NumPy is an optional dependency and is only required when this module is used.
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import shutil
+import sys
+from array import array
+from functools import lru_cache
+
+from event_store import USER_EVENT_FIELDS, user_event_to_step
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is optional
+    np = None
+
+
+ARCHIVE_FORMAT = 1
+
+# Null marker of the integer columns
+INT_NULL = -2 ** 31
+
+# Fixed-width columns and their dtypes
+FIXED_COLUMNS = {
+    'timestamp': 'int64',
+    'end_timestamp': 'int64',
+    'width': 'int32',
+    'height': 'int32',
+    'coalesced': 'int32',
+    'offset_x': 'float64',
+    'offset_y': 'float64',
+}
+
+# Every other stored field is dictionary-encoded; 'extent' as its JSON text
+STRING_COLUMNS = tuple(
+    name for name in USER_EVENT_FIELDS if name not in FIXED_COLUMNS and name != 'session_id'
+)
+
+# String columns whose distinct values are streamed to disk while writing and
+# not kept once decoded while reading
+BLOB_COLUMNS = ('image',)
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("The event archive requires numpy")
+
+
+def _field(event, name):
+    if isinstance(event, dict):
+        return event.get(name)
+    return getattr(event, name, None)
+
+
+class _Dictionary:
+    """Assigns consecutive codes to distinct values while writing."""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        if value is None:
+            return -1
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class _BlobDictionary:
+    """
+    Assigns codes like _Dictionary, for values too large to keep in memory:
+    each distinct value is appended to the blob file when it is first seen and
+    only its digest is kept.
+    """
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.handle = open(os.path.join(path, name + '.blob.raw'), 'wb')
+        self.codes = {}
+        self.offsets = array('q', [0])
+
+    def code(self, value):
+        if value is None:
+            return -1
+        data = value.encode('utf-8')
+        digest = hashlib.sha256(data).digest()
+        code = self.codes.get(digest)
+        if code is None:
+            code = self.codes[digest] = len(self.offsets) - 1
+            self.handle.write(data)
+            self.offsets.append(self.offsets[-1] + len(data))
+        return code
+
+    def save(self):
+        """Write the offsets and turn the blob file into the .npy _save_dictionary writes."""
+        self.handle.close()
+        _save(self.path, self.name + '.offsets', np.asarray(self.offsets, dtype='int64'))
+        raw = os.path.join(self.path, self.name + '.blob.raw')
+        with open(os.path.join(self.path, self.name + '.blob.npy'), 'wb') as out, open(raw, 'rb') as blob:
+            header = {'descr': '|u1', 'fortran_order': False, 'shape': (self.offsets[-1],)}
+            np.lib.format.write_array_header_1_0(out, header)
+            shutil.copyfileobj(blob, out)
+        os.remove(raw)
+
+
+def _save(path, name, values):
+    np.save(os.path.join(path, name + '.npy'), values, allow_pickle=False)
+
+
+def _save_dictionary(path, name, values):
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype='int64')
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    _save(path, name + '.offsets', offsets)
+    _save(path, name + '.blob', np.frombuffer(b''.join(encoded), dtype='uint8'))
+
+
+def _text(name, value):
+    if name == 'extent':
+        return json.dumps(list(value)) if value else None
+    return value if value is None or isinstance(value, str) else str(value)
+
+
+def write_archive(path, events):
+    """
+    Write 'events' (UserEvent model instances or dicts, in any order) to a new
+    archive directory 'path'.
+
+    Events are buffered column by column as compact arrays, so the memory used
+    while writing is a few bytes per event plus the distinct strings. Distinct
+    screenshots are written to disk as they are met (BLOB_COLUMNS).
+
+    Returns:
+    dict: The archive metadata ('events', 'sessions', ...).
+    """
+    _require_numpy()
+    os.makedirs(path, exist_ok=True)
+
+    typecodes = {'int64': 'q', 'int32': 'i', 'float64': 'd'}
+    fixed = {name: array(typecodes[dtype]) for name, dtype in FIXED_COLUMNS.items()}
+    strings = {name: array('i') for name in STRING_COLUMNS}
+    dictionaries = {
+        name: _BlobDictionary(path, name) if name in BLOB_COLUMNS else _Dictionary()
+        for name in STRING_COLUMNS
+    }
+    sessions = _Dictionary()
+    session_codes = array('i')
+
+    for event in events:
+        session_codes.append(sessions.code(_field(event, 'session_id') or ''))
+        for name, column in fixed.items():
+            value = _field(event, name)
+            if column.typecode == 'd':
+                column.append(math.nan if value is None else float(value))
+            else:
+                column.append(INT_NULL if value is None else int(value))
+        for name, column in strings.items():
+            column.append(dictionaries[name].code(_text(name, _field(event, name))))
+
+    # Sessions are stored in session id order, each sorted by timestamp; the
+    # sort is stable, so events sharing a timestamp keep their input order
+    names = np.array(sessions.values, dtype=object)
+    by_name = np.argsort(names, kind='stable') if len(names) else np.zeros(0, dtype='int64')
+    rank = np.empty(len(by_name), dtype='int64')
+    rank[by_name] = np.arange(len(by_name))
+    session_rank = rank[np.frombuffer(session_codes, dtype='int32')] if len(session_codes) \
+        else np.zeros(0, dtype='int64')
+    timestamps = np.frombuffer(fixed['timestamp'], dtype='int64') if len(session_codes) \
+        else np.zeros(0, dtype='int64')
+    order = np.lexsort((timestamps, session_rank))
+
+    for name, dtype in FIXED_COLUMNS.items():
+        _save(path, name, np.asarray(fixed[name], dtype=dtype)[order])
+    for name in STRING_COLUMNS:
+        _save(path, name, np.asarray(strings[name], dtype='int32')[order])
+        if name in BLOB_COLUMNS:
+            dictionaries[name].save()
+        else:
+            _save_dictionary(path, name, dictionaries[name].values)
+
+    counts = np.bincount(session_rank, minlength=len(by_name))
+    offsets = np.zeros(len(by_name) + 1, dtype='int64')
+    np.cumsum(counts, out=offsets[1:])
+    _save(path, 'session.offsets.rows', offsets)
+    _save_dictionary(path, 'session', [sessions.values[code] for code in by_name])
+
+    meta = {
+        'format': ARCHIVE_FORMAT,
+        'events': len(session_codes),
+        'sessions': len(by_name),
+        'fixed': FIXED_COLUMNS,
+        'strings': list(STRING_COLUMNS),
+    }
+    with open(os.path.join(path, 'archive.json'), 'w') as handle:
+        json.dump(meta, handle, indent=2)
+    return meta
+
+
+class _StringColumn:
+    """
+    Memory-mapped dictionary of a string column, decoded on first use. With
+    cache=False values are decoded on every use instead of being kept.
+    """
+
+    def __init__(self, path, name, cache=True):
+        self.offsets = np.load(os.path.join(path, name + '.offsets.npy'), mmap_mode='r')
+        self.blob = np.load(os.path.join(path, name + '.blob.npy'), mmap_mode='r')
+        self.decoded = {} if cache else None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def value(self, code):
+        if code < 0:
+            return None
+        value = None if self.decoded is None else self.decoded.get(code)
+        if value is None:
+            start, stop = int(self.offsets[code]), int(self.offsets[code + 1])
+            value = self.blob[start:stop].tobytes().decode('utf-8')
+            if self.decoded is not None:
+                self.decoded[code] = value
+        return value
+
+
+class EventArchive:
+    """
+    Read-only view of an archive written by write_archive.
+
+    Columns are memory-mapped; slices of them are views into the mapping.
+    """
+
+    def __init__(self, path):
+        _require_numpy()
+        self.path = path
+        try:
+            with open(os.path.join(path, 'archive.json')) as handle:
+                self.meta = json.load(handle)
+        except (OSError, ValueError) as exc:
+            raise ArchiveError("%s is not an event archive: %s" % (path, exc))
+        if self.meta.get('format') != ARCHIVE_FORMAT:
+            raise ArchiveError("Unsupported event archive format %r" % self.meta.get('format'))
+
+        self.columns = {
+            name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+            for name in list(FIXED_COLUMNS) + list(STRING_COLUMNS)
+        }
+        self.strings = {
+            name: _StringColumn(path, name, cache=name not in BLOB_COLUMNS) for name in STRING_COLUMNS
+        }
+        self.session_rows = np.load(os.path.join(path, 'session.offsets.rows.npy'), mmap_mode='r')
+        session_names = _StringColumn(path, 'session')
+        self.index = {session_names.value(i): i for i in range(len(session_names))}
+
+    def __len__(self):
+        return self.meta['events']
+
+    def sessions(self):
+        """Return the session ids of the archive, in storage order."""
+        return list(self.index)
+
+    def rows(self, session_id):
+        """Return the (start, stop) rows of 'session_id'; (0, 0) if it is not archived."""
+        i = self.index.get(session_id)
+        if i is None:
+            return 0, 0
+        return int(self.session_rows[i]), int(self.session_rows[i + 1])
+
+    def column(self, name, session_id):
+        """Return the rows of column 'name' for 'session_id' (a view of the mapping)."""
+        start, stop = self.rows(session_id)
+        return self.columns[name][start:stop]
+
+    def events(self, session_id, start=None, stop=None):
+        """
+        Return the events of 'session_id' as dicts of UserEvent fields, in
+        timestamp order, optionally limited to rows [start, stop) of the session.
+        """
+        first, last = self.rows(session_id)
+        if start is not None:
+            first, last = first + start, min(last, first + (stop if stop is not None else last))
+        # Nulls are replaced column by column: NaN in the float columns,
+        # INT_NULL in the integer ones
+        fixed = {}
+        for name, dtype in FIXED_COLUMNS.items():
+            values = self.columns[name][first:last]
+            null = np.isnan(values) if dtype == 'float64' else values == INT_NULL
+            values = values.astype(object)
+            values[null] = None
+            fixed[name] = values.tolist()
+        codes = {name: self.columns[name][first:last].tolist() for name in STRING_COLUMNS}
+
+        events = []
+        for i in range(last - first):
+            event = {'session_id': session_id}
+            for name, values in fixed.items():
+                event[name] = values[i]
+            for name, values in codes.items():
+                event[name] = self.strings[name].value(values[i])
+            if event['extent'] is not None:
+                event['extent'] = json.loads(event['extent'])
+            events.append(event)
+        return events
+
+    def actions(self, session_id, mapping):
+        """
+        Return the actions (see shareflow_process.map_action_type) of the events
+        of 'session_id', read from the event_type and text_content codes only.
+        """
+        from shareflow_process import map_action_type
+
+        types = self.column('event_type', session_id).tolist()
+        texts = self.column('text_content', session_id).tolist()
+        actions = {}
+        result = []
+        for pair in zip(types, texts):
+            action = actions.get(pair)
+            if action is None:
+                type_code, text_code = pair
+                event_type = self.strings['event_type'].value(type_code)
+                action = actions[pair] = map_action_type(
+                    'No type' if event_type is None else event_type,
+                    self.strings['text_content'].value(text_code) or '', mapping)
+            result.append(action)
+        return tuple(result)
+
+    def steps(self, session_id, start=None, end=None):
+        """
+        Return the steps (see event_store.user_event_to_step) of 'session_id'
+        with start <= timestamp <= end.
+        """
+        first, last = self._timestamp_rows(session_id, start, end)
+        return [user_event_to_step(event) for event in self.events(session_id, first, last)]
+
+    def _timestamp_rows(self, session_id, start, end):
+        timestamps = self.column('timestamp', session_id)
+        first = 0 if start is None else int(np.searchsorted(timestamps, start, side='left'))
+        last = len(timestamps) if end is None else int(np.searchsorted(timestamps, end, side='right'))
+        return first, max(first, last)
+
+    def fetch_page(self, session_id, userid, start, end, cursor=None, limit=500, resume=False):
+        """
+        Return (events, cursor) for the next page of events of 'session_id'
+        (and 'userid', when given) with start <= timestamp <= end, in the
+        event store interface. The cursor is the next row of the session.
+        """
+        first, last = self._timestamp_rows(session_id, start, end)
+        if cursor is not None:
+            first = cursor
+        stop = min(last, first + limit)
+        events = self.events(session_id, first, stop)
+        if userid:
+            events = [event for event in events if event['userid'] == userid]
+        return events, (stop if stop < last or resume else None)
+
+
+@lru_cache(maxsize=8)
+def open_archive(path):
+    """Return the EventArchive at 'path', opened once per process."""
+    return EventArchive(path)
+
+
+def session_entries(archive, session_id):
+    """
+    Return the entries shareflows_process takes for an archived session, one
+    per consecutive (userid, task_name) run of its events.
+    """
+    return _entries(archive.events(session_id), session_id)
+
+
+def iter_session_entries(archive, session_id, batch_size=1000):
+    """
+    Yield the entries of an archived session as session_entries does, reading
+    'batch_size' events at a time. A run longer than a batch is split into
+    consecutive entries with the same userid and task name, which the
+    single-pass pipeline (shareflow_stream) groups back together.
+    """
+    start, stop = archive.rows(session_id)
+    for first in range(0, stop - start, batch_size):
+        yield from _entries(archive.events(session_id, first, first + batch_size), session_id)
+
+
+def _entries(events, session_id):
+    entries = []
+    for event in events:
+        key = (event['userid'], event['task_name'])
+        if not entries or entries[-1][0] != key:
+            entries.append((key, []))
+        entries[-1][1].append(user_event_to_step(event))
+    return [
+        {'taskName': task_name, 'userid': userid, 'sessionId': session_id, 'steps': steps}
+        for (userid, task_name), steps in entries
+    ]
+
+
+class ArchivedSession:
+    """
+    Reference to a session of an archive. It pickles as the archive path and
+    session id only, so a worker process reads the session from its own
+    memory mapping instead of receiving its events.
+    """
+
+    __slots__ = ('path', 'session_id')
+
+    def __init__(self, path, session_id):
+        self.path = path
+        self.session_id = session_id
+
+    def __getstate__(self):
+        return self.path, self.session_id
+
+    def __setstate__(self, state):
+        self.path, self.session_id = state
+
+    def load(self):
+        return session_entries(open_archive(self.path), self.session_id)
+
+    def iter_entries(self, batch_size=1000):
+        return iter_session_entries(open_archive(self.path), self.session_id, batch_size)
+
+    def actions(self, mapping):
+        return open_archive(self.path).actions(self.session_id, mapping)
+
+
+def import_archive(archive, store, batch_size=1000):
+    """
+    Store every event of 'archive' in the event store 'store'.
+
+    Returns:
+    int: Number of events written.
+    """
+    written = 0
+    for session_id in archive.sessions():
+        start, stop = archive.rows(session_id)
+        for first in range(0, stop - start, batch_size):
+            written += store.add(archive.events(session_id, first, first + batch_size))
+    return written
+
+
+def _redis_events(since):
+    from data_models import UserEventRecord
+    from event_store import RedisEventStore, iter_events
+
+    store = RedisEventStore()
+    if since:
+        records = UserEventRecord.find(UserEventRecord.startstamp >= since).all()
+        for record in records:
+            yield from iter_events(store, record.session_id, record.userid, record.startstamp, record.endstamp)
+    else:
+        # Every session, one keyset page at a time
+        yield from iter_events(store, None, None, 0, sys.maxsize)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export UserEvents to, or import them from, a columnar archive.")
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    command = subcommands.add_parser('export', help="write the UserEvents stored in Redis to an archive")
+    command.add_argument('path', help="archive directory")
+    command.add_argument('--since', type=int, default=0,
+                         help="only the events of recordings started at or after this timestamp (ms)")
+    command = subcommands.add_parser('import', help="store the events of an archive")
+    command.add_argument('path', help="archive directory")
+    command.add_argument('--sqlite', default=None,
+                         help="write to this SQLite event store instead of Redis")
+    command.add_argument('--batch-size', type=int, default=1000, help="events stored per round trip")
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        result = write_archive(args.path, _redis_events(args.since))
+    else:
+        from event_store import RedisEventStore, SQLiteEventStore
+
+        store = SQLiteEventStore(args.sqlite) if args.sqlite else RedisEventStore()
+        result = {'events': import_archive(EventArchive(args.path), store, args.batch_size)}
+    json.dump(result, sys.stdout)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
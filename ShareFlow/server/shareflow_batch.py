@@ -0,0 +1,306 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Batch generation of ShareFlows for many sessions.
+
+reformat_to_nested builds one document per call, so the input has to be split
+per session first. shareflows_process_many partitions entries (or the events of
+UserEventRecords) by session, runs shareflows_process for every session on a
+process pool in chunks, and returns one result per session in first-seen order.
+A failing session is reported in its own result and does not stop the batch.
+
+It is also a command-line tool over JSONL files with one entry per line, which
+writes one {"sessionId", "dc", "error"} line per session:
+
+    python shareflow_batch.py traces.jsonl [...] --output shareflows.jsonl --processes 4
+
+The files are indexed first (the byte offset of every line of every session),
+and the workers read the lines of their sessions themselves. With
+--memory-budget the entries are read one at a time and the documents may
+spill to disk (see shareflow_spill), so the memory of a worker does not grow
+with the size of a session. Neither Pyramid nor NumPy is imported.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from event_store import iter_record_steps
+from shareflow_process import shareflows_process
+
+
+def partition_sessions(share_flow_data):
+    """
+    Group entries ('taskName', 'userid', 'sessionId', 'steps') by 'sessionId'.
+
+    Returns:
+    list: (sessionId, entries) pairs in order of first appearance.
+    """
+    sessions = {}
+    for entry in share_flow_data:
+        sessions.setdefault(entry.get('sessionId', ''), []).append(entry)
+    return list(sessions.items())
+
+
+def record_sessions(records, store, page_size=500):
+    """
+    Yield (sessionId, entries) for every UserEventRecord, fetching its events
+    from 'store' only when the session is about to be processed.
+    """
+    for record in records:
+        yield record.session_id, [{
+            'taskName': record.task_name,
+            'userid': record.userid,
+            'sessionId': record.session_id,
+            'steps': list(iter_record_steps(store, record, page_size)),
+        }]
+
+
+def archive_sessions(path, session_ids=None):
+    """
+    Yield (sessionId, ArchivedSession) for the sessions of the event archive
+    at 'path' (all of them by default). Only the references are sent to the
+    workers, which read the events from their own mapping of the archive.
+    """
+    from shareflow_archive import ArchivedSession, open_archive
+
+    if session_ids is None:
+        session_ids = open_archive(path).sessions()
+    for session_id in session_ids:
+        yield session_id, ArchivedSession(path, session_id)
+
+
+class JsonlSession:
+    """
+    Reference to the lines of one session in a JSONL file of entries. It
+    pickles as the path and the line offsets only.
+    """
+
+    __slots__ = ('path', 'offsets')
+
+    def __init__(self, path, offsets):
+        self.path = path
+        self.offsets = offsets
+
+    def __getstate__(self):
+        return self.path, self.offsets
+
+    def __setstate__(self, state):
+        self.path, self.offsets = state
+
+    def load(self):
+        return list(self.iter_entries())
+
+    def iter_entries(self):
+        with open(self.path, 'rb') as handle:
+            for offset in self.offsets:
+                handle.seek(offset)
+                yield json.loads(handle.readline())
+
+
+def jsonl_sessions(paths):
+    """
+    Yield (sessionId, JsonlSession) for the sessions of JSONL files of entries
+    ('taskName', 'userid', 'sessionId', 'steps'), file by file in order of
+    first appearance. Blank lines are skipped; a session split across files
+    gives one result per file.
+    """
+    for path in paths:
+        sessions = {}
+        with open(path, 'rb') as handle:
+            offset = 0
+            for number, line in enumerate(handle, 1):
+                if line.strip():
+                    try:
+                        session_id = json.loads(line).get('sessionId', '')
+                    except (ValueError, AttributeError):
+                        raise ValueError("%s:%d is not a JSON entry" % (path, number))
+                    sessions.setdefault(session_id, array('q')).append(offset)
+                offset += len(line)
+        for session_id, offsets in sessions.items():
+            yield session_id, JsonlSession(path, offsets)
+
+
+def process_session(session_id, entries, options):
+    """
+    Run shareflows_process for one session. 'entries' may be a reference to
+    the session (ArchivedSession, JsonlSession), which is read here; with a
+    'memory_budget' option it is read as the pipeline consumes it.
+
+    Returns:
+    dict: {'sessionId', 'dc', 'error'}; 'error' is None on success.
+    """
+    try:
+        if hasattr(entries, 'iter_entries'):
+            entries = entries.iter_entries() if options.get('memory_budget') is not None else entries.load()
+        return {'sessionId': session_id, 'dc': shareflows_process(entries, **options), 'error': None}
+    except Exception as exc:
+        return {'sessionId': session_id, 'dc': None, 'error': '%s: %s' % (type(exc).__name__, exc)}
+
+
+def _process_chunk(chunk, options):
+    return [process_session(session_id, entries, options) for session_id, entries in chunk]
+
+
+def _chunks(sessions, chunksize):
+    chunk = []
+    for session in sessions:
+        chunk.append(session)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_shareflows_many(sessions, processes=None, chunksize=16, **options):
+    """
+    Generate the ShareFlow of every session, yielding results in input order.
+
+    Parameters:
+    sessions (iterable): (sessionId, entries) pairs, see partition_sessions, record_sessions
+        and archive_sessions.
+    processes (int): Number of worker processes (default: CPU count); 0 or 1 runs in-process.
+    chunksize (int): Number of sessions sent to a worker at once.
+    options: Keyword arguments passed to shareflows_process (engine, columnar, memory_budget).
+
+    Yields:
+    dict: {'sessionId', 'dc', 'error'} per session.
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    chunks = _chunks(sessions, chunksize)
+    if processes <= 1:
+        for chunk in chunks:
+            yield from _process_chunk(chunk, options)
+        return
+
+    # Keep a bounded number of chunks in flight so large batches are not
+    # materialized up front; results are yielded in submission order.
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_process_chunk, chunk, options))
+            if len(pending) >= 2 * processes:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def shareflows_process_many(share_flow_data=None, records=None, store=None, processes=None,
+                            chunksize=16, archive=None, **options):
+    """
+    Generate one ShareFlow document per session.
+
+    Parameters:
+    share_flow_data (list): Entries of any number of sessions, in the shape taken by shareflows_process.
+    records (iterable): UserEventRecords whose events are read from 'store' (alternative to share_flow_data).
+    store: Event store used with 'records' (see event_store).
+    processes (int): Number of worker processes (default: CPU count); 0 or 1 runs in-process.
+    chunksize (int): Number of sessions sent to a worker at once.
+    archive (str): Path of an event archive whose sessions are all processed
+        (alternative to share_flow_data and records, see shareflow_archive).
+    options: Keyword arguments passed to shareflows_process (engine, columnar).
+
+    Returns:
+    list: {'sessionId', 'dc', 'error'} per session, in order of first appearance.
+    """
+    if archive is not None:
+        sessions = archive_sessions(archive)
+    elif records is not None:
+        if store is None:
+            raise ValueError("An event store is required to process UserEventRecords")
+        sessions = record_sessions(records, store)
+    else:
+        sessions = partition_sessions(share_flow_data or [])
+    return list(iter_shareflows_many(sessions, processes, chunksize, **options))
+
+
+def write_results(results, output):
+    """
+    Write every result as one JSON line to the text stream 'output', encoding
+    the documents incrementally (spilled documents are read back from disk).
+
+    Returns:
+    dict: Number of sessions and of errors.
+    """
+    from shareflow_response import iter_json
+
+    counts = {'sessions': 0, 'errors': 0}
+    for result in results:
+        for chunk in iter_json(result):
+            output.write(chunk.decode('utf-8'))
+        output.write('\n')
+        counts['sessions'] += 1
+        counts['errors'] += result['error'] is not None
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate one ShareFlow per session of JSONL files of entries.")
+    parser.add_argument('paths', nargs='+', help="JSONL files, one entry (taskName, userid, sessionId, steps) per line")
+    parser.add_argument('--output', default=None, help="JSONL file of the results (default: standard output)")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes (default: CPU count); 0 or 1 runs in-process")
+    parser.add_argument('--chunksize', type=int, default=1, help="sessions sent to a worker at once")
+    parser.add_argument('--memory-budget', type=int, default=None,
+                        help="bytes of steps a worker holds before spilling to disk")
+    parser.add_argument('--spill-dir', default=None, help="directory of the spill files")
+    parser.add_argument('--library', default=None, help="process library JSON file (default: the built-in one)")
+    parser.add_argument('--engine', default='trie', help="labeller engine (see LABELLER_ENGINES)")
+    parser.add_argument('--columnar', action='store_true', help="use the columnar pipeline")
+    parser.add_argument('--fused', action='store_true', help="use the fused pipeline")
+    parser.add_argument('--coalesce', action='store_true', help="coalesce keystroke and scroll runs")
+    args = parser.parse_args(argv)
+
+    options = {'engine': args.engine, 'columnar': args.columnar, 'fused': args.fused, 'coalesce': args.coalesce}
+    if args.library:
+        from process_library import load_library
+
+        options['library'] = load_library(args.library)
+    if args.memory_budget is not None:
+        options.update(memory_budget=args.memory_budget, spill_dir=args.spill_dir)
+
+    start = time.perf_counter()
+    results = iter_shareflows_many(jsonl_sessions(args.paths), args.processes, args.chunksize, **options)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            counts = write_results(results, output)
+    else:
+        counts = write_results(results, sys.stdout)
+    counts['seconds'] = round(time.perf_counter() - start, 3)
+    json.dump(counts, sys.stderr)
+    sys.stderr.write('\n')
+    return 1 if counts['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
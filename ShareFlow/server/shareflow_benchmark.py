@@ -0,0 +1,307 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Benchmark suite for the ShareFlow pipeline.
+
+A seeded generator produces synthetic sessions in the shape shareflows_process
+takes, using the event types emitted by userTraceCapture.ts and screenshot
+payloads of realistic base64 size. Every pipeline stage and the end-to-end
+pipeline are timed for each engine and the results are written as JSON:
+
+    python shareflow_benchmark.py --sizes 1000 10000 100000 --output bench.json
+"""
+
+import argparse
+import base64
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from shareflow_process import (
+    LABELLER_ENGINES,
+    action_mapper,
+    process_serialize,
+    reformat_to_nested,
+    shareflows_process,
+)
+
+
+# Event types emitted by userTraceCapture.ts with their relative frequency and
+# how likely the same event is to be repeated (scroll ticks, key presses)
+EVENT_TYPES = {
+    'click': (30, 0.25),
+    'scroll': (20, 0.6),
+    'keydown': (8, 0.7),
+    'keyup': (12, 0.7),
+    'navigate': (8, 0.05),
+    'select': (6, 0.1),
+    'change': (4, 0.1),
+    'submit': (2, 0.0),
+    'paste': (1, 0.0),
+    'drop': (1, 0.0),
+    'getfocus': (3, 0.0),
+    'beforeunload': (1, 0.0),
+}
+
+# Button texts recognised by action_mapping, plus generic ones
+CLICK_TEXTS = ['Search', 'Upload', 'Post', 'Highlight', 'k-clip', 'Save', 'Next', 'Open', '']
+
+SCROLL_TEXTS = ['SCROLL DOWN', 'SCROLL UP', 'SCROLL DOWN:SCROLL RIGHT', '']
+
+KEY_CODES = ['KeyA', 'KeyE', 'KeyS', 'KeyT', 'Space', 'Backspace', 'Enter', 'ShiftLeft']
+
+PAGE_TITLES = ['Moodle', 'Library search', 'Assessment brief', 'Knowledge base', 'Forum']
+
+
+def _image_pool(rng, size, count):
+    return [base64.b64encode(rng.randbytes(size)).decode('ascii') for _ in range(count)]
+
+
+def synthetic_trace(events, seed=0, sessions=1, image_rate=0.1, image_bytes=48 * 1024, image_pool=16):
+    """
+    Generate a seeded synthetic trace in the shape taken by shareflows_process.
+
+    Parameters:
+    events (int): Total number of steps to generate.
+    seed (int): Random seed; the same arguments always generate the same trace.
+    sessions (int): Number of entries (sessions) the steps are split across.
+    image_rate (float): Probability that a step carries a screenshot.
+    image_bytes (int): Size of the raw screenshot before base64 encoding.
+    image_pool (int): Number of distinct screenshots reused across steps.
+
+    Returns:
+    list: Entries with 'taskName', 'userid', 'sessionId' and 'steps'.
+    """
+    rng = random.Random(seed)
+    images = _image_pool(rng, image_bytes, image_pool) if image_rate else []
+    names = list(EVENT_TYPES)
+    weights = [EVENT_TYPES[name][0] for name in names]
+
+    trace = []
+    per_session, extra = divmod(events, sessions)
+    for session in range(sessions):
+        steps = []
+        url = 'https://example.edu/course/%d' % rng.randrange(1000)
+        title = rng.choice(PAGE_TITLES)
+        event_type = 'navigate'
+        for _ in range(per_session + (1 if session < extra else 0)):
+            if steps and rng.random() >= EVENT_TYPES[event_type][1]:
+                event_type = rng.choices(names, weights)[0]
+            if event_type == 'navigate':
+                url = 'https://example.edu/course/%d' % rng.randrange(1000)
+                title = rng.choice(PAGE_TITLES)
+
+            if event_type == 'click':
+                text = rng.choice(CLICK_TEXTS)
+            elif event_type == 'scroll':
+                text = rng.choice(SCROLL_TEXTS)
+            elif event_type in ('keydown', 'keyup'):
+                text = rng.choice(KEY_CODES)
+            elif event_type == 'select':
+                text = 'selected passage %d' % rng.randrange(100)
+            else:
+                text = ''
+
+            steps.append({
+                'type': event_type,
+                'text': text,
+                'url': url,
+                'description': '',
+                'image': rng.choice(images) if images and rng.random() < image_rate else '',
+                'title': title,
+                'width': 1920,
+                'height': 1080,
+                'offsetX': rng.randrange(1920),
+                'offsetY': rng.randrange(1080),
+            })
+        trace.append({
+            'taskName': 'Synthetic task %d' % session,
+            'userid': 'acct:user%d@example.edu' % (session % 7),
+            'sessionId': 'session-%d-%d' % (seed, session),
+            'steps': steps,
+        })
+    return trace
+
+
+def _time(func, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+def _record(results, stage, engine, events, timings):
+    best = min(timings)
+    results.append({
+        'stage': stage,
+        'engine': engine,
+        'events': events,
+        'repeat': len(timings),
+        'seconds_min': best,
+        'seconds_median': statistics.median(timings),
+        'events_per_second': events / best if best else None,
+    })
+
+
+def available_engines():
+    """
+    Return the engines that can run here: the labeller engines, the fused
+    single-pass mode and 'columnar' when numpy is installed.
+    """
+    engines = list(LABELLER_ENGINES) + ['fused']
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        engines.append('columnar')
+    return engines
+
+
+def run_benchmarks(sizes, repeat=3, seed=0, engines=None, image_rate=0.1):
+    """
+    Time every pipeline stage at every size.
+
+    Returns:
+    list: One result dictionary per (stage, engine, size).
+    """
+    if engines is None:
+        engines = available_engines()
+    results = []
+    for size in sizes:
+        trace = synthetic_trace(size, seed=seed, image_rate=image_rate)
+
+        timings, actions = _time(lambda: action_mapper(trace), repeat)
+        _record(results, 'action_mapper', None, size, timings)
+
+        for engine in engines:
+            if engine == 'fused':
+                # labelling is not a separate stage in the fused mode
+                continue
+            if engine == 'columnar':
+                from shareflow_columnar import process_labeller_columnar as labeller
+            else:
+                labeller = LABELLER_ENGINES[engine]
+            timings, _ = _time(lambda: labeller(actions), repeat)
+            _record(results, 'process_labeller', engine, size, timings)
+
+        timings, _ = _time(lambda: process_serialize(actions), repeat)
+        _record(results, 'process_serialize', None, size, timings)
+
+        timings, _ = _time(lambda: reformat_to_nested(actions), repeat)
+        _record(results, 'reformat_to_nested', None, size, timings)
+
+        for engine in engines:
+            if engine == 'columnar':
+                run = lambda: shareflows_process(trace, columnar=True)
+            elif engine == 'fused':
+                run = lambda: shareflows_process(trace, fused=True)
+            else:
+                run = lambda: shareflows_process(trace, engine=engine)
+            timings, _ = _time(run, repeat)
+            _record(results, 'shareflows_process', engine, size, timings)
+    return results
+
+
+def measure_memory(sizes, seed=0, image_rate=0.1):
+    """
+    Measure the memory held by the labelled action records and the peak
+    allocation of the end-to-end pipeline with tracemalloc. The synthetic trace
+    itself is not counted.
+
+    Returns:
+    list: One result dictionary per size.
+    """
+    results = []
+    for size in sizes:
+        trace = synthetic_trace(size, seed=seed, image_rate=image_rate)
+
+        tracemalloc.start()
+        actions = process_serialize(LABELLER_ENGINES['trie'](action_mapper(trace)))
+        actions_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del actions
+
+        tracemalloc.start()
+        document = shareflows_process(trace)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del document
+
+        results.append({
+            'events': size,
+            'labelled_actions_bytes': actions_bytes,
+            'labelled_actions_bytes_per_event': actions_bytes / size if size else None,
+            'shareflows_process_peak_bytes': peak_bytes,
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ShareFlow pipeline on synthetic traces.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6],
+                        help="numbers of events to benchmark")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per measurement; the minimum is reported")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic trace generator")
+    parser.add_argument('--engines', nargs='+', default=None,
+                        help="labeller engines to compare (default: all available)")
+    parser.add_argument('--image-rate', type=float, default=0.1,
+                        help="probability that a step carries a screenshot")
+    parser.add_argument('--memory', action='store_true',
+                        help="also measure memory use with tracemalloc (slow)")
+    parser.add_argument('--output', default='-', help="JSON output file ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'image_rate': args.image_rate,
+            'timestamp': int(time.time()),
+        },
+        'results': run_benchmarks(args.sizes, args.repeat, args.seed, args.engines, args.image_rate),
+    }
+    if args.memory:
+        report['memory'] = measure_memory(args.sizes, args.seed, args.image_rate)
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Memoization of generated ShareFlow documents.
+
+ShareFlowCache keeps the 'dc' documents built by shareflows_process keyed by
+the session, the UserEventRecord time range, a fingerprint of the events in
+that range and the process library version, so polling a completed recording does not rerun the pipeline.
+Entries are bounded by count and by (estimated) size with LRU eviction, and are
+dropped when new events land in a cached session range.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+
+def fingerprint_steps(results):
+    """
+    Return a content fingerprint of the events returned by batch_steps.
+
+    Parameters:
+    results (list): Entries with 'steps', as passed to shareflows_process.
+
+    Returns:
+    str: Hex digest that changes whenever any step changes.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for entry in results:
+        for step in entry.get('steps', []):
+            _update(digest, step)
+        digest.update(b'\x1e')
+    return digest.hexdigest()
+
+
+def _update(digest, step):
+    digest.update(json.dumps(step, sort_keys=True, default=str).encode('utf-8'))
+    digest.update(b'\n')
+
+
+class StepFingerprint:
+    """
+    The fingerprint_steps of one entry, computed as its steps are read, so they
+    do not have to be held to be fingerprinted.
+    """
+
+    def __init__(self):
+        self._digest = hashlib.blake2b(digest_size=16)
+
+    def update(self, step):
+        _update(self._digest, step)
+
+    def steps(self, steps):
+        """Yield 'steps', adding each to the fingerprint."""
+        for step in steps:
+            _update(self._digest, step)
+            yield step
+
+    def hexdigest(self):
+        """Return fingerprint_steps([{'steps': <the steps read so far>}])."""
+        digest = self._digest.copy()
+        digest.update(b'\x1e')
+        return digest.hexdigest()
+
+
+class ShareFlowCache:
+    """
+    LRU cache of ShareFlow documents.
+
+    Attributes:
+        max_entries (int): Maximum number of cached documents.
+        max_bytes (int): Maximum total size of the cached documents, estimated
+            from their JSON encoding.
+        hits (int): Number of lookups served from the cache.
+        misses (int): Number of lookups that had to run the pipeline.
+        evictions (int): Number of documents evicted to respect the bounds.
+        invalidations (int): Number of documents dropped because new events
+            landed in their session range.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (document, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(record, results, version=None, fingerprint=None):
+        """
+        Build the cache key of 'results' fetched for the UserEventRecord 'record':
+        (session_id, startstamp, endstamp, fingerprint of the events, version).
+        'version' identifies the process library the document was built with.
+        A known 'fingerprint' (e.g. of a materialized document) replaces the one
+        of 'results'.
+        """
+        if fingerprint is None:
+            fingerprint = fingerprint_steps(results)
+        return (record.session_id, record.startstamp, record.endstamp, fingerprint, version)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, document):
+        size = len(json.dumps(document, default=str))
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (document, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def get_or_compute(self, record, results, compute, version=None):
+        """
+        Return the cached document for 'results', computing it with
+        compute(results) and caching it on a miss. Documents built with a
+        different 'version' of the process library are not reused.
+        """
+        key = self.key(record, results, version)
+        document = self.get(key)
+        if document is None:
+            document = compute(results)
+            if document is not None:
+                self.put(key, document)
+        return document
+
+    def invalidate(self, session_id, timestamp=None, until=None):
+        """
+        Drop the documents of 'session_id' whose range contains 'timestamp', or
+        overlaps 'timestamp'..'until' when both are given (or all documents of
+        the session when no timestamp is given). Call this whenever new events
+        are stored for a session.
+
+        Returns:
+        int: Number of documents dropped.
+        """
+        if until is None:
+            until = timestamp
+        with self._lock:
+            stale = [
+                key for key in self._entries
+                if key[0] == session_id and (timestamp is None or (key[1] <= until and timestamp <= key[2]))
+            ]
+            for key in stale:
+                self._bytes -= self._entries.pop(key)[1]
+            self.invalidations += len(stale)
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Return the cache counters and current occupancy."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+            }
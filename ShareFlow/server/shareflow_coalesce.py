@@ -0,0 +1,267 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Coalescing of keystroke and scroll event runs.
+
+The capture script emits one event per key press and per scroll tick, so
+typing into a field or scrolling a page produces long runs of events mapping to
+the same action ('Type', 'Scroll') on the same target. Coalescing keeps the
+first and last event of every run of at least four such events and replaces the
+events in between by a single summary event carrying:
+
+- 'coalesced': the number of events it stands for,
+- 'endTimestamp': the timestamp of the last of them (its own timestamp is the first),
+- the final text typed,
+- 'extent': the scroll extent [min x, min y, max x, max y] of their offsets.
+
+Why this is label-equivalent: when no process_map pattern contains the action
+twice in a row (see coalescible_actions), a pattern can only enter a run at its
+first event and leave it at its last. Every event strictly inside a run either
+matches a one-action pattern or inherits the previous label, so all of them
+get the same label. Dropping some of them while keeping one leaves the labels
+of the surviving events, and therefore the processes of the ShareFlow,
+unchanged. Only the number of steps listed under a process goes down. Runs are
+never collapsed to a single event: the event inside a run can be labelled
+differently from both ends (e.g. 'SP3.1 Filling information' between a
+'SP3.1e' start and an 'AP2. Search' end).
+"""
+
+from shareflow_process import action_mapping as default_action_mapping
+from shareflow_process import map_action_type
+from shareflow_process import process_map as default_process_map
+
+
+# Actions whose runs are coalesced by default
+COALESCED_ACTIONS = ('Type', 'Scroll')
+
+# Shortest run that is coalesced; shorter runs have nothing inside to merge
+MIN_RUN = 4
+
+# Field names of the two event shapes: steps (as read by shareflows_process)
+# and UserEvent fields (as stored at ingest)
+STEP_FIELDS = {
+    'type': 'type', 'text': 'text', 'url': 'url', 'xpath': 'xpath',
+    'timestamp': 'timestamp', 'x': 'offsetX', 'y': 'offsetY',
+    'coalesced': 'coalesced', 'end': 'endTimestamp', 'extent': 'extent',
+}
+USER_EVENT_FIELDS = {
+    'type': 'event_type', 'text': 'text_content', 'url': 'base_url', 'xpath': 'x_path',
+    'timestamp': 'timestamp', 'x': 'offset_x', 'y': 'offset_y',
+    'coalesced': 'coalesced', 'end': 'end_timestamp', 'extent': 'extent',
+}
+
+
+def coalescible_actions(process_map=None, actions=COALESCED_ACTIONS):
+    """
+    Return the actions of 'actions' whose runs can be coalesced without
+    changing labels: those no pattern of 'process_map' contains twice in a row.
+    """
+    if process_map is None:
+        process_map = default_process_map
+    repeated = set()
+    for pattern in process_map.values():
+        for previous, current in zip(pattern, pattern[1:]):
+            if previous == current:
+                repeated.add(current)
+    return tuple(action for action in actions if action not in repeated)
+
+
+class _Summary:
+    """Accumulates the summary event of the events inside a run, one event at a time."""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.first = None
+        self.last = None
+        self.coalesced = 0
+        # [min x, min y, max x, max y] of the offsets and extents seen
+        self.bounds = [None, None, None, None]
+
+    def add(self, event):
+        fields = self.fields
+        if self.first is None:
+            self.first = event
+        self.last = event
+        self.coalesced += event.get(fields['coalesced']) or 1
+        xs = [event.get(fields['x'])] if event.get(fields['x']) is not None else []
+        ys = [event.get(fields['y'])] if event.get(fields['y']) is not None else []
+        extent = event.get(fields['extent'])
+        if extent:
+            xs += [extent[0], extent[2]]
+            ys += [extent[1], extent[3]]
+        bounds = self.bounds
+        for values, low, high in ((xs, 0, 2), (ys, 1, 3)):
+            if values:
+                bounds[low] = min(values) if bounds[low] is None else min(bounds[low], *values)
+                bounds[high] = max(values) if bounds[high] is None else max(bounds[high], *values)
+
+    def event(self):
+        fields = self.fields
+        # The last event keeps a (type, text) pair of the run, so the summary maps
+        # to the same action
+        summary = dict(self.last)
+        summary[fields['timestamp']] = self.first.get(fields['timestamp'])
+        summary[fields['coalesced']] = self.coalesced
+        summary[fields['end']] = self.last.get(fields['end']) or self.last.get(fields['timestamp'])
+        if None not in self.bounds:
+            summary[fields['extent']] = list(self.bounds)
+        return summary
+
+
+def _summarize(run, fields):
+    summary = _Summary(fields)
+    for event in run:
+        summary.add(event)
+    return summary.event()
+
+
+class _Run:
+    """
+    A run being read. Its events are kept until it is long enough to be
+    coalesced; from then on only its first event, the summary of the events
+    after it and its latest event are.
+    """
+
+    def __init__(self, event, fields, min_run):
+        self.fields = fields
+        self.min_run = min_run
+        self.events = [event]
+        self.first = self.summary = self.latest = None
+
+    def add(self, event):
+        if self.events is None:
+            self.summary.add(self.latest)
+            self.latest = event
+            return
+        self.events.append(event)
+        if len(self.events) == self.min_run:
+            self.first, self.latest = self.events[0], self.events[-1]
+            self.summary = _Summary(self.fields)
+            for inside in self.events[1:-1]:
+                self.summary.add(inside)
+            self.events = None
+
+    def flush(self):
+        if self.events is not None:
+            return self.events
+        return [self.first, self.summary.event(), self.latest]
+
+
+def coalesce(events, fields=STEP_FIELDS, mapping=None, process_map=None, actions=COALESCED_ACTIONS,
+             min_run=MIN_RUN):
+    """
+    Coalesce the runs of 'events' (in time order, one session) that map to the
+    same coalescible action on the same target (url and xpath).
+
+    Parameters:
+    events (list): Event dictionaries.
+    fields (dict): Field names of the event shape (STEP_FIELDS or USER_EVENT_FIELDS).
+    mapping (dict): Action mapping (defaults to the module action_mapping).
+    process_map (dict): Process map the result must stay label-equivalent for
+        (defaults to the module process_map).
+    actions (tuple): Actions whose runs may be coalesced.
+    min_run (int): Shortest run coalesced (at least 4).
+
+    Returns:
+    list: The events, with each run of 'min_run' or more events replaced by its
+    first event, a summary event and its last event. Input events are not modified.
+    """
+    return list(iter_coalesce(events, fields, mapping, process_map, actions, min_run))
+
+
+def iter_coalesce(events, fields=STEP_FIELDS, mapping=None, process_map=None, actions=COALESCED_ACTIONS,
+                  min_run=MIN_RUN):
+    """
+    Iterator version of coalesce: 'events' may be an iterator, and is read as
+    the result is. A run being coalesced holds three events in memory
+    whatever its length.
+    """
+    if min_run < MIN_RUN:
+        raise ValueError("Runs shorter than %d cannot be coalesced" % MIN_RUN)
+    if mapping is None:
+        mapping = default_action_mapping
+    allowed = set(coalescible_actions(process_map, actions))
+    if not allowed:
+        return iter(events)
+    return _coalesce(events, fields, mapping, allowed, min_run)
+
+
+def _coalesce(events, fields, mapping, allowed, min_run):
+    type_field, text_field = fields['type'], fields['text']
+    url_field, xpath_field = fields['url'], fields['xpath']
+
+    run = None
+    run_key = None
+    for event in events:
+        action = map_action_type(event.get(type_field, 'No type'), event.get(text_field, ''), mapping)
+        key = (action, event.get(url_field), event.get(xpath_field)) if action in allowed else None
+        if key is not None and key == run_key:
+            run.add(event)
+            continue
+        if run is not None:
+            yield from run.flush()
+        run = _Run(event, fields, min_run)
+        run_key = key
+    if run is not None:
+        yield from run.flush()
+
+
+def coalesce_steps(share_flow_data, mapping=None, process_map=None, actions=COALESCED_ACTIONS, min_run=MIN_RUN):
+    """
+    Return a copy of 'share_flow_data' (entries with 'steps', as taken by
+    shareflows_process) with the step runs of every entry coalesced.
+    """
+    return [
+        {**entry, 'steps': coalesce(entry.get('steps', []), STEP_FIELDS, mapping, process_map, actions, min_run)}
+        for entry in share_flow_data
+    ]
+
+
+def iter_coalesce_steps(share_flow_data, mapping=None, process_map=None, actions=COALESCED_ACTIONS,
+                        min_run=MIN_RUN):
+    """
+    Iterator version of coalesce_steps: entries are read as they are needed,
+    and their 'steps' are iterators coalescing the steps as they are read.
+    """
+    for entry in share_flow_data:
+        yield {**entry, 'steps': iter_coalesce(entry.get('steps', []), STEP_FIELDS, mapping, process_map, actions,
+                                               min_run)}
+
+
+def coalesce_user_events(events, mapping=None, process_map=None, actions=COALESCED_ACTIONS, min_run=MIN_RUN):
+    """
+    Coalesce UserEvent dictionaries of any number of sessions, e.g. one bulk
+    ingest request. Events are grouped by session and user and ordered by
+    timestamp; the result keeps that order.
+    """
+    sessions = {}
+    for event in events:
+        sessions.setdefault((event.get('session_id'), event.get('userid')), []).append(event)
+    result = []
+    for session_events in sessions.values():
+        session_events.sort(key=lambda event: event.get('timestamp') or 0)
+        result.extend(coalesce(session_events, USER_EVENT_FIELDS, mapping, process_map, actions, min_run))
+    return result
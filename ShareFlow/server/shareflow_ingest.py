@@ -0,0 +1,488 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Bulk ingestion of TraceData messages.
+
+userTraceCapture.ts sends one TraceData message per UI event. BulkIngester
+accepts many of them at once, as a JSON array or as NDJSON (one message per
+line), validates each against the UserEvent fields and writes the valid ones
+to the event store in batches. A writer thread stores one batch while the next
+is being validated, so parsing and writes overlap.
+
+Every event gets an idempotency key: the message's 'eventId' when present,
+otherwise a digest of its session, user, timestamp, type, target and position.
+Stores skip (SQLite) or overwrite (Redis) events whose key is already stored,
+so a client can safely retry a request. Invalid messages are reported by
+position and do not reject the rest of the request.
+
+The load-test harness replays synthetic traces against the SQLite stand-in:
+
+    python shareflow_ingest.py --events 200000 --batch-size 1000 --clients 4
+"""
+
+import argparse
+import hashlib
+import json
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+# TraceData message keys (camelCase, as sent by userTraceCapture.ts) mapped to
+# UserEvent fields; UserEvent field names are accepted as well
+TRACE_FIELDS = {
+    'type': 'event_type',
+    'timestamp': 'timestamp',
+    'tagName': 'tag_name',
+    'textContent': 'text_content',
+    'baseURL': 'base_url',
+    'url': 'base_url',
+    'userid': 'userid',
+    'ipAddress': 'ip_address',
+    'interactionContext': 'interaction_context',
+    'eventSource': 'event_source',
+    'systemTime': 'system_time',
+    'xpath': 'x_path',
+    'offsetX': 'offset_x',
+    'offsetY': 'offset_y',
+    'clientX': 'offset_x',
+    'clientY': 'offset_y',
+    'docId': 'doc_id',
+    'region': 'region',
+    'sessionId': 'session_id',
+    'taskName': 'task_name',
+    'width': 'width',
+    'height': 'height',
+    'image': 'image',
+    'title': 'title',
+}
+
+# Every accepted message key, including the UserEvent field names themselves
+FIELD_ALIASES = {**{field: field for field in TRACE_FIELDS.values()}, **TRACE_FIELDS}
+
+REQUIRED_FIELDS = ('event_type', 'timestamp', 'userid', 'session_id')
+
+STRING_FIELDS = (
+    'event_type', 'tag_name', 'text_content', 'base_url', 'userid', 'ip_address',
+    'interaction_context', 'event_source', 'x_path', 'doc_id', 'region',
+    'session_id', 'task_name', 'image', 'title',
+)
+FLOAT_FIELDS = ('offset_x', 'offset_y')
+INT_FIELDS = ('timestamp', 'width', 'height')
+
+_STRING_FIELDS = frozenset(STRING_FIELDS)
+_NUMBER_FIELDS = {**{field: int for field in INT_FIELDS}, **{field: float for field in FLOAT_FIELDS}}
+
+# Fields identifying an event when the client sends no 'eventId'
+KEY_FIELDS = ('session_id', 'userid', 'timestamp', 'event_type', 'x_path', 'text_content', 'offset_x', 'offset_y')
+
+MAX_REPORTED_ERRORS = 100
+
+
+class EventValidationError(ValueError):
+    """Raised when a TraceData message does not fit the UserEvent schema."""
+
+
+def trace_to_user_event(message, defaults=None, userid=None):
+    """
+    Validate a TraceData message and convert it into a dictionary of UserEvent
+    fields.
+
+    Parameters:
+    message (dict): The TraceData message.
+    defaults (dict): UserEvent fields used when the message does not set them.
+    userid (str): The authenticated user. Events are always stored under it, and
+        a message naming another 'userid' is rejected.
+
+    Returns:
+    dict: The UserEvent fields.
+
+    Raises:
+    EventValidationError: If the message is malformed or misses a required field.
+    """
+    if not isinstance(message, dict):
+        raise EventValidationError('Message is not an object')
+    if message.get('messageType', 'TraceData') != 'TraceData':
+        raise EventValidationError('Unsupported messageType %r' % (message['messageType'],))
+
+    event = dict(defaults) if defaults else {}
+    for name, value in message.items():
+        field = FIELD_ALIASES.get(name)
+        if field is not None and value is not None:
+            event[field] = value
+    if userid is not None:
+        if event.get('userid') not in (None, '', userid):
+            raise EventValidationError('userid does not match the authenticated user')
+        event['userid'] = userid
+
+    for field in REQUIRED_FIELDS:
+        if event.get(field) in (None, ''):
+            raise EventValidationError('Missing %s' % field)
+    for field, value in event.items():
+        if field in _STRING_FIELDS:
+            if not isinstance(value, str):
+                raise EventValidationError('%s must be a string' % field)
+        elif field in _NUMBER_FIELDS:
+            kind = _NUMBER_FIELDS[field]
+            if value.__class__ is not kind:
+                if isinstance(value, bool):
+                    raise EventValidationError('%s must be a number' % field)
+                try:
+                    event[field] = kind(value)
+                except (TypeError, ValueError, OverflowError):
+                    raise EventValidationError('%s must be a number' % field) from None
+    return event
+
+
+def event_key(message, event):
+    """Return the idempotency key of a validated event."""
+    event_id = message.get('eventId') if isinstance(message, dict) else None
+    if event_id:
+        return 'id:%s' % (event_id,)
+    identity = '\x1f'.join([str(event.get(name, '')) for name in KEY_FIELDS])
+    return hashlib.blake2b(identity.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def parse_messages(body, content_type=None):
+    """
+    Yield the messages of a request body: a JSON array (or a single object), or
+    NDJSON when the content type says so or the body is not a JSON array.
+    A line that is not valid JSON yields an EventValidationError in its place.
+    """
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    stripped = body.lstrip()
+    if 'ndjson' not in (content_type or '') and stripped[:1] in ('[', '{'):
+        try:
+            decoded = json.loads(body)
+        except ValueError:
+            decoded = None
+        if isinstance(decoded, list):
+            yield from decoded
+            return
+        if isinstance(decoded, dict):
+            yield decoded
+            return
+    lines = [line for line in body.splitlines() if line.strip()]
+    try:
+        # Decoding all lines as one array is much faster than line by line
+        decoded = json.loads('[' + ','.join(lines) + ']')
+    except ValueError:
+        decoded = None
+    if decoded is not None and len(decoded) == len(lines):
+        yield from decoded
+        return
+    for line in lines:
+        try:
+            yield json.loads(line)
+        except ValueError as exc:
+            yield EventValidationError('Invalid JSON: %s' % (exc,))
+
+
+class BulkIngester:
+    """
+    Validates TraceData messages and writes them to an event store in batches.
+
+    Attributes:
+        store: Event store with add(events, keys) (see event_store).
+        cache (ShareFlowCache): Optional cache whose documents are invalidated
+            for the session ranges that received events.
+        documents: Optional materialized document store whose documents are
+            dropped for sessions that received events.
+        index (SearchIndex): Optional search index whose ShareFlow processes
+            are dropped for sessions that received events.
+        live (LiveShareFlows): Optional registry of live ShareFlows, dropped when
+            events arrive before what they already read.
+        batch_size (int): Number of events per store write.
+        coalesce (dict or callable): When set, runs of keystroke and scroll
+            events in a request are coalesced before they are stored; the dict
+            holds the keyword arguments of shareflow_coalesce.coalesce_user_events
+            (mapping, process_map, ...), {} for the defaults. A callable is
+            called with each task name of a request and returns that dict, so
+            the process library can be resolved when the events arrive.
+    """
+
+    def __init__(self, store, cache=None, documents=None, batch_size=1000, coalesce=None, index=None, live=None):
+        self.store = store
+        self.cache = cache
+        self.documents = documents
+        self.index = index
+        self.live = live
+        self.batch_size = batch_size
+        self.coalesce = coalesce
+
+    def _validate(self, messages, defaults, userid, summary):
+        seen = set()
+        for index, message in enumerate(messages):
+            summary['received'] += 1
+            try:
+                if isinstance(message, Exception):
+                    raise message
+                event = trace_to_user_event(message, defaults, userid)
+            except EventValidationError as exc:
+                summary['rejected'] += 1
+                if len(summary['errors']) < MAX_REPORTED_ERRORS:
+                    summary['errors'].append({'index': index, 'error': str(exc)})
+                continue
+
+            key = event_key(message, event)
+            if key in seen:
+                summary['duplicates'] += 1
+                continue
+            seen.add(key)
+            summary['accepted'] += 1
+            yield key, event
+
+    def _coalesced(self, pairs, summary):
+        from shareflow_coalesce import coalesce_user_events
+
+        pairs = list(pairs)
+        keys = {id(event): key for key, event in pairs}
+        if callable(self.coalesce):
+            tasks = {}
+            for _, event in pairs:
+                tasks.setdefault(event.get('task_name'), []).append(event)
+            events = []
+            for task_name, task_events in tasks.items():
+                events.extend(coalesce_user_events(task_events, **self.coalesce(task_name)))
+        else:
+            events = coalesce_user_events([event for _, event in pairs], **self.coalesce)
+        summary['coalesced'] = len(pairs) - len(events)
+        for event in events:
+            key = keys.get(id(event))
+            # Summary events are derived deterministically, so retries
+            # produce the same key
+            yield key if key is not None else 'coalesced:' + event_key({}, event), event
+
+    def ingest(self, messages, defaults=None, userid=None):
+        """
+        Validate and store 'messages', as the authenticated 'userid' when given
+        (see trace_to_user_event).
+
+        Returns:
+        dict: 'received', 'accepted' (valid events), 'stored' (events written,
+        where the store can tell), 'duplicates' (repeated keys in the request),
+        'rejected', the first 'errors' ({'index', 'error'}) and, when
+        coalescing, 'coalesced' (events merged into run summaries).
+        """
+        summary = {'received': 0, 'accepted': 0, 'stored': 0, 'duplicates': 0, 'rejected': 0, 'errors': []}
+        sessions = {}   # session_id -> [min timestamp, max timestamp]
+        batch, keys = [], []
+
+        pairs = self._validate(messages, defaults, userid, summary)
+        if self.coalesce is not None:
+            pairs = self._coalesced(pairs, summary)
+
+        writes = queue.Queue(maxsize=2)
+        failure = []
+
+        def write():
+            while True:
+                item = writes.get()
+                if item is None:
+                    return
+                if failure:
+                    continue
+                try:
+                    written = self.store.add(*item)
+                    summary['stored'] += written if written is not None else len(item[0])
+                except Exception as exc:
+                    failure.append(exc)
+
+        writer = threading.Thread(target=write, name='shareflow-ingest-writer', daemon=True)
+        writer.start()
+        try:
+            try:
+                for key, event in pairs:
+                    batch.append(event)
+                    keys.append(key)
+
+                    span = sessions.get(event['session_id'])
+                    if span is None:
+                        sessions[event['session_id']] = [event['timestamp'], event['timestamp']]
+                    elif event['timestamp'] < span[0]:
+                        span[0] = event['timestamp']
+                    elif event['timestamp'] > span[1]:
+                        span[1] = event['timestamp']
+
+                    if len(batch) >= self.batch_size:
+                        writes.put((batch, keys))
+                        batch, keys = [], []
+                        if failure:
+                            break
+                if batch and not failure:
+                    writes.put((batch, keys))
+            finally:
+                writes.put(None)
+                writer.join()
+            if failure:
+                raise failure[0]
+        finally:
+            # The batches written before a failure make their sessions stale too
+            self._invalidate(sessions)
+        return summary
+
+    def _invalidate(self, sessions):
+        for session_id, (first, last) in sessions.items():
+            if self.cache is not None:
+                self.cache.invalidate(session_id, first, last)
+            if self.documents is not None:
+                self.documents.delete_session(session_id)
+            if self.index is not None:
+                self.index.remove_shareflows(session_id)
+            if self.live is not None:
+                self.live.invalidate(session_id, first)
+
+
+class IdempotentResponses:
+    """
+    Remembers the summary returned for recent request-level idempotency keys
+    (the Idempotency-Key header), so a retried request gets the same answer.
+    Keys are scoped to the user who sent them, so a user cannot read back the
+    summary of another user's request.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, userid, key):
+        with self._lock:
+            summary = self._entries.get((userid, key))
+            if summary is not None:
+                self._entries.move_to_end((userid, key))
+            return summary
+
+    def put(self, userid, key, summary):
+        with self._lock:
+            self._entries[(userid, key)] = summary
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def synthetic_messages(events, seed=0, sessions=8):
+    """Generate TraceData messages for the load test from synthetic traces."""
+    from shareflow_benchmark import synthetic_trace
+
+    targets = {'scroll': '/html/body', 'keydown': '/html/body/form/input', 'keyup': '/html/body/form/input'}
+    messages = []
+    for entry in synthetic_trace(events, seed=seed, sessions=sessions, image_rate=0):
+        for i, step in enumerate(entry['steps']):
+            messages.append({
+                'messageType': 'TraceData',
+                'type': step['type'],
+                'timestamp': 1700000000000 + i * 50,
+                'tagName': 'BUTTON' if step['type'] == 'click' else '',
+                'textContent': step['text'],
+                'baseURL': step['url'],
+                'interactionContext': '',
+                'xpath': targets.get(step['type'], '/html/body/div[%d]' % (i % 40)),
+                'eventSource': 'MOUSE',
+                'clientX': step['offsetX'],
+                'clientY': step['offsetY'],
+                'width': step['width'],
+                'height': step['height'],
+                'title': step['title'],
+                'userid': entry['userid'],
+                'sessionId': entry['sessionId'],
+                'taskName': entry['taskName'],
+            })
+    return messages
+
+
+def load_test(events=100000, batch_size=1000, request_size=5000, clients=4, seed=0, retry_rate=0.1):
+    """
+    Post synthetic NDJSON requests from 'clients' threads to a BulkIngester
+    backed by an in-memory SQLiteEventStore, re-sending a fraction of the
+    requests to exercise idempotency.
+
+    Returns:
+    dict: Event counts, elapsed seconds and sustained events per second.
+    """
+    from event_store import SQLiteEventStore
+
+    store = SQLiteEventStore()
+    ingester = BulkIngester(store, batch_size=batch_size)
+    messages = synthetic_messages(events, seed)
+    bodies = [
+        '\n'.join(json.dumps(message) for message in messages[i:i + request_size])
+        for i in range(0, len(messages), request_size)
+    ]
+    retries = bodies[:int(len(bodies) * retry_rate)]
+    requests = queue.Queue()
+    for body in bodies + retries:
+        requests.put(body)
+
+    totals = {'received': 0, 'accepted': 0, 'stored': 0, 'rejected': 0}
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            try:
+                body = requests.get_nowait()
+            except queue.Empty:
+                return
+            summary = ingester.ingest(parse_messages(body, 'application/x-ndjson'))
+            with lock:
+                for name in totals:
+                    totals[name] += summary[name]
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        **totals,
+        'requests': len(bodies) + len(retries),
+        'stored_total': store.count(),
+        'seconds': elapsed,
+        'events_per_second': totals['received'] / elapsed if elapsed else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test bulk TraceData ingestion against a local store.")
+    parser.add_argument('--events', type=int, default=100000, help="number of distinct events")
+    parser.add_argument('--batch-size', type=int, default=1000, help="events per store write")
+    parser.add_argument('--request-size', type=int, default=5000, help="events per bulk request")
+    parser.add_argument('--clients', type=int, default=4, help="concurrent client threads")
+    parser.add_argument('--retry-rate', type=float, default=0.1, help="fraction of requests sent twice")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic trace generator")
+    args = parser.parse_args(argv)
+    report = load_test(args.events, args.batch_size, args.request_size, args.clients, args.seed, args.retry_rate)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Background generation of ShareFlows.
+
+ShareFlowJobQueue runs ShareFlow generation on a bounded pool of worker threads
+so request threads only enqueue work and return a job handle. Requests for the
+same key (recording, events and library version) while a job is queued, running
+or recently finished share that job. The queue holds at most 'max_pending'
+jobs; submitting to a full queue raises JobQueueFull so callers can shed load.
+A job running longer than its timeout is reported as timed out; Python threads
+cannot be interrupted, so the worker finishes the call and its result is
+discarded.
+"""
+
+import itertools
+import queue
+import threading
+import time
+import uuid
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+TIMEOUT = 'timeout'
+
+FINISHED_STATES = (DONE, FAILED, TIMEOUT)
+
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted to a full queue."""
+
+
+class ShareFlowJob:
+    """
+    A queued ShareFlow generation.
+
+    Attributes:
+        id (str): Job handle returned to clients.
+        key: De-duplication key.
+        records (list): The recordings the job was submitted for, so whoever
+            polls it can be checked against them.
+        timeout (float): Seconds the job may run before it is reported as timed out.
+        result: Return value of the job once done.
+        error (str): Error message of a failed or timed-out job.
+        created (float): Submission time (time.time()).
+        started (float): Start time, or None while queued.
+        finished (float): Completion time, or None while unfinished.
+    """
+
+    def __init__(self, key, func, args, timeout):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.records = []
+        self.timeout = timeout
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._func = func
+        self._args = args
+        self._state = QUEUED
+        self._deadline = None
+        self._done = threading.Event()
+        # Guards the state transitions, so a timeout and a completion cannot both happen
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == RUNNING and self._deadline is not None and time.monotonic() > self._deadline:
+                self._expire()
+            return self._state
+
+    def _expire(self):
+        # Called with the lock held
+        self._state = TIMEOUT
+        self.error = 'Job exceeded its %gs timeout' % (self.timeout,)
+        self.finished = time.time()
+        self._done.set()
+
+    def run(self):
+        with self._lock:
+            if self._state != QUEUED:
+                return
+            self.started = time.time()
+            if self.timeout is not None:
+                self._deadline = time.monotonic() + self.timeout
+            self._state = RUNNING
+        try:
+            result = self._func(*self._args)
+        except Exception as exc:
+            self._finish(FAILED, error='%s: %s' % (type(exc).__name__, exc))
+        else:
+            self._finish(DONE, result=result)
+        finally:
+            self._func = self._args = None
+
+    def _finish(self, state, result=None, error=None):
+        with self._lock:
+            if self._state != RUNNING:
+                return
+            if self._deadline is not None and time.monotonic() > self._deadline:
+                self._expire()
+                return
+            self.result = result
+            self.error = error
+            self._state = state
+            self.finished = time.time()
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait up to 'timeout' seconds for the job to finish (or to exceed its own
+        timeout).
+
+        Returns:
+        bool: True if the job has finished.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        while self.state not in FINISHED_STATES:
+            now = time.monotonic()
+            if end is not None and now >= end:
+                return False
+            # Wake up at the job deadline to report the timeout; before the job
+            # starts its deadline is unknown, so check back periodically.
+            limits = [t - now for t in (end, self._deadline) if t is not None]
+            if self._deadline is None:
+                limits.append(0.5)
+            self._done.wait(max(min(limits), 0))
+        return True
+
+    def to_dict(self):
+        """Return the job status, without the result."""
+        return {
+            'job': self.id,
+            'status': self.state,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class ShareFlowJobQueue:
+    """
+    Bounded background queue of ShareFlow jobs.
+
+    Attributes:
+        workers (int): Number of worker threads.
+        max_pending (int): Maximum number of queued (not yet running) jobs.
+        timeout (float): Default per-job timeout in seconds (None for no timeout).
+        retain (float): Seconds finished jobs stay available for polling.
+        submitted (int): Number of jobs created.
+        deduplicated (int): Number of submissions served by an existing job.
+        rejected (int): Number of submissions refused because the queue was full.
+    """
+
+    def __init__(self, workers=4, max_pending=64, timeout=120.0, retain=300.0):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.retain = retain
+        self.submitted = 0
+        self.deduplicated = 0
+        self.rejected = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._jobs = {}   # id -> job
+        self._keys = {}   # key -> job
+        self._lock = threading.Lock()
+        self._threads = []
+        self._names = itertools.count()
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name='shareflow-job-%d' % next(self._names),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job.run()
+            finally:
+                self._queue.task_done()
+
+    def _prune(self):
+        horizon = time.time() - self.retain
+        for job in list(self._jobs.values()):
+            if job.state in FINISHED_STATES and job.finished < horizon:
+                del self._jobs[job.id]
+                if self._keys.get(job.key) is job:
+                    del self._keys[job.key]
+
+    def submit(self, key, func, *args, timeout=None, record=None):
+        """
+        Return the job for 'key', enqueuing func(*args) unless a job for the same
+        key is unfinished or finished successfully within 'retain' seconds.
+        'record' is added to the records of the job.
+
+        Raises:
+        JobQueueFull: If 'max_pending' jobs are already queued.
+        """
+        with self._lock:
+            self._prune()
+            job = self._keys.get(key)
+            if job is not None and job.state in (QUEUED, RUNNING, DONE):
+                self.deduplicated += 1
+                if record is not None and record not in job.records:
+                    job.records.append(record)
+                return job
+
+            job = ShareFlowJob(key, func, args, self.timeout if timeout is None else timeout)
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self.rejected += 1
+                raise JobQueueFull('%d ShareFlow jobs are already queued' % self.max_pending) from None
+            if record is not None:
+                job.records.append(record)
+            self._jobs[job.id] = job
+            self._keys[key] = job
+            self.submitted += 1
+            self._start_workers()
+            return job
+
+    def get(self, job_id):
+        """
+        Return the job with handle 'job_id'.
+
+        Raises:
+        KeyError: If the job is unknown or has expired.
+        """
+        with self._lock:
+            self._prune()
+            return self._jobs[job_id]
+
+    def stats(self):
+        """Return the queue counters and current occupancy."""
+        with self._lock:
+            states = [job.state for job in self._jobs.values()]
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'queued': states.count(QUEUED),
+                'running': states.count(RUNNING),
+                'finished': sum(state in FINISHED_STATES for state in states),
+                'submitted': self.submitted,
+                'deduplicated': self.deduplicated,
+                'rejected': self.rejected,
+            }
@@ -0,0 +1,178 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+ShareFlows of live recordings, updated incrementally between reads.
+
+A recording that is still running is read again and again while it grows.
+LiveShareFlow keeps, for one recording, the steps read so far, their
+fingerprint (see shareflow_cache.StepFingerprint) and an IncrementalShareFlow
+fed with them, together with the event store cursor after the last step. Each
+read only fetches and labels the events stored after that cursor, so its cost
+depends on the new events, not on the length of the session. The document and
+fingerprint are those shareflows_process and fingerprint_steps give for all
+the steps.
+
+LiveShareFlows holds the LiveShareFlow of recent live recordings, keyed by
+session, user, start of the recording and process library version. Events
+stored with a timestamp before the cursor of a LiveShareFlow would be missed,
+so code that stores events must call invalidate() (BulkIngester does).
+"""
+
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+
+from event_store import iter_record_pages
+from shareflow_cache import StepFingerprint
+from shareflow_stream import IncrementalShareFlow
+
+
+class StepsView(Sequence):
+    """The first 'length' items of the list 'steps', which may grow afterwards."""
+
+    def __init__(self, steps, length):
+        self._steps = steps
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._steps[i] for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("StepsView index out of range")
+        return self._steps[index]
+
+
+class LiveShareFlow:
+    """
+    The steps, fingerprint and incremental ShareFlow of one live recording.
+    Reads of the same recording are serialized by 'lock'.
+
+    Attributes:
+        steps (list): Steps read so far, in timestamp order.
+        fingerprint (StepFingerprint): Fingerprint of 'steps'.
+        cursor: Event store cursor after the last step read.
+    """
+
+    def __init__(self, library):
+        self.lock = threading.Lock()
+        self.steps = []
+        self.fingerprint = StepFingerprint()
+        self.cursor = None
+        self._processor = IncrementalShareFlow(library.process_map, library.action_mapping, flags=False)
+
+    def poll(self, store, record, page_size=500, screenshots=None):
+        """
+        Read the steps of 'record' stored since the previous poll, and return
+        how many there were. Call with 'lock' held.
+        """
+        new = 0
+        for steps, cursor in iter_record_pages(store, record, page_size, screenshots, self.cursor, resume=True):
+            self.cursor = cursor
+            if not steps:
+                continue
+            for step in steps:
+                self.fingerprint.update(step)
+            self.steps.extend(steps)
+            self._processor.update(({
+                'taskName': record.task_name,
+                'userid': record.userid,
+                'sessionId': record.session_id,
+                'steps': steps,
+            },))
+            new += len(steps)
+        return new
+
+    def read_until(self):
+        """Timestamp of the last step read, or None."""
+        return self.steps[-1].get('timestamp') if self.steps else None
+
+    def document(self):
+        """Return the ShareFlow document of the steps read so far (see IncrementalShareFlow.document)."""
+        return self._processor.document()
+
+    def snapshot(self):
+        """Return the steps read so far, as a view that later polls do not extend."""
+        return StepsView(self.steps, len(self.steps))
+
+
+class LiveShareFlows:
+    """
+    LRU registry of the LiveShareFlow of live recordings.
+
+    Attributes:
+        max_entries (int): Most recordings kept; the least recently read are dropped.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(record, library):
+        return (record.session_id, record.userid, record.startstamp, library.tag)
+
+    def get(self, record, library):
+        """Return the LiveShareFlow of 'record' built with 'library', creating it if needed."""
+        key = self.key(record, library)
+        with self._lock:
+            live = self._entries.get(key)
+            if live is None or (live.read_until() is not None and live.read_until() > record.endstamp):
+                # New, or the recording range no longer holds the steps read
+                live = self._entries[key] = LiveShareFlow(library)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return live
+
+    def invalidate(self, session_id, timestamp=None):
+        """
+        Drop the LiveShareFlows of 'session_id' that already read past
+        'timestamp', the earliest timestamp of events just stored (all of them
+        when no timestamp is given): those events come before their cursor and
+        would not be read.
+
+        Returns:
+        int: Number of LiveShareFlows dropped.
+        """
+        with self._lock:
+            stale = [
+                key for key, live in self._entries.items()
+                if key[0] == session_id and (
+                    timestamp is None or (live.read_until() is not None and timestamp < live.read_until()))
+            ]
+            for key in stale:
+                del self._entries[key]
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,273 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Materialization of ShareFlows for completed recordings.
+
+When a UserEventRecord is completed its events no longer change, so its
+ShareFlow is generated once by materialize_record and stored with the tag of
+the process library it was built with, together with the steps of the
+recording. Reads serve the stored document and steps with a single lookup,
+without paging through the events. A stored document whose tag differs from the current library is
+stale and is regenerated by the next materialization or by a backfill:
+
+    python shareflow_materialize.py backfill [--since <ms>] [--force]
+
+Two document stores share the same interface:
+
+- RedisDocumentStore keeps ShareFlowDocument models through Redis OM.
+- SQLiteDocumentStore is an in-memory (or file) stand-in.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from event_store import iter_record_steps
+from shareflow_cache import fingerprint_steps
+from shareflow_process import shareflows_process
+
+
+log = logging.getLogger('shareflow.materialize')
+
+
+def record_id(record):
+    """Return the identifier documents are stored under for 'record'."""
+    pk = getattr(record, 'pk', None)
+    if pk:
+        return pk
+    return '%s:%s:%s' % (record.session_id, record.startstamp, record.endstamp)
+
+
+def record_entries(record, steps):
+    """Return the entries shareflows_process takes for the steps of 'record'."""
+    return [{
+        'taskName': record.task_name,
+        'userid': record.userid,
+        'sessionId': record.session_id,
+        'steps': steps,
+    }]
+
+
+class RedisDocumentStore:
+    """Document store backed by the ShareFlowDocument Redis OM model."""
+
+    def get(self, rid):
+        """
+        Return (version, fingerprint, document, steps) stored for record 'rid',
+        or None. 'steps' is None for documents stored without them.
+        """
+        from data_models import ShareFlowDocument
+
+        found = ShareFlowDocument.find(ShareFlowDocument.record_id == rid).page(offset=0, limit=1)
+        if not found:
+            return None
+        steps = found[0].steps
+        return (found[0].version, found[0].fingerprint, json.loads(found[0].document),
+                json.loads(steps) if steps is not None else None)
+
+    def put(self, rid, session_id, version, fingerprint, document, steps=None):
+        from data_models import ShareFlowDocument
+
+        for stale in ShareFlowDocument.find(ShareFlowDocument.record_id == rid).all():
+            ShareFlowDocument.delete(stale.pk)
+        ShareFlowDocument(
+            record_id=rid,
+            session_id=session_id,
+            version=version,
+            fingerprint=fingerprint,
+            document=json.dumps(document),
+            steps=json.dumps(steps) if steps is not None else None,
+            created=int(time.time() * 1000),
+        ).save()
+
+    def delete_session(self, session_id):
+        """Drop the documents of 'session_id'. Returns the number dropped."""
+        from data_models import ShareFlowDocument
+
+        stale = ShareFlowDocument.find(ShareFlowDocument.session_id == session_id).all()
+        for document in stale:
+            ShareFlowDocument.delete(document.pk)
+        return len(stale)
+
+
+class SQLiteDocumentStore:
+    """SQLite stand-in for the ShareFlowDocument store."""
+
+    def __init__(self, path=':memory:'):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS shareflow_document ('
+                ' record_id TEXT PRIMARY KEY,'
+                ' session_id TEXT,'
+                ' version TEXT,'
+                ' fingerprint TEXT,'
+                ' document TEXT,'
+                ' created INTEGER,'
+                ' steps TEXT)'
+            )
+            columns = [row[1] for row in self._connection.execute('PRAGMA table_info(shareflow_document)')]
+            if 'steps' not in columns:
+                # Stores created before the steps were kept with the documents
+                self._connection.execute('ALTER TABLE shareflow_document ADD COLUMN steps TEXT')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS shareflow_document_session'
+                ' ON shareflow_document (session_id)'
+            )
+
+    def get(self, rid):
+        """
+        Return (version, fingerprint, document, steps) stored for record 'rid',
+        or None. 'steps' is None for documents stored without them.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT version, fingerprint, document, steps FROM shareflow_document WHERE record_id = ?',
+                (rid,),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2]), json.loads(row[3]) if row[3] is not None else None
+
+    def put(self, rid, session_id, version, fingerprint, document, steps=None):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO shareflow_document'
+                ' (record_id, session_id, version, fingerprint, document, created, steps)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (rid, session_id, version, fingerprint, json.dumps(document), int(time.time() * 1000),
+                 json.dumps(steps) if steps is not None else None),
+            )
+
+    def delete_session(self, session_id):
+        """Drop the documents of 'session_id'. Returns the number dropped."""
+        with self._lock, self._connection:
+            return self._connection.execute(
+                'DELETE FROM shareflow_document WHERE session_id = ?', (session_id,),
+            ).rowcount
+
+
+def stored_document(record, documents, version):
+    """
+    Return the stored ShareFlow of 'record' if it was built with 'version',
+    else None.
+    """
+    stored = documents.get(record_id(record))
+    if stored is None or stored[0] != version:
+        return None
+    return stored[2]
+
+
+def materialize_record(record, events, documents, libraries, screenshots=None, force=False, page_size=500):
+    """
+    Generate and store the ShareFlow of a completed recording.
+
+    Parameters:
+    record (UserEventRecord): The recording.
+    events: Event store the steps are read from (see event_store).
+    documents: Document store the ShareFlow is written to.
+    libraries (ProcessLibraryRegistry): Registry resolving the record's process library.
+    screenshots (ScreenshotStore): Optional store for the record's screenshots.
+    force (bool): Regenerate even if an up-to-date document is stored.
+
+    Returns:
+    str: 'current' if an up-to-date document was already stored, 'stored' if
+    one was generated, or 'empty' if the recording has no events.
+    """
+    library = libraries.resolve(record.groupid, record.task_name)
+    if not force and stored_document(record, documents, library.tag) is not None:
+        return 'current'
+    steps = list(iter_record_steps(events, record, page_size, screenshots))
+    if not steps:
+        return 'empty'
+    entries = record_entries(record, steps)
+    document = shareflows_process(entries, library=library)
+    # The steps are stored too, so that reads do not page through the events
+    documents.put(record_id(record), record.session_id, library.tag, fingerprint_steps(entries), document, steps)
+    return 'stored'
+
+
+def backfill(records, events, documents, libraries, screenshots=None, force=False, page_size=500):
+    """
+    Materialize the ShareFlows of completed 'records' whose stored document is
+    missing or built with another process library version.
+
+    Returns:
+    dict: Number of records per materialize_record outcome, plus 'failed'.
+    """
+    counts = {'current': 0, 'stored': 0, 'empty': 0, 'failed': 0}
+    for record in records:
+        if not getattr(record, 'completed', None):
+            continue
+        try:
+            outcome = materialize_record(record, events, documents, libraries, screenshots, force, page_size)
+        except Exception:
+            log.exception("Could not materialize the ShareFlow of %s", record_id(record))
+            outcome = 'failed'
+        counts[outcome] += 1
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Materialize the ShareFlows of completed recordings.")
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    command = subcommands.add_parser('backfill', help="generate missing or outdated stored ShareFlows")
+    command.add_argument('--since', type=int, default=0,
+                         help="only recordings completed at or after this timestamp (ms)")
+    command.add_argument('--force', action='store_true',
+                         help="regenerate documents that are already up to date")
+    command.add_argument('--page-size', type=int, default=500, help="events fetched per page")
+    command.add_argument('--libraries', default=None,
+                         help="process library directory (default: SHAREFLOW_PROCESS_LIBRARY_DIR or process_libraries/)")
+    args = parser.parse_args(argv)
+
+    from data_models import UserEventRecord
+    from event_store import RedisEventStore
+    from process_library import ProcessLibraryRegistry
+    from screenshot_store import ScreenshotStore
+
+    library_dir = (args.libraries or os.environ.get('SHAREFLOW_PROCESS_LIBRARY_DIR')
+                   or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'process_libraries'))
+    libraries = ProcessLibraryRegistry(library_dir, os.environ.get('SHAREFLOW_PROCESS_LIBRARY_CACHE'),
+                                       reload_interval=None)
+    screenshots = (ScreenshotStore(os.environ['SHAREFLOW_SCREENSHOT_DIR'])
+                   if os.environ.get('SHAREFLOW_SCREENSHOT_DIR') else None)
+
+    records = UserEventRecord.find(UserEventRecord.completed >= max(args.since, 1)).all()
+    counts = backfill(records, RedisEventStore(), RedisDocumentStore(), libraries,
+                      screenshots, args.force, args.page_size)
+    json.dump(counts, sys.stdout)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Instrumentation of the ShareFlow pipeline.
+
+Disabled by default; set SHAREFLOW_METRICS (or call enable()) to turn it on.
+While disabled, recorder() returns a shared no-op recorder, so the hooks in the
+pipeline cost one call and an attribute check per stage.
+
+While enabled, every stage records its wall time, the events it processed and
+the bytes of step payload (text, description, url, title, image) it handled:
+
+- the 'fetch' and 'screenshots' stages of batch_steps,
+- 'action_mapper', 'process_labeller' and 'reformat_to_nested', or the single
+  'columnar' / 'fused' stage of those modes.
+
+Per-pattern hit counts (trie and regex engines), events per process and the
+NO MATCH ratio come from the labels. Totals are exported in the Prometheus
+text format by render(). A request wrapped in request() also writes one JSON
+log line with its own stage timings to the 'shareflow.metrics' logger.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+log = logging.getLogger('shareflow.metrics')
+
+_enabled = bool(os.environ.get('SHAREFLOW_METRICS'))
+_current = contextvars.ContextVar('shareflow_metrics_recorder', default=None)
+
+# Exported metrics: name -> (type, help)
+METRICS = {
+    'shareflow_stage_seconds_total': ('counter', 'Wall time spent in each pipeline stage.'),
+    'shareflow_stage_calls_total': ('counter', 'Number of times each pipeline stage ran.'),
+    'shareflow_stage_events_total': ('counter', 'Events processed by each pipeline stage.'),
+    'shareflow_stage_bytes_total': ('counter', 'Bytes of step payload handled by each pipeline stage.'),
+    'shareflow_pattern_hits_total': ('counter', 'Matches of each process_map pattern.'),
+    'shareflow_process_events_total': ('counter', 'Events labelled with each process.'),
+    'shareflow_labelled_events_total': ('counter', 'Events labelled.'),
+    'shareflow_no_match_events_total': ('counter', 'Events labelled NO MATCH.'),
+    'shareflow_no_match_ratio': ('gauge', 'Share of labelled events labelled NO MATCH.'),
+    'shareflow_requests_total': ('counter', 'Instrumented requests.'),
+    'shareflow_request_seconds_total': ('counter', 'Wall time of instrumented requests.'),
+}
+
+
+def enabled():
+    return _enabled
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def payload_bytes(steps):
+    """Return the bytes of text payload carried by steps or action records."""
+    return sum(
+        len(step.get('text') or '') + len(step.get('description') or '') + len(step.get('url') or '')
+        + len(step.get('title') or '') + len(step.get('image') or '')
+        for step in steps
+    )
+
+
+class Registry:
+    """Process-wide metric values, keyed by (name, labels)."""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, name, **labels):
+        return self._values.get((name, tuple(sorted(labels.items()))), 0)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            values = dict(self._values)
+        labelled = values.get(('shareflow_labelled_events_total', ()), 0)
+        if labelled:
+            values[('shareflow_no_match_ratio', ())] = \
+                values.get(('shareflow_no_match_events_total', ()), 0) / labelled
+
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            samples = sorted((labels, value) for (metric, labels), value in values.items() if metric == name)
+            if not samples:
+                continue
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                if labels:
+                    rendered = ','.join('%s="%s"' % (key, _escape(val)) for key, val in labels)
+                    lines.append('%s{%s} %s' % (name, rendered, _number(value)))
+                else:
+                    lines.append('%s %s' % (name, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+
+class _Stage:
+    __slots__ = ('recorder', 'name', 'start', 'events', 'bytes')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.events = 0
+        self.bytes = 0
+
+    def count(self, events=0, bytes=0):
+        self.events += events
+        self.bytes += bytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.add(self.name, time.perf_counter() - self.start, self.events, self.bytes)
+        return False
+
+
+class Recorder:
+    """Records stage metrics into the registry and, for a request, its log line."""
+
+    enabled = True
+
+    def __init__(self, registry=registry):
+        self.registry = registry
+        self.stages = {}
+        self.labelled = 0
+        self.no_match = 0
+
+    def stage(self, name):
+        """Return a context manager timing the stage 'name'; call count() on it."""
+        return _Stage(self, name)
+
+    def add(self, name, seconds, events=0, bytes=0):
+        self.registry.inc('shareflow_stage_seconds_total', seconds, stage=name)
+        self.registry.inc('shareflow_stage_calls_total', stage=name)
+        self.registry.inc('shareflow_stage_events_total', events, stage=name)
+        self.registry.inc('shareflow_stage_bytes_total', bytes, stage=name)
+        totals = self.stages.setdefault(name, {'seconds': 0.0, 'events': 0, 'bytes': 0})
+        totals['seconds'] += seconds
+        totals['events'] += events
+        totals['bytes'] += bytes
+
+    def pattern_hits(self, hits):
+        for label, count in hits.items():
+            self.registry.inc('shareflow_pattern_hits_total', count, process=label)
+
+    def document(self, document):
+        """Count the events per process and NO MATCH events of a ShareFlow document."""
+        if not document:
+            return
+        labelled = no_match = 0
+        for process in document['KM_Process']:
+            label = '%s %s' % (process['code'], process['name'])
+            count = len(process['steps'])
+            self.registry.inc('shareflow_process_events_total', count, process=label)
+            labelled += count
+            if label == 'NO MATCH':
+                no_match += count
+        self.registry.inc('shareflow_labelled_events_total', labelled)
+        self.registry.inc('shareflow_no_match_events_total', no_match)
+        self.labelled += labelled
+        self.no_match += no_match
+
+    def log_line(self, seconds, **fields):
+        """Return the structured log record of a request."""
+        return {
+            **fields,
+            'seconds': round(seconds, 6),
+            'stages': {
+                name: {'seconds': round(totals['seconds'], 6), 'events': totals['events'], 'bytes': totals['bytes']}
+                for name, totals in self.stages.items()
+            },
+            'labelled': self.labelled,
+            'no_match_ratio': self.no_match / self.labelled if self.labelled else None,
+        }
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def count(self, events=0, bytes=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _NullRecorder:
+    """Recorder used while instrumentation is disabled; every hook is a no-op."""
+
+    enabled = False
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def add(self, name, seconds, events=0, bytes=0):
+        pass
+
+    def pattern_hits(self, hits):
+        pass
+
+    def document(self, document):
+        pass
+
+
+NULL_RECORDER = _NullRecorder()
+
+
+def recorder():
+    """
+    Return the recorder of the current request, a new recorder when
+    instrumentation is enabled outside a request, or the no-op recorder.
+    """
+    if not _enabled:
+        return NULL_RECORDER
+    current = _current.get()
+    return current if current is not None else Recorder()
+
+
+@contextmanager
+def request(**fields):
+    """
+    Instrument a request: stages recorded inside the block are also summed
+    into one JSON log line carrying 'fields'.
+    """
+    if not _enabled:
+        yield NULL_RECORDER
+        return
+    current = Recorder()
+    token = _current.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        seconds = time.perf_counter() - start
+        _current.reset(token)
+        registry.inc('shareflow_requests_total')
+        registry.inc('shareflow_request_seconds_total', seconds)
+        log.info(json.dumps(current.log_line(seconds, **fields), default=str))
+
+
+def render():
+    """Return the metrics in the Prometheus text exposition format."""
+    return registry.render()
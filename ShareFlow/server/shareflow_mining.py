@@ -0,0 +1,451 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Mining of frequent action sequences to propose new process_map patterns.
+
+process_labeller only matches contiguous runs of mapped actions, so the miner
+looks for frequent contiguous sequences. It grows them PrefixSpan-style: a
+prefix keeps its projected database (the session and end position of every
+occurrence), each extension is counted from that projection only, and
+extensions below the support threshold are pruned. The support of a sequence is
+the number of sessions containing it.
+
+Sessions are split into shards mined on a process pool in three passes over
+the shards, so the result is exact (the SON partition algorithm):
+
+1. every shard mines its locally frequent sequences at the same relative
+   threshold; a globally frequent sequence is locally frequent in at least one
+   shard, so the union of the local results holds every answer,
+2. every shard counts the support of that union exactly and the counts are
+   merged,
+3. the most frequent candidates that are not patterns yet are evaluated: each
+   is appended to the process_map (lowest priority, as a new entry would be)
+   and its effect on the labels is measured: how many events leave NO MATCH
+   and how many become covered by a pattern match instead of inheriting the
+   previous label. Each session is scanned once with the current patterns; a
+   candidate is only rescanned from the positions where it can take effect.
+
+    python shareflow_mining.py (--archive <dir> | --input <file.json>) [--min-support 0.01]
+
+The work is bounded by max_length (the projections of a level hold at most one
+entry per event) and by 'evaluate' for the relabelling pass. Archived sessions
+are read from the event_type and text_content columns only.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from shareflow_archive import ArchivedSession
+from shareflow_process import action_mapping as default_action_mapping
+from shareflow_process import compile_process_map, map_action_type, match_process_at
+from shareflow_process import process_map as default_process_map
+
+
+def session_actions(entries, mapping=None):
+    """Return the mapped action types of the steps of a session's entries, in order."""
+    if mapping is None:
+        mapping = default_action_mapping
+    return tuple(
+        map_action_type(step.get('type', 'No type'), step.get('text', ''), mapping)
+        for entry in entries
+        for step in entry.get('steps', [])
+    )
+
+
+def _resolve(shard, mapping):
+    """Return the action sequences of a shard of entries or ArchivedSession references."""
+    sequences = []
+    for item in shard:
+        if isinstance(item, tuple):
+            sequences.append(item)
+        elif isinstance(item, ArchivedSession):
+            sequences.append(item.actions(mapping))
+        else:
+            sequences.append(session_actions(item, mapping))
+    return sequences
+
+
+def prefixspan(sequences, min_count, max_length, min_length=1):
+    """
+    Return {sequence: support} for every contiguous sequence of 'min_length'
+    to 'max_length' actions contained in at least 'min_count' of 'sequences'.
+    """
+    # Projection of the empty prefix: every position of every sequence
+    projected = {}
+    for s, sequence in enumerate(sequences):
+        for position, action in enumerate(sequence):
+            projected.setdefault(action, []).append((s, position + 1))
+
+    frequent = {}
+    stack = [((action,), occurrences) for action, occurrences in projected.items()]
+    while stack:
+        prefix, occurrences = stack.pop()
+        support = _support(occurrences)
+        if support < min_count:
+            continue
+        if len(prefix) >= min_length:
+            frequent[prefix] = support
+        if len(prefix) == max_length:
+            continue
+        extensions = {}
+        for s, position in occurrences:
+            sequence = sequences[s]
+            if position < len(sequence):
+                extensions.setdefault(sequence[position], []).append((s, position + 1))
+        stack.extend((prefix + (action,), grown) for action, grown in extensions.items())
+    return frequent
+
+
+def _support(occurrences):
+    # Occurrences are in sequence order, so distinct sequences are counted by
+    # the changes of the sequence index
+    support = 0
+    previous = None
+    for s, _ in occurrences:
+        if s != previous:
+            support += 1
+            previous = s
+    return support
+
+
+def coverage(root, types):
+    """
+    Return (no_match, unmatched): the number of events process_labeller labels
+    NO MATCH, and the number not covered by any pattern match (the NO MATCH
+    events plus those inheriting the previous label).
+    """
+    no_match = unmatched = 0
+    matched = False
+    i = 0
+    while i < len(types):
+        match = match_process_at(root, types, i)
+        if match is not None:
+            matched = True
+            i += match[0]
+        else:
+            unmatched += 1
+            if not matched:
+                no_match += 1
+            i += 1
+    return no_match, unmatched
+
+
+def _mine_shard(shard, min_support, max_length, min_length, mapping):
+    sequences = _resolve(shard, mapping)
+    min_count = max(1, math.ceil(min_support * len(sequences) - 1e-9))
+    return set(prefixspan(sequences, min_count, max_length, min_length))
+
+
+def _count_shard(shard, candidates, max_length, min_length, mapping):
+    # The candidates are prefix-closed (down to min_length), so an occurrence
+    # stops being extended at its first prefix that is not a candidate
+    sequences = _resolve(shard, mapping)
+    counts = {}
+    occurrences = {}
+    for sequence in sequences:
+        seen = set()
+        n = len(sequence)
+        for i in range(n):
+            for j in range(i + 1, min(n, i + max_length) + 1):
+                subsequence = sequence[i:j]
+                if subsequence not in candidates:
+                    if j - i >= min_length:
+                        break
+                    continue
+                occurrences[subsequence] = occurrences.get(subsequence, 0) + 1
+                if subsequence not in seen:
+                    seen.add(subsequence)
+                    counts[subsequence] = counts.get(subsequence, 0) + 1
+    return len(sequences), sum(len(sequence) for sequence in sequences), counts, occurrences
+
+
+class _BaseScan:
+    """
+    The process_labeller scan of one sequence with the current patterns.
+
+    A candidate appended to the patterns has the lowest priority, so it can
+    only change the scan at a position the scan visits without a match (a
+    trigger). Up to the first trigger where the candidate occurs the two scans
+    are identical, and once the candidate scan lands on a visited position
+    again they are identical up to the next such trigger, so a candidate only
+    has to be scanned from its own triggers until it rejoins this scan.
+    """
+
+    def __init__(self, root, sequence):
+        self.sequence = sequence
+        # Visited position -> whether a pattern matched there
+        self.visited = {}
+        positions = []
+        i = 0
+        while i < len(sequence):
+            match = match_process_at(root, sequence, i)
+            self.visited[i] = match is not None
+            positions.append(i)
+            i += match[0] if match is not None else 1
+
+        # Per visited position (and the end): unmatched and NO MATCH events
+        # from there on, and whether a pattern matched before it
+        n = len(sequence)
+        self.unmatched_from = {n: 0}
+        self.no_match_from = {n: 0}
+        unmatched = 0
+        for i in reversed(positions):
+            if not self.visited[i]:
+                unmatched += 1
+            self.unmatched_from[i] = unmatched
+        self.matched_before = {}
+        matched = False
+        no_match_total = 0
+        for i in positions:
+            self.matched_before[i] = matched
+            if not self.visited[i] and not matched:
+                no_match_total += 1
+            matched = matched or self.visited[i]
+        self.matched_before[n] = matched
+        remaining = no_match_total
+        for i in positions:
+            self.no_match_from[i] = remaining
+            if not self.visited[i] and not self.matched_before[i]:
+                remaining -= 1
+        self.no_match = no_match_total
+        self.unmatched = self.unmatched_from[0] if n else 0
+        self.triggers = [i for i in positions if not self.visited[i]]
+
+    def candidate_triggers(self, candidates, max_length):
+        """Return {candidate: triggers where it occurs} for the candidates occurring at a trigger."""
+        found = {}
+        sequence = self.sequence
+        for t in self.triggers:
+            for j in range(t + 1, min(len(sequence), t + max_length) + 1):
+                if sequence[t:j] in candidates:
+                    found.setdefault(sequence[t:j], []).append(t)
+        return found
+
+    def coverage_with(self, root, triggers):
+        """Return coverage() of the sequence with the candidate compiled in 'root'."""
+        sequence = self.sequence
+        n = len(sequence)
+        no_match = unmatched = 0
+        matched = False
+        i = 0
+        k = 0
+        while i < n:
+            if i in self.visited:
+                # In step with the base scan: skip to the candidate's next trigger
+                while k < len(triggers) and triggers[k] < i:
+                    k += 1
+                stop = triggers[k] if k < len(triggers) else n
+                unmatched += self.unmatched_from[i] - self.unmatched_from[stop]
+                if not matched:
+                    no_match += self.no_match_from[i] - self.no_match_from[stop]
+                matched = matched or self.matched_before[stop]
+                i = stop
+                if i == n:
+                    break
+            match = match_process_at(root, sequence, i)
+            if match is not None:
+                matched = True
+                i += match[0]
+            else:
+                unmatched += 1
+                if not matched:
+                    no_match += 1
+                i += 1
+        return no_match, unmatched
+
+
+def _evaluate_shard(shard, candidates, patterns, max_length, mapping):
+    base = compile_process_map(patterns)
+    roots = {}
+    for candidate in candidates:
+        extended = dict(patterns)
+        extended[_candidate_name(candidate)] = list(candidate)
+        roots[candidate] = compile_process_map(extended)
+
+    candidates = frozenset(candidates)
+    totals = {'no_match': 0, 'unmatched': 0}
+    deltas = {candidate: [0, 0] for candidate in candidates}
+    for sequence in _resolve(shard, mapping):
+        scan = _BaseScan(base, sequence)
+        totals['no_match'] += scan.no_match
+        totals['unmatched'] += scan.unmatched
+        for candidate, triggers in scan.candidate_triggers(candidates, max_length).items():
+            no_match, unmatched = scan.coverage_with(roots[candidate], triggers)
+            deltas[candidate][0] += scan.no_match - no_match
+            deltas[candidate][1] += scan.unmatched - unmatched
+    return totals, deltas
+
+
+def _candidate_name(candidate):
+    return 'Candidate %s' % ' > '.join(candidate)
+
+
+def _shards(sessions, shard_size):
+    shard = []
+    for session in sessions:
+        shard.append(session)
+        if len(shard) == shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def mine_patterns(sessions, min_support=0.01, max_length=6, min_length=1, evaluate=100, top=20,
+                  processes=None, shard_size=2000, library=None):
+    """
+    Propose new process_map patterns from the action sequences of many sessions.
+
+    Parameters:
+    sessions (iterable): Per session, its entries (in the shape taken by
+        shareflows_process), an ArchivedSession, or a tuple of mapped actions.
+    min_support (float): Smallest share of sessions a sequence must occur in.
+    max_length (int): Longest sequence mined.
+    min_length (int): Shortest sequence proposed.
+    evaluate (int): Number of most frequent candidates whose NO MATCH reduction is measured.
+    top (int): Number of candidates returned.
+    processes (int): Number of worker processes (default: CPU count); 0 or 1 runs in-process.
+    shard_size (int): Number of sessions per shard.
+    library (ProcessLibrary): Process library whose mapping and process_map are
+        used (defaults to the module dictionaries).
+
+    Returns:
+    dict: 'sessions', 'events', the current 'no_match' and 'unmatched' event
+    counts and 'candidates', a list of {'pattern', 'support', 'occurrences',
+    'no_match_reduction', 'unmatched_reduction'} ranked by NO MATCH reduction,
+    then unmatched reduction, then support.
+    """
+    if not 0 < min_support <= 1:
+        raise ValueError("min_support must be a share of sessions in (0, 1]")
+    if max_length < min_length or min_length < 1:
+        raise ValueError("Invalid sequence length bounds %d..%d" % (min_length, max_length))
+    mapping = library.action_mapping if library is not None else default_action_mapping
+    patterns = library.process_map if library is not None else default_process_map
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    shards = list(_shards(sessions, shard_size))
+    existing = {tuple(pattern) for pattern in patterns.values()}
+
+    def run(function, *args):
+        if processes <= 1:
+            return [function(shard, *args) for shard in shards]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            return list(executor.map(function, shards, *[[arg] * len(shards) for arg in args]))
+
+    # 1. Locally frequent sequences
+    candidates = set()
+    for local in run(_mine_shard, min_support, max_length, min_length, mapping):
+        candidates |= local
+
+    # 2. Exact support of the candidates
+    total_sessions = total_events = 0
+    support = dict.fromkeys(candidates, 0)
+    occurrences = dict.fromkeys(candidates, 0)
+    for sessions_count, events, counts, found in run(_count_shard, frozenset(candidates), max_length, min_length, mapping):
+        total_sessions += sessions_count
+        total_events += events
+        for candidate, count in counts.items():
+            support[candidate] += count
+        for candidate, count in found.items():
+            occurrences[candidate] += count
+    min_count = math.ceil(min_support * total_sessions - 1e-9)
+    frequent = sorted(
+        (candidate for candidate, count in support.items() if count >= min_count and candidate not in existing),
+        key=lambda candidate: (-support[candidate], candidate),
+    )[:evaluate]
+
+    # 3. NO MATCH reduction of the most frequent candidates
+    totals = {'no_match': 0, 'unmatched': 0}
+    reductions = {candidate: [0, 0] for candidate in frequent}
+    for shard_totals, deltas in run(_evaluate_shard, tuple(frequent), patterns, max_length, mapping):
+        totals['no_match'] += shard_totals['no_match']
+        totals['unmatched'] += shard_totals['unmatched']
+        for candidate, (no_match, unmatched) in deltas.items():
+            reductions[candidate][0] += no_match
+            reductions[candidate][1] += unmatched
+
+    ranked = sorted(
+        frequent,
+        key=lambda candidate: (-reductions[candidate][0], -reductions[candidate][1], -support[candidate], candidate),
+    )
+    return {
+        'sessions': total_sessions,
+        'events': total_events,
+        'no_match': totals['no_match'],
+        'unmatched': totals['unmatched'],
+        'candidates': [
+            {
+                'pattern': list(candidate),
+                'support': support[candidate],
+                'occurrences': occurrences[candidate],
+                'no_match_reduction': reductions[candidate][0],
+                'unmatched_reduction': reductions[candidate][1],
+            }
+            for candidate in ranked[:top]
+        ],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Propose process_map patterns from frequent action sequences.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--archive', help="event archive directory (see shareflow_archive)")
+    source.add_argument('--input', help="JSON file of entries, in the shape taken by shareflows_process")
+    parser.add_argument('--min-support', type=float, default=0.01, help="smallest share of sessions")
+    parser.add_argument('--max-length', type=int, default=6, help="longest sequence mined")
+    parser.add_argument('--min-length', type=int, default=1, help="shortest sequence proposed")
+    parser.add_argument('--evaluate', type=int, default=100, help="candidates whose NO MATCH reduction is measured")
+    parser.add_argument('--top', type=int, default=20, help="candidates reported")
+    parser.add_argument('--processes', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--library', default=None, help="process library JSON file (see process_library)")
+    args = parser.parse_args(argv)
+
+    library = None
+    if args.library:
+        from process_library import load_library
+        library = load_library(args.library)
+
+    if args.archive:
+        from shareflow_batch import archive_sessions
+        sessions = (reference for _, reference in archive_sessions(os.path.abspath(args.archive)))
+    else:
+        from shareflow_batch import partition_sessions
+        with open(args.input) as handle:
+            sessions = (entries for _, entries in partition_sessions(json.load(handle)))
+
+    result = mine_patterns(sessions, args.min_support, args.max_length, args.min_length, args.evaluate,
+                           args.top, args.processes, library=library)
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
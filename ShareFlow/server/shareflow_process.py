@@ -32,12 +32,11 @@ library defined below. Initial exploration of the process library is
 referenced here.
 """
 
-import json
 import re
-from pyramid import i18n
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
 
-_ = i18n.TranslationStringFactory(__package__)
+import shareflow_metrics
 
 
 action_mapping = {
@@ -132,14 +131,20 @@ def map_action_types(action_list, action_mapping):
     list: Updated list with mapped 'type' values.
     """
     for entry in action_list:
-        action_text_key = (entry['type'], entry['text'])
-        if action_text_key in action_mapping:
-            entry['type'] = action_mapping[action_text_key]
-        elif entry['type'] in action_mapping:
-            entry['type'] = action_mapping[entry['type']]
+        entry['type'] = map_action_type(entry['type'], entry['text'], action_mapping)
     return action_list
 
 
+def map_action_type(action_type, text, action_mapping):
+    """Return the mapped value of a single (type, text) pair, or 'action_type' if unmapped."""
+    action_text_key = (action_type, text)
+    if action_text_key in action_mapping:
+        return action_mapping[action_text_key]
+    elif action_type in action_mapping:
+        return action_mapping[action_type]
+    return action_type
+
+
 def ExceptionHandler(action_list):
     
     """
@@ -170,41 +175,141 @@ def ExceptionHandler(action_list):
     return flagged_entries
 
 
-def action_mapper(data):
+class ActionRecord:
+    """
+    Compact record of one action flowing through the pipeline.
+
+    Holds the fields extracted by action_mapper plus the 'KM_Process' and
+    'seq_counter' labels added by later stages in __slots__ instead of a
+    per-event dict. It supports the subset of the dict interface the pipeline
+    uses (item access, get, 'in'), and is converted to the JSON step shape only
+    in reformat_to_nested (see entry_to_step).
+    """
+
+    __slots__ = (
+        'userid', 'sessionId', 'taskName', 'type', 'text', 'url', 'description',
+        'image', 'title', 'width', 'height', 'offsetX', 'offsetY',
+        'KM_Process', 'seq_counter',
+    )
+
+    def __init__(self, userid, sessionId, taskName, type, text, url, description,
+                 image, title, width, height, offsetX, offsetY):
+        self.userid = userid
+        self.sessionId = sessionId
+        self.taskName = taskName
+        self.type = type
+        self.text = text
+        self.url = url
+        self.description = description
+        self.image = image
+        self.title = title
+        self.width = width
+        self.height = height
+        self.offsetX = offsetX
+        self.offsetY = offsetY
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def get(self, key, default=None):
+        if key in self.__slots__:
+            return getattr(self, key, default)
+        return default
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.keys()}
+
+    def __eq__(self, other):
+        if isinstance(other, ActionRecord):
+            return self.to_dict() == other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'ActionRecord(%r)' % (self.to_dict(),)
+
+
+def extract_actions(data):
+    """
+    Flatten the 'steps' of every ShareFlow entry into a list of action records.
 
+    Parameters:
+    data (list): List of dictionaries containing 'taskName', 'userid', 'sessionId' and 'steps'.
+
+    Returns:
+    list: One ActionRecord per step, carrying its entry's identifiers.
+    """
     # List to store the extracted information
     action_sequence = []
 
-    #1: Iterate through the JSON data to extract key fields
+    # Iterate through the JSON data to extract key fields
     for entry in data:
         task_name = entry.get('taskName', 'No taskName')
         userid = entry.get('userid', '')
         sessionId = entry.get('sessionId', '')
         
         for step in entry.get('steps', []):
-            action_sequence.append({
-                'userid': userid,
-                'sessionId': sessionId,
-                'taskName': task_name,
-                'type': step.get('type', 'No type'),
-                'text': step.get('text', ''),
-                'url': step.get('url', ''),
-                'description': step.get('description', ''),
-                'image': step.get('image', ''),
-                'title': step.get('title', ''),
-                'width': step.get('width'),
-                'height': step.get('height'),
-                'offsetX': step.get('offsetX'),
-                'offsetY': step.get('offsetY'),
-            })
+            action_sequence.append(step_to_action(userid, sessionId, task_name, step))
+    return action_sequence
+
+
+def step_to_action(userid, sessionId, task_name, step):
+    """Build the ActionRecord of one step of an entry."""
+    return ActionRecord(
+        userid,
+        sessionId,
+        task_name,
+        step.get('type', 'No type'),
+        step.get('text', ''),
+        step.get('url', ''),
+        step.get('description', ''),
+        step.get('image', ''),
+        step.get('title', ''),
+        step.get('width'),
+        step.get('height'),
+        step.get('offsetX'),
+        step.get('offsetY'),
+    )
+
+
+def action_mapper(data, flagged_entries=None, mapping=None):
+    """
+    Extract, flag and map the actions of 'data'.
+
+    The entries flagged by ExceptionHandler are appended to 'flagged_entries'
+    when a list is given. 'mapping' defaults to the module action_mapping.
+    """
+
+    #1: Iterate through the JSON data to extract key fields
+    action_sequence = extract_actions(data)
             
     #2:  Handle & Flag/Fix Exceptions
-    flagged_entries = ExceptionHandler(action_sequence)
-    ## print(flagged_entries)
+    flagged = ExceptionHandler(action_sequence)
+    if flagged_entries is not None:
+        flagged_entries.extend(flagged)
     
     #3:  Map actions from ShareFlow with  TAC - Actions Dictionaire 
     # Map the type values
-    mapped_action_list = map_action_types(action_sequence, action_mapping)
+    mapped_action_list = map_action_types(
+        action_sequence, action_mapping if mapping is None else mapping)
 
 
     return mapped_action_list
@@ -219,89 +324,282 @@ def get_primary_process(s):
     return s
 
 
-def process_labeller (action_list):
+class _ProcessTrieNode:
+    """A node of the compiled process_map trie."""
+
+    __slots__ = ("children", "match", "best")
+
+    def __init__(self):
+        self.children = {}
+        # (priority, length, label) of the first-declared pattern ending here
+        self.match = None
+        # lowest pattern priority reachable from this node
+        self.best = float("inf")
+
+
+def compile_process_map(process_map):
+    """
+    Compile the process_map patterns into a trie keyed by action type.
+
+    Each terminal node keeps the first-declared pattern that ends there and
+    every node keeps the lowest priority reachable below it, so a scan can stop
+    as soon as no deeper pattern could beat the best match found so far.
+
+    Parameters:
+    process_map (dict): Dictionary mapping process names to sequences of 'type' values.
+
+    Returns:
+    _ProcessTrieNode: Root of the compiled trie.
+    """
+    root = _ProcessTrieNode()
+    for priority, (pattern_key, pattern_value) in enumerate(process_map.items()):
+        if not pattern_value:
+            continue
+        path = [root]
+        node = root
+        for action_type in pattern_value:
+            node = node.children.setdefault(action_type, _ProcessTrieNode())
+            path.append(node)
+        if node.match is None:
+            node.match = (priority, len(pattern_value), get_primary_process(pattern_key))
+        for visited in path:
+            visited.best = min(visited.best, priority)
+    return root
+
+
+def freeze_process_map(patterns):
+    """Return a hashable snapshot of 'patterns', used as compiled-matcher cache key."""
+    return tuple((key, tuple(value)) for key, value in patterns.items())
+
+
+# Compiled tries by frozen process_map, least recently used first
+_process_matchers = OrderedDict()
+PROCESS_MATCHER_CACHE_SIZE = 32
+
+
+def cache_process_matcher(patterns, root):
+    """
+    Register an already compiled trie for 'patterns' (e.g. one loaded from a
+    precompiled process library) so labellers do not compile it again.
+    """
+    _process_matchers[freeze_process_map(patterns)] = root
+    while len(_process_matchers) > PROCESS_MATCHER_CACHE_SIZE:
+        _process_matchers.popitem(last=False)
+
+
+def get_process_matcher(patterns=None):
+    """
+    Return the compiled trie for 'patterns' (defaults to the module process_map),
+    reusing a previously compiled one when the patterns have not changed.
+    """
+    if patterns is None:
+        patterns = process_map
+    frozen = freeze_process_map(patterns)
+    root = _process_matchers.get(frozen)
+    if root is None:
+        root = compile_process_map(patterns)
+        cache_process_matcher(patterns, root)
+    else:
+        _process_matchers.move_to_end(frozen)
+    return root
+
+
+def match_process_at(root, types, i):
+    """
+    Return (length, label) of the first-declared pattern matching 'types' at
+    position 'i', or None when no pattern matches there.
+    """
+    best = None
+    node = root
+    n = len(types)
+    while i < n and (best is None or node.best < best[0]):
+        node = node.children.get(types[i])
+        if node is None:
+            break
+        if node.match is not None and (best is None or node.match[0] < best[0]):
+            best = node.match
+        i += 1
+    if best is None:
+        return None
+    return best[1], best[2]
+
+
+def process_labeller (action_list, process_map=None, hits=None):
     
     """
     Scan through the 'action_list' for specified consecutive action values in
     in the 'type' column and map them with the corresponding value from the process_mapping dictionary.
 
+    At every position the first-declared pattern that matches wins, matches do
+    not overlap and unmatched entries inherit the previous label. The patterns
+    are compiled once into a trie (see compile_process_map), so the scan costs
+    O(events x longest pattern) instead of O(events x patterns x pattern length).
+
     Parameters:
     action_list (list): List of dictionaries containing 'taskName' and 'type'.
     process_map (dict): Dictionary mapping sequences of 'type' values to labels.
+        Defaults to the module process_map.
+    hits (dict): When given, the number of matches of every label is added to it.
 
     Returns:
     list: Updated list with an additional attribute showing the process label where the pattern was matched.
     """ 
-    # Convert patterns dictionary for easier access
-    pattern_keys = list(process_map.keys())
-    pattern_values = list(process_map.values())
+    root = get_process_matcher(process_map)
+    types = [entry['type'] for entry in action_list]
 
     # Iterate through the list to check for pattern matches
     i = 0
     prev_pattern = None
     while i < len(action_list):
-        match_found = False
-        for pattern_key, pattern_value in zip(pattern_keys, pattern_values):
-            pattern_length = len(pattern_value)
-            if i + pattern_length <= len(action_list):
-                if all(action_list[i + j]['type'] == pattern_value[j] for j in range(pattern_length)):
-                    for k in range(pattern_length):
-                        action_list[i + k]['KM_Process'] = get_primary_process(pattern_key)
-                    i += pattern_length - 1
-                    match_found = True
-                    if match_found:
-                        prev_pattern = get_primary_process(pattern_key)
-                    break
-        if not match_found:
+        match = match_process_at(root, types, i)
+        if match is not None:
+            pattern_length, label = match
+            for k in range(i, i + pattern_length):
+                action_list[k]['KM_Process'] = label
+            if hits is not None:
+                hits[label] = hits.get(label, 0) + 1
+            prev_pattern = label
+            i += pattern_length
+        else:
             action_list[i]['KM_Process'] = prev_pattern if prev_pattern else "NO MATCH"
-        i += 1                
-                        
+            i += 1
+
     return action_list
 
 
-def process_labeller_re(action_list):
+# Separator used to join action types into a single string for the regex
+# engine; it does not occur in the action vocabulary.
+TOKEN_SEPARATOR = "\x1f"
+
+
+@lru_cache(maxsize=32)
+def _compile_frozen_process_regex(frozen_process_map):
+    alternatives = []
+    labels = {}
+    for priority, (pattern_key, pattern_value) in enumerate(frozen_process_map):
+        if not pattern_value:
+            continue
+        group = "p%d" % priority
+        alternatives.append("(?P<%s>%s)" % (
+            group, TOKEN_SEPARATOR.join(re.escape(t) for t in pattern_value)))
+        labels[group] = (len(pattern_value), get_primary_process(pattern_key))
+    if not alternatives:
+        return None, labels
+    # Python tries the alternatives in order, so at every token boundary the
+    # first-declared pattern that matches whole tokens wins.
+    regex = re.compile("(?:^|(?<=%s))(?:%s)(?=%s|$)" % (
+        TOKEN_SEPARATOR, "|".join(alternatives), TOKEN_SEPARATOR))
+    return regex, labels
+
+
+def get_process_regex(patterns=None):
+    """
+    Return (regex, labels) for 'patterns' (defaults to the module process_map):
+    a single alternation of all patterns anchored on token boundaries, and a
+    mapping of its named groups to (pattern length, primary process name).
+    """
+    if patterns is None:
+        patterns = process_map
+    return _compile_frozen_process_regex(freeze_process_map(patterns))
+
+
+def process_labeller_re(action_list, process_map=None, hits=None):
     """
     Scan through the 'action_list' for specified consecutive action values in the 'type' column
     and map them with the corresponding value from the process_map dictionary.
 
+    Regex engine with the same labels as process_labeller: the patterns are
+    compiled once into a single alternation over whole tokens, so 'Click' does
+    not match inside 'Click_Search', and match offsets are converted to entry
+    indices with a precomputed offset map.
+
     Parameters:
     action_list (list): List of dictionaries containing 'taskName' and 'type'.
     process_map (dict): Dictionary mapping sequences of 'type' values to labels.
+        Defaults to the module process_map.
+    hits (dict): When given, the number of matches of every label is added to it.
 
     Returns:
     list: Updated list with an additional attribute showing the process label where the pattern was matched.
     """
-    
-    # Create a string representation of the 'type' column
-    type_sequence = ' '.join(entry['type'] for entry in action_list)
-    
-    # Create a dictionary to store the matches and their positions
-    matches = {}
-    
-    for pattern_key, pattern_value in process_map.items():
-        pattern_str = ' '.join(pattern_value)
-        for match in re.finditer(pattern_str, type_sequence):
-            start, end = match.span()
-            start_index = len(type_sequence[:start].split())
-            end_index = len(type_sequence[:end].split())
-            matches[(start_index, end_index)] = pattern_key
-    
-    # Label the actions based on the matched patterns
-    for (start, end), pattern_key in matches.items():
-        for i in range(start, end):
-            action_list[i]['KM_Process'] = pattern_key
-    
-    # Label remaining actions as "NO MATCH"
-    for entry in action_list:
-        if 'KM_Process' not in entry:
-            entry['KM_Process'] = "NO MATCH"
-    
+    regex, labels = get_process_regex(process_map)
+
+    # Create a string representation of the 'type' column and the offset of
+    # every entry in it (types that are not strings never match a pattern)
+    types = [entry['type'] if isinstance(entry['type'], str) else "" for entry in action_list]
+    type_sequence = TOKEN_SEPARATOR.join(types)
+    index_of = {}
+    offset = 0
+    for index, action_type in enumerate(types):
+        index_of[offset] = index
+        offset += len(action_type) + 1
+
+    i = 0
+    prev_pattern = None
+    matches = regex.finditer(type_sequence) if regex is not None and action_list else ()
+    for match in matches:
+        start = index_of[match.start()]
+        pattern_length, label = labels[match.lastgroup]
+        # Unmatched entries inherit the previous label
+        for k in range(i, start):
+            action_list[k]['KM_Process'] = prev_pattern if prev_pattern else "NO MATCH"
+        for k in range(start, start + pattern_length):
+            action_list[k]['KM_Process'] = label
+        if hits is not None:
+            hits[label] = hits.get(label, 0) + 1
+        prev_pattern = label
+        i = start + pattern_length
+
+    for k in range(i, len(action_list)):
+        action_list[k]['KM_Process'] = prev_pattern if prev_pattern else "NO MATCH"
+
     return action_list
 
 
-def reformat_to_nested(data):
+def entry_to_step(entry):
+    """Build the step dictionary of the nested document from a labelled entry."""
+    return {
+        "type": entry["type"],
+        "text": entry["text"],
+        "title": entry["title"],  #new Field S.S
+        "url": entry["url"],
+        "description": entry["description"],
+        "image": entry["image"],
+        "width": entry.get("width"),
+        "height": entry.get("height"),
+        "offsetX": entry.get("offsetX"),
+        "offsetY": entry.get("offsetY")
+    }
+
+
+def build_km_process(name, steps):
+    """Build the KM_Process metadata of one labelled group of steps."""
+    return {
+        "image": "", #new Field S.S TODO
+        "name": name.split(" ", 1)[1],
+        "code" : name.split(" ", 1)[0], #new Field S.S
+        "title" : get_first_non_empty_title(steps), #new Field S.S
+        "steps": set_all_images_to_empty(steps),
+        "screenshot": get_last_non_empty_image(steps),
+    }
+
+
+def build_nested_document(userid, sessionId, taskName, km_process):
+    """Wrap the KM_Process list with the identifiers of the ShareFlow document."""
+    return {
+        "userid": userid,
+        "sessionId": sessionId,
+        "taskName": taskName,
+        "dataShareFlowsID": "dc-" + sessionId,
+        "KM_Process": km_process
+    }
+
+
+def reformat_to_nested(data, serialize=True):
     # Use defaultdict to organize the data
-    data = process_serialize(data)
+    # (callers that already assigned 'seq_counter' can skip the serialization)
+    if serialize:
+        data = process_serialize(data)
     users = defaultdict(lambda: defaultdict(list))
 
     if not len(data):
@@ -310,41 +608,15 @@ def reformat_to_nested(data):
     for entry in data:
         user_key = (entry["userid"], entry["sessionId"], entry["taskName"], entry["seq_counter"])
         process_name = entry["KM_Process"]
-        step = {
-            "type": entry["type"],
-            "text": entry["text"],
-            "title": entry["title"],  #new Field S.S
-            "url": entry["url"],
-            "description": entry["description"],
-            "image": entry["image"],
-            "width": entry.get("width"),
-            "height": entry.get("height"),
-            "offsetX": entry.get("offsetX"),
-            "offsetY": entry.get("offsetY")
-        }
-        users[user_key][process_name].append(step)
+        users[user_key][process_name].append(entry_to_step(entry))
 
     # Build the final structured list
     km_process = []
     for (userid, sessionId, taskName, seq_counter), processes in users.items():
         for name, steps in processes.items():
-            metadata = {
-                "image": "", #new Field S.S TODO
-                "name": name.split(" ", 1)[1],
-                "code" : name.split(" ", 1)[0], #new Field S.S
-                "title" : get_first_non_empty_title(steps), #new Field S.S
-                "steps": set_all_images_to_empty(steps),
-                "screenshot": get_last_non_empty_image(steps),
-            }
-            km_process.append(metadata)
+            km_process.append(build_km_process(name, steps))
 
-    return {
-        "userid": userid,
-        "sessionId": sessionId,
-        "taskName": taskName,
-        "dataShareFlowsID": "dc-" + sessionId,
-        "KM_Process": km_process
-    }
+    return build_nested_document(userid, sessionId, taskName, km_process)
 
 
 def set_all_images_to_empty(data):
@@ -409,13 +681,106 @@ def get_first_non_empty_title(data):
     return title
 
 
-def shareflows_process(share_flow_data):
-    action_list = action_mapper(share_flow_data)
+# Process labelling engines selectable in shareflows_process; all of them
+# produce the same labels.
+LABELLER_ENGINES = {
+    "trie": process_labeller,
+    "regex": process_labeller_re,
+}
+
+
+def shareflows_process(share_flow_data, columnar=False, engine="trie", fused=False, library=None,
+                       coalesce=False, memory_budget=None, spill_dir=None, flagged_entries=None):
+    """
+    Generate the nested ShareFlow document for 'share_flow_data'.
+
+    'library' is an optional process_library.ProcessLibrary whose action
+    mapping and process map replace the module defaults.
+
+    'engine' selects the process labeller from LABELLER_ENGINES. With
+    columnar=True the action types are integer-encoded and flagged, labelled
+    and serialized with NumPy array operations (see shareflow_columnar)
+    instead. With fused=True mapping, flagging, labelling, serialization and
+    grouping run in a single pass over the steps (see shareflow_stream). The
+    resulting document is identical in every mode.
+
+    With coalesce=True, runs of keystroke and scroll events are merged first
+    (see shareflow_coalesce); the processes are unchanged, with fewer steps.
+    With a 'memory_budget' as well they are merged as the steps are read.
+
+    With a 'memory_budget' (bytes) the single-pass pipeline runs with its steps
+    and segments spilling to temporary files under 'spill_dir' past the budget
+    (see shareflow_spill); 'share_flow_data' may then be an iterator. The
+    document is the same, but parts of it may be read back lazily from disk.
+
+    The entries flagged by ExceptionHandler ('Consecutive repeating type') are
+    appended to 'flagged_entries' when a list is given, in every mode.
+    """
+    patterns = library.process_map if library is not None else None
+    mapping = library.action_mapping if library is not None else None
+
+    recorder = shareflow_metrics.recorder()
+
+    if coalesce and memory_budget is not None:
+        # Coalesced lazily as the bounded pass reads the steps, so the input is never held whole
+        from shareflow_coalesce import iter_coalesce_steps
+        share_flow_data = iter_coalesce_steps(share_flow_data, mapping, patterns)
+    elif coalesce:
+        from shareflow_coalesce import coalesce_steps
+        with recorder.stage("coalesce") as stage:
+            share_flow_data = coalesce_steps(share_flow_data, mapping, patterns)
+            if recorder.enabled:
+                stage.count(events=sum(len(entry.get("steps", [])) for entry in share_flow_data))
+
+    if memory_budget is not None:
+        from shareflow_spill import shareflows_process_bounded
+        with recorder.stage("bounded") as stage:
+            nested_data, spill = shareflows_process_bounded(share_flow_data, memory_budget, patterns, mapping,
+                                                            spill_dir, flagged_entries)
+            stage.count(events=spill["events"])
+        recorder.document(nested_data)
+        return nested_data
+
+    if recorder.enabled:
+        # Payload handled by every stage, counted outside the timed stages
+        steps = [step for entry in share_flow_data for step in entry.get("steps", [])]
+        events, payload = len(steps), shareflow_metrics.payload_bytes(steps)
+        del steps
+    else:
+        events = payload = 0
+
+    if columnar or fused:
+        with recorder.stage("columnar" if columnar else "fused") as stage:
+            if columnar:
+                from shareflow_columnar import shareflows_process_columnar
+                nested_data = shareflows_process_columnar(share_flow_data, patterns, mapping, flagged_entries)
+            else:
+                from shareflow_stream import shareflows_process_fused
+                nested_data, flagged = shareflows_process_fused(share_flow_data, patterns, mapping)
+                if flagged_entries is not None:
+                    flagged_entries.extend(flagged)
+            stage.count(events, payload)
+        recorder.document(nested_data)
+        return nested_data
+
+    if engine not in LABELLER_ENGINES:
+        raise ValueError("Unknown process labeller engine: %r" % (engine,))
+
+    with recorder.stage("action_mapper") as stage:
+        action_list = action_mapper(share_flow_data, flagged_entries, mapping=mapping)
+        stage.count(events, payload)
 
     # Scan and label KM Process
-    updated_process_map_flat_data = process_labeller(action_list)
+    hits = {} if recorder.enabled else None
+    with recorder.stage("process_labeller") as stage:
+        updated_process_map_flat_data = LABELLER_ENGINES[engine](action_list, patterns, hits)
+        stage.count(events)
+    if hits is not None:
+        recorder.pattern_hits(hits)
 
     # Reformat the flat data into nested JSON
-    nested_data = reformat_to_nested(updated_process_map_flat_data)
+    with recorder.stage("reformat_to_nested") as stage:
+        nested_data = reformat_to_nested(updated_process_map_flat_data)
+        stage.count(events, payload)
+    recorder.document(nested_data)
     return nested_data
-
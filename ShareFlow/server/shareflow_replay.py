@@ -0,0 +1,533 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Capture of production traces and their offline replay with profiling.
+
+TraceCapture snapshots the batch_steps results of requests to gzip-compressed
+JSON files, anonymized so that real workload shapes can leave production:
+
+- only the entry and step fields the pipeline reads are kept; any other field
+  (e.g. 'shared') is dropped,
+- identifiers (taskName, task_name, userid, sessionId, session_id, groupid)
+  and free-text step fields are replaced by keyed pseudonyms of the same
+  length, so equal values stay equal and payload sizes are kept; empty values
+  stay empty,
+- a step 'text' is kept when its (type, text) pair is a key of the action
+  mapping, since labelling depends on it,
+- timestamps, of the entries and of their steps, are shifted so that the
+  trace starts at 0.
+
+Requests hand their results to TraceCapture.submit, which samples them and
+leaves the anonymizing and writing to a background thread.
+
+The replay command feeds captured traces back through shareflows_process at
+the requested concurrency and reports latencies and the functions the time
+went to, from cProfile or from periodic stack samples:
+
+    python shareflow_replay.py <capture dir> --concurrency 4 --profile cprofile --output replay.prof
+"""
+
+import argparse
+import copy
+import cProfile
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pstats
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+
+from shareflow_process import action_mapping, shareflows_process
+
+
+CAPTURE_FORMAT = 1
+
+# Step fields replaced by pseudonyms ('text' is kept for mapped (type, text) pairs)
+ANONYMIZED_STEP_FIELDS = ('text', 'url', 'description', 'image', 'title', 'xpath')
+ANONYMIZED_ENTRY_FIELDS = ('taskName', 'task_name', 'userid', 'sessionId', 'session_id', 'groupid')
+
+# Fields kept in a snapshot; every other field is dropped
+STEP_FIELDS = ANONYMIZED_STEP_FIELDS + (
+    'type', 'width', 'height', 'offsetX', 'offsetY', 'timestamp', 'coalesced', 'endTimestamp', 'extent',
+)
+ENTRY_FIELDS = ANONYMIZED_ENTRY_FIELDS + ('timestamp', 'steps')
+
+PROFILERS = ('cprofile', 'sample')
+
+# Seconds between two stack samples
+SAMPLE_INTERVAL = 0.005
+
+log = logging.getLogger('shareflow.replay')
+
+
+def _pseudonym(value, salt, memo):
+    if not isinstance(value, str) or not value:
+        return value
+    pseudonym = memo.get(value)
+    if pseudonym is None:
+        digest = hashlib.blake2b(value.encode('utf-8'), key=salt, digest_size=16).hexdigest()
+        pseudonym = memo[value] = (digest * (len(value) // len(digest) + 1))[:len(value)]
+    return pseudonym
+
+
+def anonymize(results, salt, mapping=None):
+    """
+    Return an anonymized copy of batch_steps 'results' (see the module docstring).
+
+    Parameters:
+    results (list): Entries with 'steps', as passed to shareflows_process.
+    salt (bytes): Key of the pseudonyms (up to 64 bytes).
+    mapping (dict): Action mapping whose (type, text) keys are kept (module default when omitted).
+    """
+    mapping = action_mapping if mapping is None else mapping
+    memo = {}
+    timestamps = [step.get('timestamp') for entry in results for step in entry.get('steps', [])]
+    timestamps.extend(entry.get('timestamp') for entry in results)
+    start = min((value for value in timestamps if isinstance(value, (int, float))), default=0)
+    anonymized = []
+    for entry in results:
+        copied = {name: value for name, value in entry.items() if name in ENTRY_FIELDS}
+        for name in ANONYMIZED_ENTRY_FIELDS:
+            if name in copied:
+                copied[name] = _pseudonym(copied[name], salt, memo)
+        if isinstance(copied.get('timestamp'), (int, float)):
+            copied['timestamp'] -= start
+        steps = []
+        for step in entry.get('steps', []):
+            step = {name: value for name, value in step.items() if name in STEP_FIELDS}
+            for name in ANONYMIZED_STEP_FIELDS:
+                if name == 'text' and (step.get('type'), step.get('text')) in mapping:
+                    continue
+                if name in step:
+                    step[name] = _pseudonym(step[name], salt, memo)
+            for name in ('timestamp', 'endTimestamp'):
+                if isinstance(step.get(name), (int, float)):
+                    step[name] -= start
+            steps.append(step)
+        copied['steps'] = steps
+        anonymized.append(copied)
+    return anonymized
+
+
+class TraceCapture:
+    """
+    Writes anonymized snapshots of batch_steps results to 'directory'.
+
+    Attributes:
+        directory (str): Where snapshots are written.
+        rate (float): Share of the requests captured.
+        max_pending (int): Snapshots submitted and not yet written, at most;
+            requests sampled beyond it are not captured.
+        captured (int): Number of snapshots written.
+        dropped (int): Number of sampled requests not captured because
+            'max_pending' snapshots were waiting.
+    """
+
+    def __init__(self, directory, rate=1.0, salt=None, max_pending=8):
+        self.directory = directory
+        self.rate = rate
+        self.max_pending = max_pending
+        self.captured = 0
+        self.dropped = 0
+        # The pseudonyms of one process are consistent across its snapshots
+        self._salt = salt if salt is not None else os.urandom(32)
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _sampled(self):
+        return self.rate >= 1 or random.random() < self.rate
+
+    def capture(self, results, library=None, route=None):
+        """
+        Snapshot 'results' fetched for a request handled with 'library'.
+
+        Returns:
+        str: Path of the snapshot, or None if the request was not sampled or
+        the snapshot could not be written (capturing never fails a request).
+        """
+        if not self._sampled():
+            return None
+        return self._write(results, library, route)
+
+    def submit(self, results, library=None, route=None):
+        """
+        Snapshot 'results' as capture() does, on the background thread. The
+        results must not change afterwards.
+
+        Returns:
+        bool: True if the request was sampled and queued.
+        """
+        if not self._sampled():
+            return False
+        try:
+            self._pending.put_nowait((results, library, route))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name='shareflow-capture', daemon=True)
+                self._thread.start()
+        return True
+
+    def join(self):
+        """Wait until the submitted snapshots are written."""
+        self._pending.join()
+
+    def _work(self):
+        while True:
+            results, library, route = self._pending.get()
+            try:
+                self._write(results, library, route)
+            except Exception:
+                log.exception("Could not capture a trace snapshot")
+            finally:
+                self._pending.task_done()
+
+    def _write(self, results, library, route):
+        captured = int(time.time() * 1000)
+        snapshot = {
+            'format': CAPTURE_FORMAT,
+            'captured': captured,
+            'route': route,
+            'library': {'name': library.name, 'version': library.version, 'tag': library.tag}
+            if library is not None else None,
+            'results': anonymize(results, self._salt, library.action_mapping if library is not None else None),
+        }
+        path = os.path.join(self.directory, '%d-%s.json.gz' % (captured, uuid.uuid4().hex[:8]))
+        try:
+            with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as handle:
+                json.dump(snapshot, handle)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            log.exception("Could not write trace snapshot %s", path)
+            return None
+        self.captured += 1
+        return path
+
+
+def load_capture(path):
+    """Return the snapshot stored at 'path' (gzip-compressed or plain JSON)."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as handle:
+        snapshot = json.load(handle)
+    if snapshot.get('format') != CAPTURE_FORMAT:
+        raise ValueError("Unsupported trace snapshot format in %s: %r" % (path, snapshot.get('format')))
+    return snapshot
+
+
+def capture_paths(paths):
+    """Expand directories in 'paths' to the snapshots they hold, in capture order."""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.endswith(('.json.gz', '.json'))))
+        else:
+            found.append(path)
+    return found
+
+
+class StackSampler:
+    """
+    Statistical profiler: samples the stack of thread 'thread_id' every
+    'interval' seconds from a background thread while active. With 'root',
+    only the frames called from that code object's frame are counted.
+
+    Attributes:
+        samples (int): Number of samples taken.
+        own (Counter): Samples per function (filename, first line, name) at the top of the stack.
+        total (Counter): Samples per function anywhere on the stack.
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL, root=None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.root = root
+        self.samples = 0
+        self.own = Counter()
+        self.total = Counter()
+        self._stop = None
+        self._thread = None
+
+    def __enter__(self):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None or self._stop.is_set():
+                # Not running, or already waiting for this thread to stop
+                continue
+            self.samples += 1
+            seen = set()
+            top = True
+            while frame is not None and frame.f_code is not self.root:
+                code = frame.f_code
+                key = (code.co_filename, code.co_firstlineno, code.co_name)
+                if top:
+                    self.own[key] += 1
+                    top = False
+                if key not in seen:
+                    seen.add(key)
+                    self.total[key] += 1
+                frame = frame.f_back
+
+
+@lru_cache(maxsize=None)
+def _registry(directory):
+    from process_library import ProcessLibraryRegistry
+
+    return ProcessLibraryRegistry(directory)
+
+
+def replay_library(snapshot, library_dir=None, library_file=None):
+    """
+    Return the process library to replay 'snapshot' with: 'library_file' when
+    given, else the captured library name and version from 'library_dir'
+    (the default library if it is missing there), else the module defaults (None).
+    """
+    if library_file:
+        from process_library import load_library
+
+        return load_library(library_file)
+    if not library_dir:
+        return None
+    registry = _registry(library_dir)
+    captured = snapshot.get('library') or {}
+    try:
+        library = registry.get(captured.get('name'), captured.get('version'))
+    except KeyError:
+        library = registry.get()
+    if captured.get('tag') and library.tag != captured['tag']:
+        log.warning("Replaying a trace captured with %s using %s", captured['tag'], library.tag)
+    return library
+
+
+def _replay_one(task):
+    path, library_dir, library_file, options, profile, interval, repeat = task
+    result = {'path': path, 'events': 0, 'timings': [], 'error': None, 'stats': None,
+              'samples': 0, 'own': None, 'total': None}
+    try:
+        snapshot = load_capture(path)
+        library = replay_library(snapshot, library_dir, library_file)
+        result['events'] = sum(len(entry.get('steps', [])) for entry in snapshot['results'])
+        profiler = cProfile.Profile() if profile == 'cprofile' else None
+        sampler = None
+        if profile == 'sample':
+            sampler = StackSampler(threading.get_ident(), interval, root=sys._getframe().f_code)
+        for _ in range(repeat):
+            # The pipeline modifies the steps it is given
+            data = copy.deepcopy(snapshot['results'])
+            start = time.perf_counter()
+            if profiler is not None:
+                profiler.enable()
+            if sampler is not None:
+                with sampler:
+                    shareflows_process(data, library=library, **options)
+            else:
+                shareflows_process(data, library=library, **options)
+            if profiler is not None:
+                profiler.disable()
+            result['timings'].append(time.perf_counter() - start)
+        if profiler is not None:
+            profiler.create_stats()
+            result['stats'] = profiler.stats
+        if sampler is not None:
+            result.update(samples=sampler.samples, own=sampler.own, total=sampler.total)
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    return result
+
+
+class _Profile:
+    """Adapts raw cProfile stats to pstats.Stats."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else None
+
+
+def replay(paths, concurrency=1, processes=False, repeat=1, profile=None, interval=SAMPLE_INTERVAL,
+           library_dir=None, library_file=None, **options):
+    """
+    Run captured traces through shareflows_process.
+
+    Parameters:
+    paths (list): Snapshot files or capture directories.
+    concurrency (int): Traces replayed at once.
+    processes (bool): Replay on worker processes instead of threads.
+    repeat (int): Runs of every trace.
+    profile (str): 'cprofile', 'sample' (see StackSampler) or None.
+    library_dir (str): Process library directory resolving the captured libraries.
+    library_file (str): Process library file used for every trace instead.
+    options: Further arguments of shareflows_process (engine, columnar, fused, coalesce).
+
+    Returns:
+    dict: 'traces', 'events', 'runs', 'errors' (path -> message), 'wall' and
+    'events_per_second', 'latency' (p50, p95, max seconds per run), and with
+    profiling 'stats' (pstats.Stats) or 'samples', 'own' and 'total' (Counters).
+    """
+    if profile not in (None,) + PROFILERS:
+        raise ValueError("Unknown profiler %r, expected one of %s" % (profile, ', '.join(PROFILERS)))
+    tasks = [(path, library_dir, library_file, options, profile, interval, repeat) for path in capture_paths(paths)]
+    executor = ProcessPoolExecutor(concurrency) if processes else ThreadPoolExecutor(concurrency)
+    start = time.perf_counter()
+    with executor:
+        results = list(executor.map(_replay_one, tasks))
+    wall = time.perf_counter() - start
+
+    timings = sorted(timing for result in results for timing in result['timings'])
+    events = sum(result['events'] * len(result['timings']) for result in results)
+    report = {
+        'traces': len(results),
+        'events': events,
+        'runs': len(timings),
+        'errors': {result['path']: result['error'] for result in results if result['error']},
+        'wall': wall,
+        'events_per_second': events / wall if wall else None,
+        'latency': {'p50': _percentile(timings, 0.5), 'p95': _percentile(timings, 0.95),
+                    'max': timings[-1] if timings else None},
+    }
+    if profile == 'cprofile':
+        profiled = [_Profile(result['stats']) for result in results if result['stats']]
+        report['stats'] = pstats.Stats(*profiled) if profiled else None
+    elif profile == 'sample':
+        report['interval'] = interval
+        report['samples'] = sum(result['samples'] for result in results)
+        report['own'] = sum((result['own'] for result in results if result['own']), Counter())
+        report['total'] = sum((result['total'] for result in results if result['total']), Counter())
+    return report
+
+
+def _function_name(key):
+    filename, line, name = key
+    return '%s:%d(%s)' % (os.path.basename(filename), line, name)
+
+
+def hotspots(report, top=20, sort='own'):
+    """
+    Return the 'top' functions of a profiled replay 'report' by 'sort' ('own'
+    or 'cumulative' time).
+
+    Returns:
+    list: {'function', 'calls', 'own', 'cumulative'}; times in seconds (estimated
+    from the sample counts for sampled replays), calls None when sampled.
+    """
+    rows = []
+    if report.get('stats') is not None:
+        for key, (_, calls, own, cumulative, _) in report['stats'].stats.items():
+            rows.append({'function': _function_name(key), 'calls': calls, 'own': own, 'cumulative': cumulative})
+    elif report.get('total'):
+        interval = report.get('interval', SAMPLE_INTERVAL)
+        for key, count in report['total'].items():
+            rows.append({'function': _function_name(key), 'calls': None,
+                         'own': report['own'].get(key, 0) * interval, 'cumulative': count * interval})
+    rows.sort(key=lambda row: row[sort], reverse=True)
+    return rows[:top]
+
+
+def _print_hotspots(rows, title, stream):
+    stream.write('\n%s\n%10s %10s %10s  %s\n' % (title, 'own s', 'cum s', 'calls', 'function'))
+    for row in rows:
+        stream.write('%10.4f %10.4f %10s  %s\n' % (row['own'], row['cumulative'],
+                                                     row['calls'] if row['calls'] is not None else '-', row['function']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay captured traces through shareflows_process.")
+    parser.add_argument('paths', nargs='+', help="snapshot files or capture directories")
+    parser.add_argument('--concurrency', type=int, default=1, help="traces replayed at once")
+    parser.add_argument('--processes', action='store_true', help="replay on processes instead of threads")
+    parser.add_argument('--repeat', type=int, default=1, help="runs of every trace")
+    parser.add_argument('--profile', choices=PROFILERS, default=None, help="profiler to run")
+    parser.add_argument('--interval', type=float, default=SAMPLE_INTERVAL, help="seconds between stack samples")
+    parser.add_argument('--top', type=int, default=20, help="functions listed per hotspot table")
+    parser.add_argument('--output', default=None,
+                        help="write the merged cProfile stats (pstats format) or the stack samples (JSON) here")
+    parser.add_argument('--library-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                              'process_libraries'),
+                        help="process library directory resolving the captured libraries")
+    parser.add_argument('--library', default=None, help="process library JSON file used for every trace")
+    parser.add_argument('--engine', default='trie', help="labeller engine (see LABELLER_ENGINES)")
+    parser.add_argument('--columnar', action='store_true', help="use the columnar pipeline")
+    parser.add_argument('--fused', action='store_true', help="use the fused pipeline")
+    parser.add_argument('--coalesce', action='store_true', help="coalesce keystroke and scroll runs")
+    args = parser.parse_args(argv)
+
+    report = replay(args.paths, args.concurrency, args.processes, args.repeat, args.profile, args.interval,
+                    args.library_dir, args.library, engine=args.engine, columnar=args.columnar,
+                    fused=args.fused, coalesce=args.coalesce)
+    out = sys.stdout
+    latency = report['latency']
+    out.write('%d traces, %d runs, %d events in %.3fs (%.0f events/s)\n' % (
+        report['traces'], report['runs'], report['events'], report['wall'], report['events_per_second'] or 0))
+    if report['runs']:
+        out.write('latency per run: p50 %.4fs p95 %.4fs max %.4fs\n' % (latency['p50'], latency['p95'], latency['max']))
+    for path, error in report['errors'].items():
+        out.write('error in %s: %s\n' % (path, error))
+
+    if args.profile:
+        if args.profile == 'sample':
+            out.write('%d stack samples every %gs\n' % (report['samples'], args.interval))
+        _print_hotspots(hotspots(report, args.top, 'own'), 'Hotspots by own time', out)
+        _print_hotspots(hotspots(report, args.top, 'cumulative'), 'Hotspots by cumulative time', out)
+    if args.output:
+        if report.get('stats') is not None:
+            report['stats'].dump_stats(args.output)
+        elif args.profile == 'sample':
+            with open(args.output, 'w') as handle:
+                json.dump({'interval': args.interval, 'samples': report['samples'], 'functions': [
+                    {'function': _function_name(key), 'own': report['own'].get(key, 0), 'total': count}
+                    for key, count in report['total'].most_common()]}, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Projection, pagination, validators and streamed encoding of recording.read
+responses.
+
+A read can select fields (?fields=), page through the KM_Process entries of
+its ShareFlow (?offset=, ?limit=) and revalidate with If-None-Match. The ETag
+is derived from the document version (session, record range, fingerprint of
+the events and process library version) and the requested variant, so it can
+be checked before the ShareFlow is generated or encoded. Bodies are encoded
+in chunks with iter_json instead of as one string.
+
+Field paths are dotted (KM_Process.steps.url). A path whose first name is not a
+field of the response (RESPONSE_FIELDS) is looked up in the ShareFlow document
+'dc', and a name without a dot continues the parent of the previous path, so
+'KM_Process.name,code,title' selects three fields of every KM_Process entry.
+A leading dot starts again from the top (KM_Process.name,.taskName).
+
+Every body also carries a 'version' token. A client watching a live recording
+passes it back as ?since= and gets only what changed since then:
+
+- 'steps': the events after the first 'stepsFrom' it already has,
+- 'dc.KM_Process': the entries from index 'dc.KM_ProcessFrom' on, which
+  replace the client's entries from there. When the first one continues the
+  client's last entry, it only has the steps after its 'stepsFrom'.
+
+The token is stateless: it holds the number of events and KM_Process entries
+the client has, digests of its last event and last few entries and the
+process library version. Closed entries before those are never re-sent. When
+the client's copy cannot be verified (older events changed, another library)
+the full body is sent with 'reset' set.
+"""
+
+import base64
+import hashlib
+import json
+from collections.abc import Sequence
+
+
+# Fields of a recording.read body
+RESPONSE_FIELDS = ('taskName', 'sessionId', 'timestamp', 'steps', 'task_name', 'session_id',
+                   'userid', 'groupid', 'shared', 'dc', 'version')
+
+# Fields describing a page or delta, kept whatever fields are selected
+CONTROL_FIELDS = ('page', 'version', 'since', 'reset', 'stepsFrom')
+
+# Number of trailing KM_Process entries a version token can verify
+TOKEN_WINDOW = 4
+
+# Size of the chunks yielded by iter_json, in characters
+CHUNK_SIZE = 64 * 1024
+
+
+class ResponseOptionsError(ValueError):
+    """Raised for malformed fields, offset, limit or since parameters."""
+
+
+def parse_fields(spec):
+    """
+    Parse a ?fields= value into a selection tree.
+
+    Returns:
+    dict: {name: subtree}, where a subtree of None selects the whole value.
+    """
+    tree = {}
+    parent = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if item.startswith('.'):
+            path = item[1:].split('.')
+        elif '.' in item:
+            path = item.split('.')
+        else:
+            path = parent + [item]
+        if not all(path):
+            raise ResponseOptionsError("Invalid field path: %r" % item)
+        if path[0] not in RESPONSE_FIELDS:
+            path = ['dc'] + path
+        parent = path[:-1]
+        _select(tree, path)
+    if not tree:
+        raise ResponseOptionsError("No fields selected")
+    return tree
+
+
+def _select(tree, path):
+    node = tree
+    for name in path[:-1]:
+        if name in node and node[name] is None:
+            # An ancestor is already selected whole
+            return
+        node = node.setdefault(name, {})
+    node[path[-1]] = None
+
+
+def project(value, tree):
+    """Return the parts of 'value' selected by 'tree' (see parse_fields); lists are projected per item."""
+    if tree is None:
+        return value
+    if isinstance(value, dict):
+        return {name: project(item, tree[name]) for name, item in value.items() if name in tree}
+    if _is_array(value):
+        return [project(item, tree) for item in value]
+    return value
+
+
+def paginate(body, offset=0, limit=None):
+    """
+    Return a copy of 'body' with only the KM_Process entries offset..offset+limit
+    of its ShareFlow, and a 'page' field {'offset', 'limit', 'total'}.
+    """
+    dc = body.get('dc')
+    processes = (dc or {}).get('KM_Process') or []
+    stop = len(processes) if limit is None else offset + limit
+    body = dict(body)
+    if dc is not None:
+        body['dc'] = {**dc, 'KM_Process': processes[offset:stop]}
+    body['page'] = {'offset': offset, 'limit': limit, 'total': len(processes)}
+    return body
+
+
+def _digest(value):
+    encoded = json.dumps(value, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.blake2b(encoded, digest_size=8).hexdigest()
+
+
+def _entry_digest(process):
+    return _digest([process.get('code'), process.get('name'), len(process.get('steps') or ())])
+
+
+def _head_digest(process):
+    return _digest([process.get('code'), process.get('name')])
+
+
+def version_token(body, library_version=None):
+    """
+    Return the version token of 'body' (see delta).
+
+    Parameters:
+    body (dict): A full recording.read body.
+    library_version (str): Tag of the process library the ShareFlow was built with.
+    """
+    steps = body.get('steps') or []
+    processes = (body.get('dc') or {}).get('KM_Process') or []
+    last = processes[-1] if processes else {}
+    state = [
+        library_version,
+        len(steps), _digest(steps[-1]) if steps else None,
+        len(processes), [_entry_digest(process) for process in processes[-TOKEN_WINDOW:-1]],
+        _head_digest(last), len(last.get('steps') or ()),
+    ]
+    encoded = json.dumps(state, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(encoded).decode('ascii').rstrip('=')
+
+
+def _decode_token(token):
+    try:
+        state = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        library_version, events, event_digest, count, closed, head, steps = state
+        if not (isinstance(events, int) and isinstance(count, int) and isinstance(steps, int)
+                and isinstance(closed, list) and min(events, count, steps) >= 0):
+            raise ValueError(token)
+    except (TypeError, ValueError):
+        raise ResponseOptionsError("Invalid since token")
+    return library_version, events, event_digest, count, closed, head, steps
+
+
+def delta(body, since, library_version=None):
+    """
+    Return what changed in 'body' since the version token 'since'.
+
+    Returns:
+    dict: The record fields of 'body' with 'steps' after 'stepsFrom', 'dc' with
+    the KM_Process entries from 'KM_ProcessFrom' on, 'since', 'reset' (True
+    when the client must replace its copy) and the new 'version'.
+    """
+    library_version_since, events, event_digest, count, closed, head, last_steps = _decode_token(since)
+    steps = body.get('steps') or []
+    dc = body.get('dc')
+    processes = (dc or {}).get('KM_Process') or []
+
+    # Events and labels before the client's last event are assumed unchanged
+    # as long as that event is still in place
+    reset = (library_version_since != library_version or events > len(steps) or count > len(processes)
+             or (events and _digest(steps[events - 1]) != event_digest))
+    first, steps_from = 0, None
+    if not reset and count:
+        first = count - 1
+        start = count - 1 - len(closed)
+        for i, digest in enumerate(closed, start):
+            if _entry_digest(processes[i]) != digest:
+                first = i
+                # Entries before the window may have changed too
+                reset = i == start and start > 0
+                break
+        else:
+            last = processes[count - 1]
+            if _head_digest(last) == head and len((last.get('steps') or ())) >= last_steps:
+                steps_from = last_steps
+    if reset:
+        events, first, steps_from = 0, 0, None
+
+    result = {name: value for name, value in body.items() if name not in ('steps', 'dc', 'version')}
+    result['steps'] = steps[events:]
+    result['stepsFrom'] = events
+    if dc is not None:
+        entries = processes[first:]
+        if steps_from is not None and entries:
+            entries[0] = {**entries[0], 'steps': entries[0]['steps'][steps_from:], 'stepsFrom': steps_from}
+        result['dc'] = {**dc, 'KM_Process': entries, 'KM_ProcessFrom': first}
+    else:
+        result['dc'] = None
+    result['since'] = since
+    result['reset'] = bool(reset)
+    result['version'] = version_token(body, library_version)
+    return result
+
+
+class ReadOptions:
+    """
+    The representation of a recording.read body requested by a client.
+
+    Attributes:
+        fields (dict): Selection tree (see parse_fields), or None for every field.
+        offset (int): First KM_Process entry returned.
+        limit (int): Most KM_Process entries returned, or None for all.
+        since (str): Version token the client already has, or None.
+    """
+
+    def __init__(self, fields=None, offset=0, limit=None, since=None):
+        self.fields = fields
+        self.offset = offset
+        self.limit = limit
+        self.since = since
+
+    @classmethod
+    def from_params(cls, params):
+        """Build the options from request parameters (fields, offset, limit, since)."""
+        fields = parse_fields(params['fields']) if params.get('fields') else None
+        try:
+            offset = int(params.get('offset') or 0)
+            limit = int(params['limit']) if params.get('limit') else None
+        except ValueError:
+            raise ResponseOptionsError("offset and limit must be integers")
+        if offset < 0 or (limit is not None and limit < 1):
+            raise ResponseOptionsError("offset must be >= 0 and limit >= 1")
+        since = params.get('since') or None
+        if since is not None:
+            _decode_token(since)
+            if offset or limit is not None:
+                raise ResponseOptionsError("since cannot be combined with offset or limit")
+        return cls(fields, offset, limit, since)
+
+    @property
+    def paged(self):
+        return bool(self.offset) or self.limit is not None
+
+    def apply(self, body, library_version=None):
+        """
+        Return 'body' as a delta (with 'since') or with its version token,
+        paged and projected; the body itself is not modified.
+        """
+        if not isinstance(body, dict):
+            return body
+        if self.since is not None:
+            body = delta(body, self.since, library_version)
+        else:
+            body = {**body, 'version': version_token(body, library_version)}
+        if self.paged:
+            body = paginate(body, self.offset, self.limit)
+        if self.fields is not None:
+            projected = project(body, self.fields)
+            for name in CONTROL_FIELDS:
+                if name in body:
+                    projected[name] = body[name]
+            if isinstance(projected.get('dc'), dict) and 'KM_ProcessFrom' in body['dc']:
+                projected['dc']['KM_ProcessFrom'] = body['dc']['KM_ProcessFrom']
+            body = projected
+        return body
+
+    def variant(self):
+        return [self.fields, self.offset, self.limit, self.since]
+
+
+def etag(version, options=None):
+    """
+    Return the entity tag of a body.
+
+    Parameters:
+    version: Identifies the document, e.g. ShareFlowCache.key(); JSON-encodable.
+    options (ReadOptions): The requested variant.
+    """
+    variant = options.variant() if options is not None else None
+    encoded = json.dumps([version, variant], sort_keys=True, default=str)
+    return hashlib.blake2b(encoded.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def iter_json(value, chunk_size=CHUNK_SIZE):
+    """
+    Encode 'value' as json.dumps would, yielding UTF-8 chunks of about
+    'chunk_size' characters.
+
+    Containers are walked so that the whole text is never built at once; dicts
+    holding no containers (steps, for instance) are encoded with one call.
+    Sequences other than lists (e.g. spilled KM_Process lists) are encoded as
+    lists, item by item.
+    """
+    buffer = []
+    size = 0
+    for part in _iter_parts(value):
+        buffer.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+def _is_array(value):
+    # Lists, and sequences standing in for them such as shareflow_spill.SpillList
+    return isinstance(value, (list, tuple)) or (
+        isinstance(value, Sequence) and not isinstance(value, (str, bytes, bytearray)))
+
+
+def _iter_parts(value):
+    if isinstance(value, dict):
+        if not any(isinstance(item, dict) or _is_array(item) for item in value.values()):
+            yield json.dumps(value)
+            return
+        yield '{'
+        first = True
+        for name, item in value.items():
+            # Non-string keys are written as their JSON text, as json.dumps does
+            key = name if isinstance(name, str) else json.dumps(name)
+            yield ('' if first else ', ') + json.dumps(key) + ': '
+            first = False
+            yield from _iter_parts(item)
+        yield '}'
+    elif _is_array(value):
+        yield '['
+        for i, item in enumerate(value):
+            if i:
+                yield ', '
+            yield from _iter_parts(item)
+        yield ']'
+    else:
+        yield json.dumps(value)
@@ -0,0 +1,483 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+In-process full-text search over recordings and ShareFlows.
+
+SearchIndex is an inverted index over two kinds of documents:
+
+- 'record': a UserEventRecord (task_name, description, target_uri, session_id),
+- 'process': one KM_Process of a generated ShareFlow (its code, name and title
+  and the text, description, title and url of its steps).
+
+Both carry the userid, groupid and shared fields of their recording, which
+queries can filter on. A query matches the documents containing all of its
+tokens and returns the k best by a BM25-style score.
+
+Every document keeps the impacts of its tokens (the BM25 term weights,
+quantized to 1..255); every token keeps its postings as arrays of document ids
+and impacts, ordered by decreasing impact. A query scans the postings of its
+tokens in parallel and stops as soon as no unseen document can beat the k-th
+best score (Fagin's threshold algorithm), so it reads a few entries per token
+instead of every match. Queries whose smallest posting list or filter set is small are scored
+exhaustively instead.
+
+Updates only touch the postings of the document's tokens. Postings are rebuilt
+lazily, once the documents added or removed since they were built are a
+sizeable share of them; documents added in the meantime are scored up front.
+"""
+
+import heapq
+import itertools
+import math
+import re
+import sys
+import threading
+from array import array
+
+
+# Field weights of the two document kinds
+RECORD_FIELDS = {'task_name': 2.0, 'description': 1.0, 'target_uri': 0.5, 'session_id': 1.0}
+PROCESS_FIELDS = {'name': 2.0, 'code': 2.0, 'title': 1.5, 'text': 1.0, 'description': 1.0, 'url': 0.5}
+
+# Fields returned with the results of the two document kinds
+RECORD_RESULT = ('task_name', 'description', 'target_uri', 'session_id', 'userid', 'groupid', 'shared')
+PROCESS_RESULT = ('process', 'code', 'name', 'title', 'steps', 'session_id', 'userid', 'groupid', 'shared')
+
+# Fields queries can filter on
+FILTER_FIELDS = ('kind', 'userid', 'groupid', 'shared', 'session_id')
+
+# Queries whose smallest candidate set is at most this large are scored exhaustively
+EXHAUSTIVE_LIMIT = 1024
+
+# BM25 parameters; document lengths are normalized by a fixed reference length
+# so that impacts do not change as the index grows
+K1 = 1.2
+B = 0.75
+REFERENCE_LENGTH = 16.0
+
+# Term weights lie in (0, K1 + 1) and are stored as impacts 1..IMPACT_LEVELS
+IMPACT_LEVELS = 255
+
+# Filter values with at most this many documents keep them in a list, not a set
+SMALL_FILTER = 16
+
+_token = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the lower-cased word tokens of 'text'."""
+    if not text:
+        return []
+    return _token.findall(str(text).lower())
+
+
+def _impacts(fields, boosts):
+    counts = {}
+    length = 0
+    for name, boost in boosts.items():
+        for token in tokenize(fields.get(name)):
+            counts[token] = counts.get(token, 0.0) + boost
+            length += 1
+    norm = K1 * (1 - B + B * length / REFERENCE_LENGTH)
+    # Tokens are interned, so the documents sharing one share its string
+    return (
+        tuple(sys.intern(token) for token in counts),
+        bytes(max(1, round(IMPACT_LEVELS * tf / (tf + norm))) for tf in counts.values()),
+    )
+
+
+def _field(record, name):
+    if isinstance(record, dict):
+        return record.get(name)
+    return getattr(record, name, None)
+
+
+def _add_member(members, document):
+    if isinstance(members, list) and len(members) >= SMALL_FILTER:
+        members = set(members)
+    if isinstance(members, list):
+        members.append(document)
+    else:
+        members.add(document)
+    return members
+
+
+class _Postings:
+    """
+    Documents containing a token. The impacts themselves are kept with the
+    documents; entries of removed documents are dropped at the next rebuild.
+    """
+
+    __slots__ = ('count', 'documents', 'impacts', 'added', 'stale')
+
+    def __init__(self):
+        # Number of indexed documents containing the token
+        self.count = 0
+        # Documents by decreasing impact, and their impacts, as of the last rebuild
+        self.documents = array('q')
+        self.impacts = array('B')
+        # Documents added since the last rebuild, and entries removed since
+        self.added = array('q')
+        self.stale = 0
+
+    def needs_rebuild(self):
+        return len(self.added) + self.stale > max(64, len(self.documents) // 8)
+
+
+class _Allowed:
+    """Documents passing a query's filters: in every 'required' set and, if any, in one 'any_of' set."""
+
+    __slots__ = ('required', 'any_of')
+
+    def __init__(self, required, any_of):
+        self.required = sorted(required, key=len)
+        self.any_of = any_of
+
+    def size(self):
+        sizes = []
+        if self.required:
+            sizes.append(len(self.required[0]))
+        if self.any_of:
+            sizes.append(sum(len(members) for members in self.any_of))
+        return min(sizes)
+
+    def members(self):
+        if self.required and (not self.any_of or len(self.required[0]) <= self.size()):
+            return self.required[0]
+        return set().union(*self.any_of)
+
+    def __contains__(self, document):
+        for members in self.required:
+            if document not in members:
+                return False
+        if self.any_of:
+            for members in self.any_of:
+                if document in members:
+                    return True
+            return False
+        return True
+
+
+class SearchIndex:
+    """
+    Inverted index of recordings and ShareFlow processes. Thread-safe; queries
+    and updates are serialized by a lock.
+    """
+
+    def __init__(self, exhaustive_limit=EXHAUSTIVE_LIMIT):
+        self.exhaustive_limit = exhaustive_limit
+        self._postings = {}
+        # (filter field, value) -> documents, see _add_member
+        self._filters = {}
+        # Internal document id -> (kind, record id, result values, tokens, impacts, filter values)
+        self._documents = {}
+        # Record id -> ids of its documents
+        self._by_record = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def add_record(self, rid, record):
+        """Index (or re-index) the UserEventRecord 'record' stored under 'rid'."""
+        fields = {name: _field(record, name) for name in RECORD_FIELDS}
+        filters = self._filter_values('record', record)
+        values = (fields['task_name'], fields['description'], fields['target_uri'], filters[4],
+                  filters[1], filters[2], filters[3])
+        tokens, impacts = _impacts(fields, RECORD_FIELDS)
+        with self._lock:
+            self._remove_kind(rid, 'record')
+            self._put('record', rid, values, tokens, impacts, filters)
+
+    def add_shareflow(self, rid, record, document):
+        """
+        Index the KM_Process list of the ShareFlow 'document' generated for
+        record 'rid', replacing the processes indexed for it before.
+        """
+        filters = self._filter_values('process', record)
+        processes = []
+        for i, process in enumerate((document or {}).get('KM_Process') or ()):
+            steps = process.get('steps') or ()
+            fields = {
+                'name': process.get('name'),
+                'code': process.get('code'),
+                'title': ' '.join(filter(None, [process.get('title')] + [step.get('title') for step in steps])),
+                'text': ' '.join(filter(None, (step.get('text') for step in steps))),
+                'description': ' '.join(filter(None, (step.get('description') for step in steps))),
+                'url': ' '.join(filter(None, (step.get('url') for step in steps))),
+            }
+            values = (i, process.get('code'), process.get('name'), process.get('title'), len(steps),
+                      filters[4], filters[1], filters[2], filters[3])
+            processes.append((values,) + _impacts(fields, PROCESS_FIELDS))
+        with self._lock:
+            self._remove_kind(rid, 'process')
+            for values, tokens, impacts in processes:
+                self._put('process', rid, values, tokens, impacts, filters)
+
+    def remove(self, rid):
+        """Drop the record 'rid' and the processes of its ShareFlow."""
+        with self._lock:
+            for document in list(self._by_record.get(rid, ())):
+                self._remove(document)
+
+    def remove_shareflows(self, session_id):
+        """Drop the processes of the ShareFlows of 'session_id', e.g. when new events make them stale."""
+        with self._lock:
+            for document in list(self._filters.get(('session_id', session_id), ())):
+                if self._documents[document][0] == 'process':
+                    self._remove(document)
+
+    def optimize(self):
+        """Rebuild every ordered posting list, e.g. after a bulk load."""
+        with self._lock:
+            ordered = {}
+            for document, (_, _, _, tokens, impacts, _) in self._documents.items():
+                for token, impact in zip(tokens, impacts):
+                    ordered.setdefault(token, []).append((-impact, document))
+            for token, entries in ordered.items():
+                self._store_ordered(self._postings[token], entries)
+
+    @staticmethod
+    def _filter_values(kind, record):
+        shared = _field(record, 'shared')
+        # In FILTER_FIELDS order
+        return (kind, _field(record, 'userid'), _field(record, 'groupid'),
+                int(shared) if shared is not None else None, _field(record, 'session_id'))
+
+    def _put(self, kind, rid, values, tokens, impacts, filters):
+        document = self._next_id
+        self._next_id += 1
+        self._documents[document] = (kind, rid, values, tokens, impacts, filters)
+        self._by_record.setdefault(rid, []).append(document)
+        for token in tokens:
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = _Postings()
+            postings.count += 1
+            postings.added.append(document)
+        for name, value in zip(FILTER_FIELDS, filters):
+            key = (name, value)
+            self._filters[key] = _add_member(self._filters.get(key, []), document)
+
+    def _remove_kind(self, rid, kind):
+        for document in [document for document in self._by_record.get(rid, ())
+                         if self._documents[document][0] == kind]:
+            self._remove(document)
+
+    def _remove(self, document):
+        _, rid, _, tokens, _, filters = self._documents.pop(document)
+        documents = self._by_record[rid]
+        documents.remove(document)
+        if not documents:
+            del self._by_record[rid]
+        for token in tokens:
+            postings = self._postings[token]
+            postings.count -= 1
+            postings.stale += 1
+            if not postings.count:
+                del self._postings[token]
+        for name, value in zip(FILTER_FIELDS, filters):
+            members = self._filters[(name, value)]
+            members.remove(document)
+            if not members:
+                del self._filters[(name, value)]
+
+    def _rebuild(self, token, postings):
+        entries = []
+        for source in (postings.documents, postings.added):
+            for document in source:
+                entry = self._documents.get(document)
+                if entry is not None:
+                    entries.append((-entry[4][entry[3].index(token)], document))
+        self._store_ordered(postings, entries)
+
+    @staticmethod
+    def _store_ordered(postings, entries):
+        entries.sort()
+        postings.documents = array('q', [document for _, document in entries])
+        postings.impacts = array('B', [-negative for negative, _ in entries])
+        postings.added = array('q')
+        postings.stale = 0
+
+    def search(self, query, k=10, visible_to=None, **filters):
+        """
+        Return the k best documents containing every token of 'query'.
+
+        Parameters:
+        query (str): Query text; tokenized like the documents.
+        k (int): Number of results.
+        visible_to (str): When given, only shared documents and those of this userid.
+        filters: Exact values of FILTER_FIELDS (kind, userid, groupid, shared, session_id);
+            None values are ignored.
+
+        Returns:
+        list: {'kind', 'record_id', 'score', ...result fields} by decreasing score.
+        """
+        unknown = set(filters) - set(FILTER_FIELDS)
+        if unknown:
+            raise ValueError("Unknown search filter(s): %s" % ', '.join(sorted(unknown)))
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens or k <= 0:
+            return []
+
+        with self._lock:
+            lists = []
+            for token in tokens:
+                postings = self._postings.get(token)
+                if postings is None:
+                    return []
+                lists.append(postings)
+            allowed = self._allowed(filters, visible_to)
+            if allowed is not None and allowed.size() == 0:
+                return []
+            total = len(self._documents)
+            idfs = [math.log(1 + (total - p.count + 0.5) / (p.count + 0.5)) for p in lists]
+            terms = list(zip(tokens, idfs))
+
+            smallest = min(lists, key=lambda postings: postings.count)
+            ranked = None
+            if smallest.count > self.exhaustive_limit and (
+                    allowed is None or allowed.size() > self.exhaustive_limit):
+                ranked = self._threshold(tokens, lists, terms, allowed, k, smallest.count)
+            if ranked is None:
+                ranked = self._exhaustive(smallest, terms, allowed, k)
+            return [self._result(document, score) for score, document in ranked]
+
+    def _allowed(self, filters, visible_to):
+        empty = ()
+        required = [self._filters.get((name, value), empty) for name, value in filters.items() if value is not None]
+        any_of = None
+        if visible_to is not None:
+            any_of = [self._filters.get(('shared', 1), empty), self._filters.get(('userid', visible_to), empty)]
+        if not required and any_of is None:
+            return None
+        return _Allowed(required, any_of)
+
+    def _score(self, document, terms):
+        entry = self._documents.get(document)
+        if entry is None:
+            return None
+        tokens, impacts = entry[3], entry[4]
+        score = 0.0
+        for token, idf in terms:
+            if token not in tokens:
+                return None
+            score += idf * impacts[tokens.index(token)]
+        return score
+
+    def _exhaustive(self, smallest, terms, allowed, k):
+        if allowed is not None and allowed.size() < smallest.count:
+            candidates = allowed.members()
+        else:
+            candidates = itertools.chain(smallest.documents, smallest.added)
+        score_of = self._score
+        scored = []
+        for document in candidates:
+            if allowed is not None and document not in allowed:
+                continue
+            score = score_of(document, terms)
+            if score is not None:
+                scored.append((score, -document))
+        return [(score, -negative) for score, negative in heapq.nlargest(k, scored)]
+
+    def _threshold(self, tokens, lists, terms, allowed, k, budget):
+        """
+        Top-k by the threshold algorithm, or None once it has read 'budget'
+        entries, when scoring the smallest candidate set is cheaper (few
+        documents contain all tokens).
+        """
+        for token, postings in zip(tokens, lists):
+            if postings.needs_rebuild():
+                self._rebuild(token, postings)
+        # (score, -document) of the best documents so far, as a min-heap
+        best = []
+        seen = set()
+
+        def consider(document):
+            seen.add(document)
+            if allowed is not None and document not in allowed:
+                return
+            score = self._score(document, terms)
+            if score is None:
+                return
+            if len(best) < k:
+                heapq.heappush(best, (score, -document))
+            elif (score, -document) > best[0]:
+                heapq.heapreplace(best, (score, -document))
+
+        # Documents added since an ordered list was built are not in it, so they
+        # are scored up front; the threshold below bounds every other document
+        for postings in lists:
+            for document in postings.added:
+                if document not in seen:
+                    consider(document)
+
+        # Every match contains all tokens, so once one list is exhausted every
+        # match has been seen
+        depth = 0
+        end = min(len(postings.documents) for postings in lists)
+        while depth < end:
+            threshold = 0.0
+            for postings, (_, idf) in zip(lists, terms):
+                # Entries of removed documents still bound the impacts below them
+                threshold += idf * postings.impacts[depth]
+                document = postings.documents[depth]
+                if document not in seen:
+                    consider(document)
+            # An unseen document scoring the threshold could still win the tie-break on its id
+            if len(best) == k and best[0][0] > threshold:
+                break
+            depth += 1
+            if depth * len(lists) >= budget:
+                return None
+        return sorted(((score, -negative) for score, negative in best), key=lambda item: (-item[0], item[1]))
+
+    def _result(self, document, score):
+        kind, rid, values, _, _, _ = self._documents[document]
+        names = RECORD_RESULT if kind == 'record' else PROCESS_RESULT
+        return {'kind': kind, 'record_id': rid, 'score': round(score / IMPACT_LEVELS, 6), **dict(zip(names, values))}
+
+
+def populate(index, records, documents=None):
+    """
+    Add 'records' and, with a document store (see shareflow_materialize), their
+    stored ShareFlows to 'index'.
+
+    Returns:
+    SearchIndex: 'index'.
+    """
+    from shareflow_materialize import record_id
+
+    for record in records:
+        rid = record_id(record)
+        index.add_record(rid, record)
+        if documents is not None:
+            stored = documents.get(rid)
+            if stored is not None:
+                index.add_shareflow(rid, record, stored[2])
+    index.optimize()
+    return index
@@ -0,0 +1,368 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Memory-bounded ShareFlow generation.
+
+shareflows_process_bounded runs the single-pass pipeline of shareflow_stream
+within a memory budget, so a session of hours of events with screenshots does
+not have to fit in memory. The input entries may be an iterator, and their
+'steps' too. The steps of the open KM_Process segments and the finished
+segments are kept in SpillLists. Once the estimated size of what they hold in
+memory exceeds the budget, the largest lists are pickled to temporary files and
+dropped from memory until half of the budget is free again.
+
+The document returned has SpillLists in place of the lists of the staged
+pipeline wherever something was spilled. They iterate, index and slice like
+lists and are read back lazily, e.g. by shareflow_response.iter_json while the
+response is streamed. A document that stayed within the budget only has plain
+lists, and equals the one of shareflows_process.
+
+hold_steps keeps the steps fetched for a request within a budget the same way,
+so they can be streamed back into the response and the pipeline.
+
+The spill files of a document share a temporary directory, removed once the
+document is no longer referenced. Pickling a document (to return it from a
+worker process, for instance) hands the directory over to the unpickled copy.
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+import weakref
+from array import array
+from collections.abc import Sequence
+
+from shareflow_process import build_km_process
+from shareflow_stream import IncrementalShareFlow
+
+
+# Estimated bytes of a step dictionary besides its strings
+STEP_OVERHEAD = 700
+
+# Live spill directories, by path
+_directories = weakref.WeakValueDictionary()
+
+
+def _step_bytes(step):
+    return STEP_OVERHEAD + sum(len(value) for value in step.values() if isinstance(value, str))
+
+
+class SpillDirectory:
+    """Temporary directory of the spill files of one document, removed with it."""
+
+    def __init__(self, parent=None, path=None):
+        self.path = path if path is not None else tempfile.mkdtemp(prefix='shareflow-spill-', dir=parent)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+        _directories[self.path] = self
+
+    def new_file(self):
+        handle, path = tempfile.mkstemp(suffix='.pickle', dir=self.path)
+        os.close(handle)
+        return path
+
+    def __reduce__(self):
+        # Pickled for another process: the unpickled copy removes the directory
+        self._finalizer.detach()
+        return _adopt_directory, (self.path,)
+
+
+def _adopt_directory(path):
+    directory = _directories.get(path)
+    if directory is None:
+        return SpillDirectory(path=path)
+    if not directory._finalizer.alive:
+        directory._finalizer = weakref.finalize(directory, shutil.rmtree, path, True)
+    return directory
+
+
+def _live_directory(path):
+    return _directories[path]
+
+
+class _Pickler(pickle.Pickler):
+    """Pickler of spill files; the directory of the document is referenced, not handed over."""
+
+    def reducer_override(self, obj):
+        if isinstance(obj, SpillDirectory):
+            return _live_directory, (obj.path,)
+        return NotImplemented
+
+
+class MemoryBudget:
+    """
+    Estimated bytes held in memory by a set of SpillLists, and the limit past
+    which the largest of them are spilled.
+
+    Attributes:
+        limit (int): Budget in bytes.
+        used (int): Estimated bytes held in memory.
+        spills (int): Number of times a list was spilled.
+        spilled_bytes (int): Estimated bytes moved to disk.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.spills = 0
+        self.spilled_bytes = 0
+        self._lists = {}
+
+    def track(self, spill_list):
+        self._lists[id(spill_list)] = spill_list
+
+    def forget(self, spill_list):
+        self._lists.pop(id(spill_list), None)
+
+    def charge(self, nbytes):
+        self.used += nbytes
+        if self.used > self.limit:
+            self._relieve()
+
+    def release(self, nbytes):
+        self.used -= nbytes
+
+    def _relieve(self):
+        for spill_list in sorted(self._lists.values(), key=lambda item: item.nbytes, reverse=True):
+            if self.used <= self.limit // 2 or not spill_list.nbytes:
+                break
+            self.spills += 1
+            self.spilled_bytes += spill_list.nbytes
+            spill_list.spill()
+
+
+class SpillList(Sequence):
+    """
+    Append-only sequence whose items can be moved to a pickle file in
+    'directory'. Spilled items always precede the ones held in memory.
+
+    Attributes:
+        nbytes (int): Estimated bytes of the items held in memory ('size' of each).
+    """
+
+    def __init__(self, directory, budget=None, size=_step_bytes):
+        self.directory = directory
+        self.budget = budget
+        self.size = size
+        self.nbytes = 0
+        self._items = []
+        self._path = None
+        # Start of every spilled item in the file, then the end of the last one
+        self._offsets = array('q', [0])
+        if budget is not None:
+            budget.track(self)
+
+    @property
+    def spilled(self):
+        """Number of items in the spill file."""
+        return len(self._offsets) - 1
+
+    def append(self, item, nbytes=None):
+        self._items.append(item)
+        nbytes = self.size(item) if nbytes is None else nbytes
+        self.nbytes += nbytes
+        if self.budget is not None:
+            self.budget.charge(nbytes)
+
+    def spill(self):
+        """Move the items held in memory to the spill file."""
+        if not self._items:
+            return
+        if self._path is None:
+            self._path = self.directory.new_file()
+        with open(self._path, 'ab') as handle:
+            pickler = _Pickler(handle, pickle.HIGHEST_PROTOCOL)
+            for item in self._items:
+                pickler.dump(item)
+                # Every item is loaded on its own
+                pickler.clear_memo()
+                self._offsets.append(handle.tell())
+        self._items = []
+        if self.budget is not None:
+            self.budget.release(self.nbytes)
+        self.nbytes = 0
+
+    def detach(self):
+        """Stop counting this list against its budget; it no longer grows."""
+        if self.budget is not None:
+            self.budget.forget(self)
+            self.budget.release(self.nbytes)
+            self.budget = None
+
+    def __len__(self):
+        return self.spilled + len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("SpillList index out of range")
+        if index >= self.spilled:
+            return self._items[index - self.spilled]
+        with open(self._path, 'rb') as handle:
+            handle.seek(self._offsets[index])
+            return pickle.loads(handle.read(self._offsets[index + 1] - self._offsets[index]))
+
+    def __iter__(self):
+        if self.spilled:
+            with open(self._path, 'rb') as handle:
+                for _ in range(self.spilled):
+                    yield pickle.load(handle)
+        yield from list(self._items)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, SpillList)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return '<SpillList of %d items, %d spilled>' % (len(self), self.spilled)
+
+    def __getstate__(self):
+        self.spill()
+        self.detach()
+        return {'directory': self.directory, 'path': self._path, 'offsets': self._offsets.tobytes()}
+
+    def __setstate__(self, state):
+        self.directory = state['directory']
+        self._path = state['path']
+        self._offsets = array('q')
+        self._offsets.frombytes(state['offsets'])
+        self.budget = None
+        self.size = _step_bytes
+        self.nbytes = 0
+        self._items = []
+
+
+class _SegmentSteps(SpillList):
+    """Steps of an open KM_Process segment, stored as build_km_process leaves them."""
+
+    def __init__(self, directory, budget):
+        super().__init__(directory, budget)
+        # First non-empty title, as get_first_non_empty_title
+        self.title = ''
+
+    def append(self, step, nbytes=None):
+        nbytes = _step_bytes(step)
+        if not self.title and step.get('title'):
+            self.title = step['title']
+        # As set_all_images_to_empty, which build_km_process applies again harmlessly
+        if step.get('image'):
+            step['screenshot'] = step.get('image')
+        step['image'] = ''
+        super().append(step, nbytes)
+
+
+class BoundedShareFlow(IncrementalShareFlow):
+    """
+    IncrementalShareFlow whose steps and segments spill to disk past 'budget'
+    bytes (see the module docstring). Flagged entries are only kept with
+    flags=True, and update() and close() do not return the segments; they are
+    in km_process.
+    """
+
+    def __init__(self, budget, patterns=None, mapping=None, directory=None, flags=False):
+        super().__init__(patterns, mapping, flags=flags)
+        self.budget = MemoryBudget(budget)
+        self.directory = SpillDirectory(directory)
+        self.km_process = SpillList(self.directory, self.budget)
+
+    def _new_steps(self):
+        return _SegmentSteps(self.directory, self.budget)
+
+    def _flush(self):
+        for steps in self._open.values():
+            if steps.spilled:
+                # The whole segment goes to disk; only its metadata stays. The
+                # images are cleared before build_km_process picks the last
+                # one, so the screenshot is always empty
+                steps.spill()
+                steps.detach()
+                segment = build_km_process(self._label, [])
+                segment.update(title=steps.title, steps=steps)
+                nbytes = STEP_OVERHEAD
+            else:
+                nbytes = steps.nbytes
+                steps.detach()
+                segment = build_km_process(self._label, steps._items)
+            self.km_process.append(segment, nbytes)
+        self._open = {}
+        return []
+
+
+def shareflows_process_bounded(share_flow_data, budget, patterns=None, mapping=None, directory=None,
+                               flagged_entries=None):
+    """
+    Memory-bounded equivalent of shareflows_process (see the module docstring).
+
+    Parameters:
+    share_flow_data (iterable): Entries ('taskName', 'userid', 'sessionId', 'steps'); both the
+        entries and their steps may be iterators.
+    budget (int): Estimated bytes of steps held in memory before spilling.
+    directory (str): Where the spill directory is created (default: the system temporary directory).
+    flagged_entries (list): When given, the flagged repeated entries are appended to it.
+
+    Returns:
+    tuple: (nested document, {'events', 'spills', 'spilled_bytes'}).
+    """
+    processor = BoundedShareFlow(budget, patterns, mapping, directory, flags=flagged_entries is not None)
+    for entry in share_flow_data:
+        processor.update((entry,))
+    processor.close()
+    if flagged_entries is not None:
+        flagged_entries.extend(processor.flagged_entries)
+    document = processor.document()
+    if document is not None and not processor.budget.spills:
+        # Nothing was spilled: the same plain lists as shareflows_process
+        document['KM_Process'] = list(processor.km_process)
+    processor.km_process.detach()
+    return document, {
+        'events': processor.event_count,
+        'spills': processor.budget.spills,
+        'spilled_bytes': processor.budget.spilled_bytes,
+    }
+
+
+def hold_steps(steps, budget, directory=None):
+    """
+    Read the iterable 'steps' into a sequence keeping about 'budget' bytes of
+    them in memory at most: a list when they fit, otherwise a SpillList whose
+    earlier steps are read back from a spill file under 'directory'.
+    """
+    held = SpillList(SpillDirectory(directory), MemoryBudget(budget))
+    for step in steps:
+        held.append(step)
+    held.detach()
+    if not held.spilled:
+        return held._items
+    return held
+
+
+def is_spilled(document):
+    """Return True if parts of the ShareFlow 'document' are kept on disk."""
+    return bool(document) and isinstance(document.get('KM_Process'), SpillList)
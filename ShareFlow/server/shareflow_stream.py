@@ -0,0 +1,216 @@
+"""
+Copyright (c) 2024, Centre for Learning Analytics at Monash (CoLAM).
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Incremental ShareFlow generation for live sessions.
+
+IncrementalShareFlow accepts the events of a session in batches, in the same
+shape shareflows_process takes, and labels them as soon as enough lookahead is
+available: the label of an event is final once the longest process_map pattern
+fits after it. KM_Process segments are emitted as soon as the label changes
+again, so the work done per batch is proportional to the new events only.
+
+Feeding a whole session through update() followed by close() produces the same
+KM_Process list as shareflows_process; shareflows_process_fused does exactly
+that as a single-pass execution mode of the pipeline.
+"""
+
+import copy
+
+from shareflow_process import (
+    action_mapping,
+    build_km_process,
+    build_nested_document,
+    entry_to_step,
+    get_process_matcher,
+    map_action_type,
+    match_process_at,
+    process_map,
+    step_to_action,
+)
+
+
+class IncrementalShareFlow:
+    """
+    Stateful, incremental equivalent of shareflows_process for one session.
+
+    Attributes:
+        km_process (list): Finalized KM_Process segments, in document order.
+        flagged_entries (list): Entries flagged as 'Consecutive repeating type',
+            as returned by ExceptionHandler.
+        event_count (int): Number of events received so far.
+
+    With flags=False the repeated entries are not kept in flagged_entries.
+    """
+
+    def __init__(self, patterns=None, mapping=None, flags=True):
+        if patterns is None:
+            patterns = process_map
+        self._root = get_process_matcher(patterns)
+        self._lookahead = max((len(value) for value in patterns.values()), default=1)
+        self._mapping = action_mapping if mapping is None else mapping
+        self._flags = flags
+
+        self._pending = []          # mapped entries waiting for enough lookahead
+        self._prev_pattern = None   # label inherited by unmatched entries
+        self._previous_type = None  # raw type, for repeat flagging
+        self._label = None          # label of the open seq_counter group
+        self._seq_counter = 0
+        self._open = {}             # (userid, sessionId, taskName) -> steps
+        self._last_key = None
+        self.closed = False
+
+        self.km_process = []
+        self.flagged_entries = []
+        self.event_count = 0
+
+    def update(self, share_flow_data):
+        """
+        Add a batch of entries ('taskName', 'userid', 'sessionId', 'steps').
+
+        Returns:
+        list: KM_Process segments finalized by this batch.
+        """
+        if self.closed:
+            raise ValueError("Cannot update a closed IncrementalShareFlow")
+        emitted = []
+        pending = self._pending
+        # Label in batches of at least one lookahead window
+        threshold = 2 * self._lookahead
+        for data in share_flow_data:
+            task_name = data.get('taskName', 'No taskName')
+            userid = data.get('userid', '')
+            sessionId = data.get('sessionId', '')
+            for step in data.get('steps', []):
+                entry = step_to_action(userid, sessionId, task_name, step)
+                if entry.type == self._previous_type and self._flags:
+                    self.flagged_entries.append({
+                        'index': self.event_count,
+                        'taskName': task_name,
+                        'type': entry.type,
+                        'flag': 'Consecutive repeating type'
+                    })
+                self._previous_type = entry.type
+                self.event_count += 1
+                entry.type = map_action_type(entry.type, entry.text, self._mapping)
+                pending.append(entry)
+                if len(pending) >= threshold:
+                    emitted.extend(self._advance(final=False))
+        emitted.extend(self._advance(final=False))
+        return emitted
+
+    def close(self):
+        """
+        Label the remaining entries and close the last segment.
+
+        Returns:
+        list: KM_Process segments finalized by closing the session.
+        """
+        if self.closed:
+            return []
+        emitted = self._advance(final=True)
+        emitted.extend(self._flush())
+        self.closed = True
+        return emitted
+
+    def document(self):
+        """
+        Return the nested ShareFlow document for the events received so far,
+        as shareflows_process would build it. The pending entries and the open
+        segment are labelled provisionally; the processor itself is not changed.
+        """
+        if self.closed:
+            processor = self
+        else:
+            processor = copy.copy(self)
+            processor._pending = list(self._pending)
+            processor._open = {
+                key: [dict(step) for step in steps] for key, steps in self._open.items()
+            }
+            processor.km_process = list(self.km_process)
+            processor.flagged_entries = list(self.flagged_entries)
+            processor.close()
+        if processor._last_key is None:
+            return None
+        return build_nested_document(*processor._last_key, processor.km_process)
+
+    def _advance(self, final):
+        emitted = []
+        pending = self._pending
+        types = [entry['type'] for entry in pending]
+        n = len(pending)
+        i = 0
+        while i < n and (final or n - i >= self._lookahead):
+            match = match_process_at(self._root, types, i)
+            if match is not None:
+                pattern_length, label = match
+                for k in range(i, i + pattern_length):
+                    self._assign(pending[k], label, emitted)
+                self._prev_pattern = label
+                i += pattern_length
+            else:
+                self._assign(pending[i], self._prev_pattern if self._prev_pattern else "NO MATCH", emitted)
+                i += 1
+        del pending[:i]
+        return emitted
+
+    def _assign(self, entry, label, emitted):
+        if label != self._label:
+            emitted.extend(self._flush())
+            self._seq_counter += 1
+            self._label = label
+        key = (entry['userid'], entry['sessionId'], entry['taskName'])
+        steps = self._open.get(key)
+        if steps is None:
+            # reformat_to_nested reports the identifiers of the last group created
+            steps = self._open[key] = self._new_steps()
+            self._last_key = key
+        steps.append(entry_to_step(entry))
+
+    def _new_steps(self):
+        return []
+
+    def _flush(self):
+        segments = [build_km_process(self._label, steps) for steps in self._open.values()]
+        self._open = {}
+        self.km_process.extend(segments)
+        return segments
+
+
+def shareflows_process_fused(share_flow_data, patterns=None, mapping=None):
+    """
+    Single-pass equivalent of shareflows_process.
+
+    Every step is mapped, flagged, labelled (with a bounded lookahead),
+    serialized and grouped as it streams through an IncrementalShareFlow,
+    without the intermediate full-length lists of the staged pipeline.
+
+    Returns:
+    tuple: (nested document, flagged entries as returned by ExceptionHandler).
+    """
+    processor = IncrementalShareFlow(patterns, mapping)
+    processor.update(share_flow_data)
+    processor.close()
+    return processor.document(), processor.flagged_entries
@@ -0,0 +1,100 @@
+"""
+Tests of the versioned process libraries (process_library).
+"""
+
+import json
+import os
+import shutil
+
+import pytest
+
+from process_library import ProcessLibraryRegistry, builtin_library, load_library
+from shareflow_process import action_mapping, process_map
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_LIBRARY = os.path.join(HERE, 'process_libraries', 'default-v1.json')
+
+
+@pytest.fixture
+def directory(tmp_path):
+    shutil.copy(DEFAULT_LIBRARY, str(tmp_path / 'default-v1.json'))
+    return tmp_path
+
+
+def _touch(path, content):
+    path.write_text(content)
+    stat = os.stat(str(path))
+    # A distinct mtime even on coarse-grained file systems
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_invalid_file_keeps_previous_version(directory):
+    registry = ProcessLibraryRegistry(str(directory), reload_interval=0)
+    library = registry.get()
+    _touch(directory / 'default-v1.json', '{"name": "default", "vers')
+    assert registry.resolve('group', 'task') is library
+    assert registry.get() is library
+    # Fixing the file loads it again
+    document = json.loads(open(DEFAULT_LIBRARY).read())
+    _touch(directory / 'default-v1.json', json.dumps(document, indent=1))
+    assert registry.reload() == ['default@1']
+    assert registry.get() is not library
+
+
+def test_invalid_new_file_is_skipped(directory):
+    registry = ProcessLibraryRegistry(str(directory), reload_interval=0)
+    (directory / 'broken-v1.json').write_text('[')
+    assert registry.reload() == []
+    assert registry.names() == ['default']
+
+
+def test_cached_matcher(directory, tmp_path_factory, monkeypatch):
+    import process_library
+
+    compiled = []
+    compile_process_map = process_library.compile_process_map
+    monkeypatch.setattr(process_library, 'compile_process_map',
+                        lambda process_map: compiled.append(1) or compile_process_map(process_map))
+    cache_dir = tmp_path_factory.mktemp('cache')
+    path = str(directory / 'default-v1.json')
+    load_library(path, str(cache_dir))
+    load_library(path, str(cache_dir))
+    assert len(compiled) == 1
+
+    # A file that does not record the library hash is not unpickled, and is replaced
+    cached, = cache_dir.iterdir()
+    cached.write_bytes(b'not a matcher')
+    load_library(path, str(cache_dir))
+    assert len(compiled) == 2
+    assert cached.read_bytes().startswith(cached.name.split('.')[0].encode('ascii'))
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason="POSIX permissions")
+def test_cached_matcher_writable_by_others_is_ignored(directory, tmp_path_factory, monkeypatch):
+    cache_dir = tmp_path_factory.mktemp('cache')
+    load_library(str(directory / 'default-v1.json'), str(cache_dir))
+    os.chmod(str(cache_dir), 0o777)
+    import process_library
+
+    loads = []
+    monkeypatch.setattr(process_library.pickle, 'loads', lambda data: loads.append(data))
+    load_library(str(directory / 'default-v1.json'), str(cache_dir))
+    assert loads == []
+
+
+def test_missing_default_falls_back_to_builtin_library(tmp_path):
+    _touch(tmp_path / 'default-v1.json', '{"name": "default", "vers')
+    registry = ProcessLibraryRegistry(str(tmp_path), reload_interval=0)
+    library = registry.get()
+    assert library is builtin_library()
+    assert library.process_map is process_map and library.action_mapping is action_mapping
+    assert registry.resolve('group', 'task') is library
+    with pytest.raises(KeyError):
+        registry.get('other')
+    with pytest.raises(KeyError):
+        registry.get(version=1)
+    # The default library is used once it loads
+    shutil.copy(DEFAULT_LIBRARY, str(tmp_path / 'default-v1.json'))
+    _touch(tmp_path / 'default-v1.json', open(DEFAULT_LIBRARY).read())
+    assert registry.get().key == 'default@1'
@@ -0,0 +1,64 @@
+"""
+Tests of the content-addressed screenshot store (screenshot_store).
+"""
+
+import base64
+import hashlib
+import os
+import threading
+
+import pytest
+
+from screenshot_store import REF_PREFIX, ScreenshotStore, is_image_ref, store_step_images
+
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 32
+
+
+def _files(root):
+    return sorted(os.path.join(path, name) for path, _, names in os.walk(root) for name in names)
+
+
+def test_put_and_get(tmp_path):
+    store = ScreenshotStore(str(tmp_path))
+    ref = store.put(base64.b64encode(PNG).decode())
+    assert ref == REF_PREFIX + hashlib.sha256(PNG).hexdigest() and is_image_ref(ref)
+    assert ref in store
+    assert store.get(ref) == (PNG, 'image/png')
+    # Data URLs decode to the same frame
+    assert store.put('data:image/png;base64,' + base64.b64encode(PNG).decode()) == ref
+    assert store.writes == 1 and store.deduplicated == 1
+    # References and empty values are returned as they are
+    assert store.put(ref) == ref and store.put('') == '' and store.put(None) is None
+
+
+def test_unknown_references(tmp_path):
+    store = ScreenshotStore(str(tmp_path))
+    for ref in ('sha256:' + '0' * 64, 'sha256:../../etc/passwd', 'not-a-ref'):
+        assert ref not in store
+        with pytest.raises(KeyError):
+            store.get(ref)
+    with pytest.raises(ValueError):
+        store.put('not base64!')
+
+
+def test_concurrent_writes_leave_one_complete_blob(tmp_path):
+    store = ScreenshotStore(str(tmp_path), remember=0)
+    data = os.urandom(1 << 20)
+    refs = []
+    threads = [threading.Thread(target=lambda: refs.append(store.put_bytes(data))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(refs)) == 1
+    # No temporary file is left behind, and the blob is whole
+    assert [os.path.basename(path) for path in _files(str(tmp_path))] == [refs[0][len(REF_PREFIX):]]
+    assert store.get(refs[0])[0] == data
+
+
+def test_store_step_images(tmp_path):
+    store = ScreenshotStore(str(tmp_path))
+    steps = [{'image': base64.b64encode(PNG).decode()}, {'image': '***'}, {'image': ''}, {}]
+    store_step_images(steps, store)
+    assert steps == [{'image': REF_PREFIX + hashlib.sha256(PNG).hexdigest()}, {'image': ''}, {'image': ''}, {}]
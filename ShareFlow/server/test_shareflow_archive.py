@@ -0,0 +1,64 @@
+"""
+Tests of the columnar event archive (shareflow_archive): an export read back
+and imported into an event store gives the stored events again.
+"""
+
+import base64
+import os
+import random
+import types
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from event_store import SQLiteEventStore, iter_record_steps
+from shareflow_archive import EventArchive, import_archive, write_archive
+from shareflow_ingest import synthetic_messages, trace_to_user_event
+
+
+def _events(seed):
+    rng = random.Random(seed)
+    events = [trace_to_user_event(message) for message in synthetic_messages(2000, sessions=6, seed=seed)]
+    frames = [base64.b64encode(rng.randbytes(rng.randrange(1, 4000))).decode() for _ in range(20)]
+    for event in events:
+        # Screenshots repeat across events and sessions
+        event['image'] = rng.choice(frames + [None, 'sha256:' + '0' * 64])
+    events[0].update(extent=[1.0, 2.0, 3.0, 4.0], coalesced=5, end_timestamp=events[0]['timestamp'] + 9)
+    return events, frames
+
+
+def _steps(store, session_id):
+    record = types.SimpleNamespace(session_id=session_id, userid=None, startstamp=0, endstamp=2 ** 62)
+    return list(iter_record_steps(store, record, page_size=100))
+
+
+def test_export_import_round_trip(tmp_path):
+    for seed in range(3):
+        events, frames = _events(seed)
+        path = str(tmp_path / str(seed))
+        meta = write_archive(path, events)
+        assert meta['events'] == len(events)
+        assert not any(name.endswith('.raw') for name in os.listdir(path))
+
+        archive = EventArchive(path)
+        # Each distinct screenshot is stored once
+        assert len(archive.strings['image']) == len({event['image'] for event in events} - {None})
+        assert sum(len(frame) for frame in frames) <= archive.strings['image'].offsets[-1]
+
+        source = SQLiteEventStore()
+        source.add(events)
+        imported = SQLiteEventStore()
+        assert import_archive(archive, imported, batch_size=333) == len(events)
+        for session_id in archive.sessions():
+            expected = _steps(source, session_id)
+            assert _steps(archive, session_id) == expected
+            assert _steps(imported, session_id) == expected
+
+
+def test_empty_archive(tmp_path):
+    path = str(tmp_path)
+    assert write_archive(path, [])['events'] == 0
+    archive = EventArchive(path)
+    assert archive.sessions() == []
+    assert import_archive(archive, SQLiteEventStore()) == 0
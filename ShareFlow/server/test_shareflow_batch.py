@@ -0,0 +1,53 @@
+"""
+Tests of the multi-session batch pipeline (shareflow_batch).
+"""
+
+import copy
+import json
+
+from shareflow_batch import main, shareflows_process_many
+from shareflow_benchmark import synthetic_trace
+from shareflow_process import shareflows_process
+
+
+def _data():
+    data = []
+    for seed in range(6):
+        for entry in synthetic_trace(200, seed=seed, sessions=2, image_rate=0):
+            data.append({**entry, 'sessionId': 'session-%d-%s' % (seed % 4, entry['sessionId'])})
+    # A session that fails on its own
+    data.insert(3, {'taskName': 'T', 'userid': 'u', 'sessionId': 'broken', 'steps': 5})
+    return data
+
+
+def _expected(data):
+    sessions = {}
+    for entry in data:
+        sessions.setdefault(entry['sessionId'], []).append(entry)
+    return sessions
+
+
+def test_results_keep_session_order_and_errors():
+    data = _data()
+    sessions = _expected(data)
+    for processes, chunksize in ((1, 16), (2, 1), (3, 2)):
+        results = shareflows_process_many(copy.deepcopy(data), processes=processes, chunksize=chunksize)
+        assert [result['sessionId'] for result in results] == list(sessions)
+        for result in results:
+            if result['sessionId'] == 'broken':
+                assert result['dc'] is None and result['error'].startswith('TypeError')
+            else:
+                assert result['error'] is None
+                assert result['dc'] == shareflows_process(copy.deepcopy(sessions[result['sessionId']]))
+
+
+def test_command_line(tmp_path, capsys):
+    data = _data()
+    path = tmp_path / 'entries.jsonl'
+    path.write_text(''.join(json.dumps(entry) + '\n' for entry in data))
+    output = tmp_path / 'results.jsonl'
+    assert main([str(path), '--output', str(output), '--processes', '2']) == 1
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert results == shareflows_process_many(copy.deepcopy(data), processes=1)
+    counts = json.loads(capsys.readouterr().err)
+    assert (counts['sessions'], counts['errors']) == (len(results), 1)
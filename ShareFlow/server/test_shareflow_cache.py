@@ -0,0 +1,91 @@
+"""
+Tests of the ShareFlow document cache (shareflow_cache).
+"""
+
+import json
+import random
+import types
+
+from shareflow_cache import ShareFlowCache, StepFingerprint, fingerprint_steps
+
+
+def _record(session_id='s1', startstamp=0, endstamp=100):
+    return types.SimpleNamespace(session_id=session_id, startstamp=startstamp, endstamp=endstamp)
+
+
+def _document(size):
+    return {'KM_Process': 'x' * size}
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ShareFlowCache(max_entries=2)
+    cache.put('a', _document(1))
+    cache.put('b', _document(1))
+    assert cache.get('a') == _document(1)
+    cache.put('c', _document(1))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.stats()['evictions'] == 1 and cache.stats()['entries'] == 2
+
+
+def test_entries_are_evicted_past_the_byte_limit():
+    size = len(json.dumps(_document(100)))
+    cache = ShareFlowCache(max_bytes=2 * size + 1)
+    for key in 'abc':
+        cache.put(key, _document(100))
+    assert [cache.get(key) is not None for key in 'abc'] == [False, True, True]
+    assert cache.stats()['bytes'] == 2 * size
+    # Replacing an entry does not count its old size
+    cache.put('c', _document(100))
+    assert cache.stats()['bytes'] == 2 * size
+    # A document larger than the cache is not cached and evicts nothing
+    cache.put('d', _document(1000))
+    assert cache.get('d') is None and cache.stats()['entries'] == 2
+
+
+def test_invalidate_drops_overlapping_ranges():
+    cache = ShareFlowCache()
+    keys = [
+        ShareFlowCache.key(_record('s1', 0, 100), [], 'v'),
+        ShareFlowCache.key(_record('s1', 200, 300), [], 'v'),
+        ShareFlowCache.key(_record('s2', 0, 100), [], 'v'),
+    ]
+    for key in keys:
+        cache.put(key, _document(1))
+    assert cache.invalidate('s1', 50) == 1
+    assert cache.get(keys[0]) is None and cache.get(keys[1]) is not None
+    assert cache.invalidate('s1', 150, 199) == 0
+    assert cache.invalidate('s1', 150, 250) == 1
+    cache.put(keys[0], _document(1))
+    assert cache.invalidate('s2') == 1
+    assert [cache.get(key) is not None for key in keys] == [True, False, False]
+    assert cache.stats()['invalidations'] == 3
+
+
+def test_get_or_compute_is_keyed_by_events_and_version():
+    cache = ShareFlowCache()
+    calls = []
+
+    def compute(results):
+        calls.append(results)
+        return _document(len(calls))
+
+    results = [{'steps': [{'type': 'click', 'timestamp': 1}]}]
+    first = cache.get_or_compute(_record(), results, compute, version='v1')
+    assert cache.get_or_compute(_record(), results, compute, version='v1') is first
+    cache.get_or_compute(_record(), results, compute, version='v2')
+    cache.get_or_compute(_record(), [{'steps': [{'type': 'click', 'timestamp': 2}]}], compute, version='v1')
+    assert len(calls) == 3
+
+
+def test_step_fingerprint_matches_fingerprint_steps():
+    rng = random.Random(0)
+    for _ in range(50):
+        steps = [{'type': rng.choice(['click', 'scroll']), 'timestamp': rng.randrange(100), 'text': None}
+                 for _ in range(rng.randrange(20))]
+        fingerprint = StepFingerprint()
+        assert list(fingerprint.steps(iter(steps))) == steps
+        assert fingerprint.hexdigest() == fingerprint_steps([{'steps': steps}])
+        # Reading the digest does not end the fingerprint
+        fingerprint.update({'type': 'click'})
+        assert fingerprint.hexdigest() == fingerprint_steps([{'steps': steps + [{'type': 'click'}]}])
@@ -0,0 +1,98 @@
+"""
+Tests of keystroke and scroll run coalescing (shareflow_coalesce): labels and
+processes must be the same as without coalescing.
+"""
+
+import copy
+import json
+import random
+
+import shareflow_spill
+from shareflow_benchmark import synthetic_trace
+from shareflow_coalesce import coalesce_steps, coalescible_actions
+from shareflow_process import action_mapper, process_labeller, process_serialize, shareflows_process
+from shareflow_response import iter_json
+
+
+def _labels(entries):
+    return process_serialize(process_labeller(action_mapper(copy.deepcopy(entries))))
+
+
+def _runs_trace(seed, events=300):
+    # Long runs of keystrokes and scroll ticks on a few targets, between other actions
+    rng = random.Random(seed)
+    steps = []
+    while len(steps) < events:
+        event_type = rng.choice(['keydown', 'keyup', 'scroll', 'click', 'navigate', 'select'])
+        target = rng.choice(['/a', '/b'])
+        for _ in range(rng.randint(1, 12) if event_type in ('keydown', 'keyup', 'scroll') else 1):
+            steps.append({'type': event_type, 'text': rng.choice(['', 'x', 'Search']), 'url': 'https://e.test' + target,
+                          'xpath': target, 'offsetX': rng.random(), 'offsetY': rng.random()})
+    return [{'taskName': 't', 'userid': 'u', 'sessionId': 's', 'steps': steps}]
+
+
+def _traces():
+    for seed in range(60):
+        yield synthetic_trace(random.Random(seed).randrange(5, 400), seed=seed, image_rate=0)
+        yield _runs_trace(seed)
+
+
+def test_coalescing_keeps_labels():
+    coalesced_any = False
+    for trace in _traces():
+        for i, step in enumerate(trace[0]['steps']):
+            step['timestamp'] = i
+        coalesced = coalesce_steps(trace)
+        coalesced_any |= len(coalesced[0]['steps']) < len(trace[0]['steps'])
+
+        # Every surviving event (a summary carries the timestamp of the first
+        # event it stands for) has the label and seq_counter it had before
+        before = dict(enumerate(_labels(trace)))
+        for step, entry in zip(coalesced[0]['steps'], _labels(coalesced)):
+            original = before[step['timestamp']]
+            assert (entry['KM_Process'], entry['seq_counter']) == (original['KM_Process'], original['seq_counter'])
+
+        expected = shareflows_process(copy.deepcopy(trace))
+        document = shareflows_process(copy.deepcopy(trace), coalesce=True)
+        assert [(p['code'], p['name'], p['title']) for p in document['KM_Process']] == \
+            [(p['code'], p['name'], p['title']) for p in expected['KM_Process']]
+    assert coalesced_any
+
+
+def test_input_is_not_modified():
+    trace = _runs_trace(1)
+    original = copy.deepcopy(trace)
+    coalesce_steps(trace)
+    assert trace == original
+
+
+def test_repeated_actions_are_not_coalesced():
+    patterns = {'X1 typing': ['Type', 'Type', 'Click'], 'X2 scrolling': ['Scroll', 'Click']}
+    assert coalescible_actions(patterns) == ('Scroll',)
+    trace = [{'taskName': 't', 'userid': 'u', 'sessionId': 's',
+              'steps': [{'type': 'keydown', 'text': 'a', 'url': 'u', 'xpath': 'x'}] * 6}]
+    assert len(coalesce_steps(trace, process_map=patterns)[0]['steps']) == 6
+
+
+def test_bounded_coalescing_streams(tmp_path, monkeypatch):
+    trace = _runs_trace(2, events=2000)
+    expected = json.loads(b''.join(iter_json(shareflows_process(copy.deepcopy(trace), coalesce=True))))
+
+    read = []
+
+    def steps():
+        for step in copy.deepcopy(trace[0]['steps']):
+            read.append(step)
+            yield step
+
+    # Nothing is read (and coalesced) ahead of the bounded pass
+    bounded = shareflow_spill.shareflows_process_bounded
+    started = []
+    monkeypatch.setattr(shareflow_spill, 'shareflows_process_bounded',
+                        lambda *args: started.append(len(read)) or bounded(*args))
+
+    entries = iter([{**trace[0], 'steps': steps()}])
+    document = shareflows_process(entries, coalesce=True, memory_budget=4096, spill_dir=str(tmp_path))
+    assert started == [0]
+    assert len(read) == len(trace[0]['steps'])
+    assert json.loads(b''.join(iter_json(document))) == expected
@@ -0,0 +1,56 @@
+"""
+Tests of the columnar pipeline (shareflow_columnar) against the staged one.
+"""
+
+import copy
+import random
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from shareflow_benchmark import synthetic_trace
+from shareflow_columnar import shareflows_process_columnar
+from shareflow_process import action_mapper, reformat_to_nested, process_labeller, shareflows_process
+
+
+def _staged(data):
+    flagged = []
+    document = reformat_to_nested(process_labeller(action_mapper(copy.deepcopy(data), flagged)))
+    return document, flagged
+
+
+def _mixed_entries(seed):
+    # Several entries, alternating identifiers, sparse fields and empty entries
+    rng = random.Random(seed)
+    trace = synthetic_trace(rng.randint(1, 400), seed=seed, sessions=rng.randint(1, 4), image_rate=0.3)
+    entries = []
+    for i, entry in enumerate(trace):
+        steps = entry['steps']
+        for step in steps:
+            for name in ('text', 'title', 'width', 'image'):
+                if rng.random() < 0.1:
+                    step.pop(name, None)
+            if rng.random() < 0.05:
+                step['image'] = None
+        cut = rng.randint(0, len(steps))
+        task = rng.choice(['t1', 't2'])
+        entries.append({'taskName': task, 'userid': 'u%d' % (i % 2), 'sessionId': 's', 'steps': steps[:cut]})
+        entries.append({'taskName': task, 'userid': 'u%d' % (i % 2), 'sessionId': 's', 'steps': []})
+        entries.append({'taskName': 't1', 'userid': 'u0', 'sessionId': 's', 'steps': steps[cut:]})
+    return entries
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_columnar_matches_staged(seed):
+    data = _mixed_entries(seed)
+    expected, expected_flagged = _staged(data)
+    flagged = []
+    assert shareflows_process_columnar(copy.deepcopy(data), flagged_entries=flagged) == expected
+    assert flagged == expected_flagged
+    assert shareflows_process(copy.deepcopy(data), columnar=True) == expected
+
+
+def test_empty():
+    assert shareflows_process_columnar([]) is None
+    assert shareflows_process_columnar([{'taskName': 't', 'steps': []}]) is None
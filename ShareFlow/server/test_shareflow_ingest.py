@@ -0,0 +1,143 @@
+"""
+Tests of TraceData bulk ingestion (shareflow_ingest).
+"""
+
+import json
+
+import pytest
+
+from event_store import SQLiteEventStore
+from shareflow_ingest import (
+    BulkIngester,
+    EventValidationError,
+    IdempotentResponses,
+    parse_messages,
+    trace_to_user_event,
+)
+
+
+def _message(**fields):
+    return {'messageType': 'TraceData', 'type': 'click', 'timestamp': 1, 'userid': 'u1', 'sessionId': 's1', **fields}
+
+
+def test_events_are_stored_under_the_authenticated_user():
+    assert trace_to_user_event(_message(userid=None), userid='u1')['userid'] == 'u1'
+    assert trace_to_user_event(_message(), userid='u1')['userid'] == 'u1'
+    with pytest.raises(EventValidationError):
+        trace_to_user_event(_message(userid='u2'), userid='u1')
+    with pytest.raises(EventValidationError):
+        trace_to_user_event(_message(userid='u2'), {'userid': 'u1'}, userid='u1')
+
+    store = SQLiteEventStore()
+    summary = BulkIngester(store).ingest([_message(), _message(userid='u2', timestamp=2)], userid='u1')
+    assert (summary['accepted'], summary['rejected']) == (1, 1)
+    events, _ = store.fetch_page('s1', 'u2', 0, 10)
+    assert events == []
+
+
+def test_idempotent_responses_are_scoped_to_the_user():
+    responses = IdempotentResponses()
+    responses.put('u1', 'k', {'accepted': 1})
+    assert responses.get('u1', 'k') == {'accepted': 1}
+    assert responses.get('u2', 'k') is None
+
+
+class _FailingStore(SQLiteEventStore):
+    def __init__(self, fail_after):
+        super().__init__()
+        self.fail_after = fail_after
+
+    def add(self, events, keys=None):
+        if self.fail_after == 0:
+            raise RuntimeError('store down')
+        self.fail_after -= 1
+        return super().add(events, keys)
+
+
+class _Documents:
+    def __init__(self):
+        self.deleted = []
+
+    def delete_session(self, session_id):
+        self.deleted.append(session_id)
+
+
+def test_written_sessions_are_invalidated_when_a_batch_fails():
+    documents = _Documents()
+    ingester = BulkIngester(_FailingStore(fail_after=1), documents=documents, batch_size=2)
+    messages = [_message(sessionId='s%d' % (i // 2), timestamp=i) for i in range(8)]
+    with pytest.raises(RuntimeError):
+        ingester.ingest(messages)
+    assert 's0' in documents.deleted
+
+
+def test_coalescing_options_are_resolved_per_request():
+    calls = []
+
+    def options(task_name):
+        calls.append(task_name)
+        return {}
+
+    ingester = BulkIngester(SQLiteEventStore(), coalesce=options)
+    messages = [_message(type='keydown', target='/html/body/input', timestamp=i, taskName=task, sessionId=task)
+                for task in ('T1', 'T2') for i in range(1, 6)]
+    summary = ingester.ingest(messages)
+    assert sorted(calls) == ['T1', 'T2'] and summary['coalesced'] > 0
+    ingester.ingest([_message(taskName='T1')])
+    assert sorted(calls) == ['T1', 'T1', 'T2']
+
+
+def test_validation():
+    event = trace_to_user_event(_message(timestamp='12', offsetX=3, width=2.0, textContent='Search'))
+    assert (event['timestamp'], event['offset_x'], event['width']) == (12, 3.0, 2)
+    assert event['event_type'] == 'click' and event['text_content'] == 'Search'
+    invalid = [
+        'not an object',
+        _message(messageType='Other'),
+        _message(timestamp=None),
+        _message(sessionId=''),
+        _message(type=5),
+        _message(timestamp=True),
+        _message(offsetX='left'),
+    ]
+    for message in invalid:
+        with pytest.raises(EventValidationError):
+            trace_to_user_event(message)
+
+
+def test_aliases():
+    event = trace_to_user_event(_message(url='https://a.test', xpath='/html', clientX=1, clientY=2,
+                                         event_type='scroll', unknown='dropped'))
+    fields = (event['base_url'], event['x_path'], event['offset_x'], event['offset_y'])
+    assert fields == ('https://a.test', '/html', 1.0, 2.0)
+    assert event['event_type'] == 'scroll' and 'unknown' not in event
+    assert trace_to_user_event(_message(baseURL='https://b.test'))['base_url'] == 'https://b.test'
+    # Defaults fill in what the message leaves out
+    assert trace_to_user_event(_message(), {'task_name': 'T'})['task_name'] == 'T'
+
+
+def test_parse_messages():
+    messages = [_message(timestamp=i) for i in range(3)]
+    assert list(parse_messages(json.dumps(messages))) == messages
+    assert list(parse_messages(json.dumps(messages[0]).encode('utf-8'))) == messages[:1]
+    ndjson = '\n'.join(json.dumps(message) for message in messages) + '\n\n'
+    assert list(parse_messages(ndjson)) == messages
+    assert list(parse_messages(json.dumps(messages[0]), 'application/x-ndjson')) == messages[:1]
+    # An invalid line is reported in its place
+    parsed = list(parse_messages(ndjson + '{"type": \n'))
+    assert parsed[:3] == messages and isinstance(parsed[3], EventValidationError)
+
+    summary = BulkIngester(SQLiteEventStore()).ingest(parse_messages(ndjson + '{"type": \n'))
+    assert (summary['accepted'], summary['rejected'], summary['errors'][0]['index']) == (3, 1, 3)
+
+
+def test_retried_messages_are_stored_once():
+    store = SQLiteEventStore()
+    ingester = BulkIngester(store, batch_size=2)
+    messages = [_message(timestamp=i) for i in range(5)] + [_message(timestamp=0), _message(eventId='e1')]
+    summary = ingester.ingest(messages)
+    assert (summary['accepted'], summary['duplicates'], summary['stored']) == (6, 1, 6)
+    # A retried request stores nothing new; a changed event with the same eventId neither
+    summary = ingester.ingest(messages + [_message(eventId='e1', timestamp=9)])
+    assert (summary['accepted'], summary['duplicates'], summary['stored']) == (6, 2, 0)
+    assert store.count() == 6
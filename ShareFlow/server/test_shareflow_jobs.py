@@ -0,0 +1,65 @@
+"""
+Tests of the ShareFlow job state transitions (shareflow_jobs).
+"""
+
+import sys
+import threading
+import time
+
+from shareflow_jobs import DONE, FINISHED_STATES, TIMEOUT, ShareFlowJob, ShareFlowJobQueue
+
+
+def test_finished_state_is_final():
+    # Jobs completing at their deadline while their state is polled: whichever
+    # of the completion and the timeout happens first, the other never overrides it
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for i in range(300):
+            _run_polled(ShareFlowJob(i, time.sleep, (0.001,), timeout=0.001))
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+
+def _run_polled(job):
+    seen = []
+
+    def poll():
+        while not job._done.is_set():
+            seen.append(job.state)
+        seen.append(job.state)
+
+    poller = threading.Thread(target=poll)
+    poller.start()
+    job.run()
+    poller.join()
+    final = job.state
+    assert final in (DONE, TIMEOUT)
+    assert all(state == final for state in seen if state in FINISHED_STATES)
+    assert (job.error is None) == (final == DONE)
+
+
+def test_states():
+    job = ShareFlowJob('a', lambda: 42, (), timeout=None)
+    job.run()
+    assert (job.state, job.result, job.error) == (DONE, 42, None)
+
+    job = ShareFlowJob('b', time.sleep, (0.05,), timeout=0.01)
+    job.run()
+    assert job.state == TIMEOUT and job.result is None
+
+    job = ShareFlowJob('c', lambda: 1 / 0, (), timeout=None)
+    job.run()
+    assert job.state == 'failed' and job.error.startswith('ZeroDivisionError')
+
+
+def test_deduplicated_jobs_keep_every_record():
+    queue = ShareFlowJobQueue(workers=1)
+    release = threading.Event()
+    job = queue.submit('k', release.wait, 5, record='r1')
+    assert queue.submit('k', release.wait, 5, record='r2') is job
+    assert queue.submit('k', release.wait, 5, record='r1') is job
+    assert queue.submit('k', release.wait, 5) is job
+    assert job.records == ['r1', 'r2']
+    release.set()
+    assert job.wait(5) and job.state == DONE
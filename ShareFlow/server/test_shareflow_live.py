@@ -0,0 +1,121 @@
+"""
+Tests of incremental ShareFlow generation (shareflow_stream, shareflow_live):
+the documents of live sessions must be those shareflows_process gives for the
+events read so far.
+"""
+
+import copy
+import random
+import types
+
+from event_store import SQLiteEventStore, iter_record_steps
+from shareflow_benchmark import synthetic_trace
+from shareflow_cache import fingerprint_steps
+from shareflow_ingest import BulkIngester
+from shareflow_live import LiveShareFlows
+from shareflow_process import shareflows_process
+from shareflow_stream import IncrementalShareFlow
+
+
+LIBRARY = types.SimpleNamespace(tag='test@1', process_map=None, action_mapping=None)
+
+
+def _record(**fields):
+    return types.SimpleNamespace(**{'session_id': 's1', 'userid': 'u1', 'task_name': 'T', 'startstamp': 0,
+                                    'endstamp': 10 ** 12, **fields})
+
+
+def _events(seed, count):
+    steps = synthetic_trace(count, seed=seed, image_rate=0)[0]['steps']
+    rng = random.Random(seed)
+    timestamp = 0
+    events = []
+    for step in steps:
+        # Some events share their timestamp
+        timestamp += rng.choice([0, 1, 1, 5])
+        events.append({'event_type': step['type'], 'text_content': step['text'], 'base_url': step['url'],
+                       'title': step['title'], 'offset_x': step['offsetX'], 'offset_y': step['offsetY'],
+                       'timestamp': timestamp, 'session_id': 's1', 'userid': 'u1', 'task_name': 'T'})
+    return events
+
+
+def _expected(store, record):
+    steps = list(iter_record_steps(store, record))
+    entries = [{'taskName': record.task_name, 'userid': record.userid, 'sessionId': record.session_id,
+                'steps': steps}]
+    return steps, fingerprint_steps(entries), shareflows_process(copy.deepcopy(entries)) if steps else None
+
+
+def test_incremental_document_matches_shareflows_process():
+    for seed in range(20):
+        rng = random.Random(seed)
+        trace = synthetic_trace(rng.randrange(1, 400), seed=seed, sessions=1 + seed % 2, image_rate=0)
+        processor = IncrementalShareFlow()
+        read = []
+        for entry in trace:
+            steps = entry['steps']
+            i = 0
+            while i < len(steps):
+                batch = steps[i:i + rng.randint(1, 40)]
+                i += len(batch)
+                processor.update([{**entry, 'steps': copy.deepcopy(batch)}])
+                read.append({**entry, 'steps': batch})
+                assert processor.document() == shareflows_process(copy.deepcopy(read))
+        processor.close()
+        assert processor.document() == shareflows_process(copy.deepcopy(trace))
+
+
+def test_live_polls_match_full_reads():
+    for seed in range(10):
+        rng = random.Random(seed)
+        events = _events(seed, rng.randrange(50, 800))
+        store = SQLiteEventStore()
+        record = _record()
+        live_shareflows = LiveShareFlows()
+        i = 0
+        while i < len(events):
+            batch = events[i:i + rng.randint(1, 120)]
+            i += len(batch)
+            store.add(batch)
+            live = live_shareflows.get(record, LIBRARY)
+            with live.lock:
+                assert live.poll(store, record, page_size=rng.choice([7, 50, 500])) == len(batch)
+                steps, fingerprint, document = _expected(store, record)
+                assert list(live.snapshot()) == steps
+                assert live.fingerprint.hexdigest() == fingerprint
+                assert live.document() == document
+        # Nothing new: nothing read
+        with live.lock:
+            assert live.poll(store, record) == 0
+
+
+def test_live_shareflows_are_dropped_by_earlier_events():
+    store = SQLiteEventStore()
+    live_shareflows = LiveShareFlows()
+    ingester = BulkIngester(store, live=live_shareflows)
+    record = _record()
+    message = {'messageType': 'TraceData', 'type': 'click', 'userid': 'u1', 'sessionId': 's1', 'taskName': 'T'}
+    ingester.ingest([{**message, 'timestamp': 10}, {**message, 'timestamp': 20}])
+    live = live_shareflows.get(record, LIBRARY)
+    with live.lock:
+        live.poll(store, record)
+
+    # Later events are read by the same LiveShareFlow
+    ingester.ingest([{**message, 'timestamp': 30}])
+    assert live_shareflows.get(record, LIBRARY) is live
+    # An event before what it read replaces it
+    ingester.ingest([{**message, 'timestamp': 15}])
+    fresh = live_shareflows.get(record, LIBRARY)
+    assert fresh is not live
+    with fresh.lock:
+        fresh.poll(store, record)
+        assert [step['timestamp'] for step in fresh.snapshot()] == [10, 15, 20, 30]
+        assert fresh.document() == _expected(store, record)[2]
+
+
+def test_live_shareflows_are_kept_per_library():
+    live_shareflows = LiveShareFlows(max_entries=2)
+    record = _record()
+    other = types.SimpleNamespace(tag='other@1', process_map=None, action_mapping=None)
+    assert live_shareflows.get(record, LIBRARY) is not live_shareflows.get(record, other)
+    assert live_shareflows.get(record, LIBRARY) is live_shareflows.get(record, LIBRARY)
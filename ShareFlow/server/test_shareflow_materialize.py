@@ -0,0 +1,46 @@
+"""
+Tests of ShareFlow materialization (shareflow_materialize).
+"""
+
+import os
+import sqlite3
+from types import SimpleNamespace
+
+from event_store import SQLiteEventStore, iter_record_steps
+from process_library import ProcessLibraryRegistry
+from shareflow_materialize import SQLiteDocumentStore, materialize_record, record_id
+
+
+LIBRARIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'process_libraries')
+
+
+def _record():
+    return SimpleNamespace(session_id='s1', userid='u1', startstamp=0, endstamp=10 ** 9, task_name='T',
+                           groupid='g', completed=1, shared=1)
+
+
+def test_steps_are_stored_with_the_document():
+    events = SQLiteEventStore()
+    events.add([{'event_type': kind, 'text_content': '', 'timestamp': i, 'session_id': 's1', 'userid': 'u1'}
+                for i, kind in enumerate(['navigate', 'scroll', 'click', 'navigate', 'keydown'])])
+    documents = SQLiteDocumentStore()
+    record = _record()
+    assert materialize_record(record, events, documents, ProcessLibraryRegistry(LIBRARIES)) == 'stored'
+    version, fingerprint, document, steps = documents.get(record_id(record))
+    # The steps a read would otherwise fetch with batch_steps
+    assert steps == list(iter_record_steps(events, record, 500))
+    assert document['KM_Process']
+
+
+def test_store_created_without_steps(tmp_path):
+    path = str(tmp_path / 'documents.db')
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE shareflow_document (record_id TEXT PRIMARY KEY, session_id TEXT,'
+                       ' version TEXT, fingerprint TEXT, document TEXT, created INTEGER)')
+    connection.execute("INSERT INTO shareflow_document VALUES ('r', 's', 'v', 'f', '{}', 0)")
+    connection.commit()
+    connection.close()
+    documents = SQLiteDocumentStore(path)
+    assert documents.get('r') == ('v', 'f', {}, None)
+    documents.put('r2', 's', 'v', 'f', {'KM_Process': []}, [{'type': 'click'}])
+    assert documents.get('r2') == ('v', 'f', {'KM_Process': []}, [{'type': 'click'}])
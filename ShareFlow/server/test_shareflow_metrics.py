@@ -0,0 +1,87 @@
+"""
+Tests of the pipeline instrumentation (shareflow_metrics).
+"""
+
+import json
+import logging
+import re
+
+import pytest
+
+import shareflow_metrics
+from shareflow_benchmark import synthetic_trace
+from shareflow_metrics import NULL_RECORDER, Recorder, Registry
+from shareflow_process import shareflows_process
+
+
+SAMPLE = re.compile(r'^[a-z_]+(\{([a-z_]+="([^"\\]|\\.)*",?)+\})? -?[0-9.e+-]+$')
+
+
+@pytest.fixture
+def enabled():
+    was_enabled = shareflow_metrics.enabled()
+    shareflow_metrics.enable()
+    shareflow_metrics.registry.clear()
+    yield shareflow_metrics.registry
+    shareflow_metrics.registry.clear()
+    if not was_enabled:
+        shareflow_metrics.disable()
+
+
+def _check_exposition(text):
+    names = set()
+    for line in text.splitlines():
+        if line.startswith('# HELP ') or line.startswith('# TYPE '):
+            names.add(line.split()[2])
+        else:
+            assert SAMPLE.match(line), line
+            assert re.split('[{ ]', line)[0] in names
+
+
+def test_render():
+    registry = Registry()
+    assert registry.render() == '\n'
+    recorder = Recorder(registry)
+    recorder.add('fetch', 0.5, events=3, bytes=10)
+    recorder.add('fetch', 0.25, events=1)
+    recorder.pattern_hits({'AP1 "Quoted"\\ name': 2})
+    recorder.document({'KM_Process': [
+        {'code': 'AP1.', 'name': 'Navigate', 'steps': [{}, {}, {}]},
+        {'code': 'NO', 'name': 'MATCH', 'steps': [{}]},
+    ]})
+    text = registry.render()
+    _check_exposition(text)
+    lines = text.splitlines()
+    assert lines[:3] == [
+        '# HELP shareflow_stage_seconds_total Wall time spent in each pipeline stage.',
+        '# TYPE shareflow_stage_seconds_total counter',
+        'shareflow_stage_seconds_total{stage="fetch"} 0.75',
+    ]
+    assert 'shareflow_stage_calls_total{stage="fetch"} 2' in lines
+    assert 'shareflow_stage_events_total{stage="fetch"} 4' in lines
+    assert 'shareflow_pattern_hits_total{process="AP1 \\"Quoted\\"\\\\ name"} 2' in lines
+    assert 'shareflow_process_events_total{process="AP1. Navigate"} 3' in lines
+    assert '# TYPE shareflow_no_match_ratio gauge' in lines
+    assert 'shareflow_no_match_ratio 0.25' in lines
+    assert 'shareflow_requests_total' not in text
+
+
+def test_instrumented_pipeline(enabled, caplog):
+    data = synthetic_trace(500, seed=1, image_rate=0)
+    expected = shareflows_process(data)
+    shareflow_metrics.disable()
+    assert shareflow_metrics.recorder() is NULL_RECORDER
+    shareflow_metrics.enable()
+    with caplog.at_level(logging.INFO, logger='shareflow.metrics'):
+        with shareflow_metrics.request(route='test'):
+            assert shareflows_process(data) == expected
+    line = json.loads(caplog.records[-1].getMessage())
+    assert line['route'] == 'test' and line['labelled'] == 500
+    assert set(line['stages']) == {'action_mapper', 'process_labeller', 'reformat_to_nested'}
+    assert line['stages']['action_mapper']['events'] == 500
+
+    text = shareflow_metrics.render()
+    _check_exposition(text)
+    assert 'shareflow_requests_total 1' in text.splitlines()
+    assert enabled.get('shareflow_stage_calls_total', stage='process_labeller') == 2
+    assert enabled.get('shareflow_labelled_events_total') == 1000
@@ -0,0 +1,57 @@
+"""
+Tests of process_map pattern mining (shareflow_mining).
+"""
+
+import random
+
+from shareflow_benchmark import synthetic_trace
+from shareflow_mining import _BaseScan, _candidate_name, coverage, prefixspan, session_actions
+from shareflow_process import action_mapper, compile_process_map, process_labeller, process_map
+
+
+ACTIONS = ['Click', 'Type', 'Scroll', 'Navigation', 'Select', 'Click_Search', 'Query', 'change', 'Submit',
+           'Click_Save', 'Push']
+
+
+def test_prefixspan_finds_every_frequent_subsequence():
+    rng = random.Random(1)
+    sequences = [tuple(rng.choice('abcd') for _ in range(rng.randrange(12))) for _ in range(200)]
+    expected = {}
+    for sequence in sequences:
+        for subsequence in {sequence[i:j] for i in range(len(sequence))
+                            for j in range(i + 1, min(len(sequence), i + 4) + 1)}:
+            expected[subsequence] = expected.get(subsequence, 0) + 1
+    assert prefixspan(sequences, 20, 4) == {key: count for key, count in expected.items() if count >= 20}
+
+
+def test_coverage_counts_the_no_match_labels():
+    root = compile_process_map(process_map)
+    for seed in range(30):
+        trace = synthetic_trace(random.Random(seed).randrange(1, 200), seed=seed, image_rate=0)
+        labelled = process_labeller(action_mapper(trace))
+        no_match = sum(1 for action in labelled if action['KM_Process'] == 'NO MATCH')
+        assert coverage(root, session_actions(trace))[0] == no_match
+
+
+def test_coverage_with_candidate_matches_a_full_scan():
+    rng = random.Random(5)
+    base = compile_process_map(process_map)
+    for _ in range(5000):
+        sequence = tuple(rng.choice(ACTIONS[:rng.randrange(2, len(ACTIONS))]) for _ in range(rng.randrange(40)))
+        scan = _BaseScan(base, sequence)
+        assert (scan.no_match, scan.unmatched) == coverage(base, sequence)
+        # Half of the candidates are taken from the sequence, so they occur in it
+        candidate = tuple(rng.choice(ACTIONS) for _ in range(rng.randrange(1, 4)))
+        if rng.random() < 0.5 and len(sequence) > 3:
+            i = rng.randrange(len(sequence))
+            candidate = sequence[i:i + rng.randrange(1, 4)]
+        extended = dict(process_map)
+        extended[_candidate_name(candidate)] = list(candidate)
+        root = compile_process_map(extended)
+        triggers = scan.candidate_triggers({candidate}, 6).get(candidate)
+        expected = coverage(root, sequence)
+        if triggers:
+            assert scan.coverage_with(root, triggers) == expected
+        else:
+            # Without a trigger the candidate cannot change the scan
+            assert (scan.no_match, scan.unmatched) == expected
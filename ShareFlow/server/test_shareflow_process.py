@@ -0,0 +1,103 @@
+"""
+Tests of the process labellers (shareflow_process) against the original
+nested-scan algorithm, and of the execution modes of shareflows_process
+against the staged pipeline.
+"""
+
+import copy
+import json
+import random
+
+import pytest
+
+from shareflow_benchmark import synthetic_trace
+from shareflow_process import (
+    ExceptionHandler, extract_actions, get_primary_process, process_labeller, process_labeller_re, process_map,
+    shareflows_process,
+)
+from shareflow_response import iter_json
+
+
+def nested_scan_labeller(action_list, patterns):
+    """The labeller the trie replaced: every pattern is tried at every position, in declaration order."""
+    i = 0
+    prev_pattern = None
+    while i < len(action_list):
+        match_found = False
+        for pattern_key, pattern_value in patterns.items():
+            pattern_length = len(pattern_value)
+            if i + pattern_length <= len(action_list):
+                if all(action_list[i + j]['type'] == pattern_value[j] for j in range(pattern_length)):
+                    for k in range(pattern_length):
+                        action_list[i + k]['KM_Process'] = get_primary_process(pattern_key)
+                    i += pattern_length - 1
+                    match_found = True
+                    prev_pattern = get_primary_process(pattern_key)
+                    break
+        if not match_found:
+            action_list[i]['KM_Process'] = prev_pattern if prev_pattern else "NO MATCH"
+        i += 1
+    return action_list
+
+
+DEFAULT_VOCABULARY = sorted({action for pattern in process_map.values() for action in pattern} | {'Other'})
+
+# Shared prefixes, a pattern shadowed by an earlier one and a one-action pattern
+CUSTOM_MAP = {
+    'X1a first': ['A', 'B'],
+    'X2 single': ['A'],
+    'X3 longer': ['A', 'B', 'C'],
+    'X4 shadowed': ['A', 'B'],
+    'X5 other': ['C', 'C', 'D'],
+}
+
+
+def _traces(vocabulary, count, seed):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield [{'taskName': 't', 'type': rng.choice(vocabulary)} for _ in range(rng.randint(0, 80))]
+
+
+@pytest.mark.parametrize('labeller', [process_labeller, process_labeller_re])
+@pytest.mark.parametrize('patterns, vocabulary', [
+    (process_map, DEFAULT_VOCABULARY),
+    # Few distinct actions, so that long patterns match too
+    (process_map, ['Click', 'Type', 'Select', 'Navigation', 'Scroll']),
+    (CUSTOM_MAP, list('ABCD')),
+])
+def test_labeller_matches_nested_scan(labeller, patterns, vocabulary):
+    for trace in _traces(vocabulary, 500, seed=len(vocabulary)):
+        expected = nested_scan_labeller(copy.deepcopy(trace), patterns)
+        assert labeller(copy.deepcopy(trace), patterns) == expected
+
+
+@pytest.mark.parametrize('labeller', [process_labeller, process_labeller_re])
+def test_labeller_counts_hits(labeller):
+    trace = [{'type': action} for action in 'ABCAAB']
+    hits = {}
+    labeller(trace, CUSTOM_MAP, hits)
+    # The first declared pattern wins; unmatched entries inherit the previous label
+    assert [entry['KM_Process'] for entry in trace] == ['X1 first'] * 3 + ['X2 single'] + ['X1 first'] * 2
+    assert hits == {'X1 first': 2, 'X2 single': 1}
+
+
+def test_execution_modes_agree():
+    # Every mode builds the same document and flags the same repeated entries
+    # as the staged pipeline
+    modes = [{'fused': True}, {'memory_budget': 10 ** 9}, {'memory_budget': 20000}]
+    try:
+        import numpy  # noqa: F401
+        modes.append({'columnar': True})
+    except ImportError:
+        pass
+    for seed in range(8):
+        trace = synthetic_trace(random.Random(seed).randrange(1, 600), seed=seed, sessions=1 + seed % 3,
+                                image_rate=0)
+        flagged = []
+        expected = shareflows_process(copy.deepcopy(trace), flagged_entries=flagged)
+        assert flagged == ExceptionHandler(extract_actions(copy.deepcopy(trace)))
+        for options in modes:
+            mode_flagged = []
+            document = shareflows_process(copy.deepcopy(trace), flagged_entries=mode_flagged, **options)
+            assert json.loads(b''.join(iter_json(document))) == json.loads(json.dumps(expected)), options
+            assert mode_flagged == flagged, options
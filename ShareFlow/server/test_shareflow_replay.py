@@ -0,0 +1,83 @@
+"""
+Tests of the anonymized trace capture (shareflow_replay).
+"""
+
+import copy
+import gzip
+import json
+import os
+
+from shareflow_process import shareflows_process
+from shareflow_replay import TraceCapture, anonymize, load_capture
+
+
+def _results():
+    # batch_steps returns one entry carrying the recording metadata
+    steps = [
+        {'type': 'navigate', 'text': 'Secret-Page-Text', 'url': 'https://intranet.example-corp.test/x',
+         'description': 'Confidential-Description', 'image': '', 'title': 'Private-Title-Of-Page',
+         'width': 1280, 'height': 800, 'offsetX': 1.0, 'offsetY': 2.0, 'timestamp': 1718000000123,
+         'xpath': '/html/body/div-secret-xpath'},
+        {'type': 'click', 'text': 'Search', 'url': 'https://intranet.example-corp.test/y',
+         'description': '', 'image': 'data:image/png;base64,U2VjcmV0LVNjcmVlbnNob3Q=',
+         'title': 'Private-Title-Of-Page', 'width': 1280, 'height': 800, 'offsetX': 3.0,
+         'offsetY': 4.0, 'timestamp': 1718000000456, 'xpath': '', 'unknownField': 'Leaky-Extra-Value'},
+    ]
+    return [{
+        'taskName': 'Quarterly-Audit-Task',
+        'sessionId': 'session-4f1c9a7e-alpha',
+        'timestamp': 1718000000000,
+        'steps': steps,
+        'task_name': 'Quarterly-Audit-Task',
+        'session_id': 'session-4f1c9a7e-alpha',
+        'userid': 'acct:jane.doe@example-corp.test',
+        'groupid': 'group-finance-team-7',
+        'shared': 1,
+    }]
+
+
+IDENTIFIERS = (
+    'Quarterly-Audit-Task', 'session-4f1c9a7e-alpha', 'acct:jane.doe@example-corp.test', 'group-finance-team-7',
+    'Secret-Page-Text', 'intranet.example-corp.test', 'Confidential-Description', 'Private-Title-Of-Page',
+    'div-secret-xpath', 'U2VjcmV0LVNjcmVlbnNob3Q=', 'Leaky-Extra-Value', '1718000000',
+)
+
+
+def test_capture_contains_no_identifier(tmp_path):
+    capture = TraceCapture(str(tmp_path), salt=b'test-salt')
+    path = capture.capture(_results(), route='recording.read')
+    with gzip.open(path, 'rt', encoding='utf-8') as handle:
+        text = handle.read()
+    for value in IDENTIFIERS:
+        assert value not in text
+    entry = load_capture(path)['results'][0]
+    assert 'shared' not in entry
+    assert entry['timestamp'] == 0
+    assert [step['timestamp'] for step in entry['steps']] == [123, 456]
+
+
+def test_anonymized_trace_keeps_labels_and_sizes():
+    results = _results()
+    anonymized = anonymize(copy.deepcopy(results), b'test-salt')
+    entry = anonymized[0]
+    assert entry['sessionId'] == entry['session_id'] != results[0]['sessionId']
+    assert len(entry['userid']) == len(results[0]['userid'])
+    # Mapped (type, text) pairs are kept, since labelling depends on them
+    assert entry['steps'][1]['text'] == 'Search'
+    original = shareflows_process(copy.deepcopy(results))
+    replayed = shareflows_process(anonymized)
+    assert [p['code'] for p in replayed['KM_Process']] == [p['code'] for p in original['KM_Process']]
+
+
+def test_submitted_snapshots_are_written_in_the_background(tmp_path):
+    capture = TraceCapture(str(tmp_path), salt=b'test-salt')
+    for _ in range(3):
+        assert capture.submit(_results(), route='recording.read')
+    capture.join()
+    assert capture.captured == 3 and capture.dropped == 0
+    synchronous = TraceCapture(str(tmp_path / 'sync'), salt=b'test-salt')
+    expected = load_capture(synchronous.capture(_results(), route='recording.read'))['results']
+    for name in os.listdir(str(tmp_path)):
+        if name.endswith('.json.gz'):
+            assert load_capture(str(tmp_path / name))['results'] == expected
+    assert not TraceCapture(str(tmp_path / 'off'), rate=0).submit(_results())
@@ -0,0 +1,100 @@
+"""
+Tests of the read response helpers (shareflow_response): a client applying
+every ?since= delta to its copy must end up with the full body.
+"""
+
+import copy
+import json
+import random
+
+import pytest
+
+from shareflow_benchmark import synthetic_trace
+from shareflow_process import shareflows_process
+from shareflow_response import ReadOptions, ResponseOptionsError, iter_json
+
+
+LIBRARY = 'default@1:0123456789ab'
+
+
+def _body(steps):
+    entry = {'taskName': 'task', 'userid': 'u', 'sessionId': 's', 'steps': copy.deepcopy(steps)}
+    return {'taskName': 'task', 'sessionId': 's', 'steps': steps,
+            'dc': shareflows_process([entry]) if steps else None}
+
+
+def _read(body, since=None, library=LIBRARY):
+    # As recording.read sends it
+    options = ReadOptions.from_params({'since': since} if since else {})
+    return json.loads(b''.join(iter_json(options.apply(body, library))))
+
+
+def merge(client, delta):
+    """Apply a delta to the client's copy, as a client would."""
+    merged = {name: value for name, value in delta.items() if name not in ('since', 'reset', 'stepsFrom')}
+    if delta['reset']:
+        if merged['dc'] is not None:
+            merged['dc'] = {name: value for name, value in delta['dc'].items() if name != 'KM_ProcessFrom'}
+        return merged
+    merged['steps'] = client['steps'][:delta['stepsFrom']] + delta['steps']
+    if delta['dc'] is not None:
+        first = delta['dc']['KM_ProcessFrom']
+        previous = client['dc']['KM_Process'] if client['dc'] is not None else []
+        entries = [dict(entry) for entry in delta['dc']['KM_Process']]
+        if entries and 'stepsFrom' in entries[0]:
+            head = entries[0]
+            head['steps'] = previous[first]['steps'][:head.pop('stepsFrom')] + head['steps']
+        dc = {name: value for name, value in delta['dc'].items() if name != 'KM_ProcessFrom'}
+        merged['dc'] = {**dc, 'KM_Process': previous[:first] + entries}
+    return merged
+
+
+def _poll(client, body, library=LIBRARY):
+    delta = _read(body, client['version'], library)
+    return merge(client, delta), delta
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_deltas_rebuild_the_full_body(seed):
+    rng = random.Random(seed)
+    steps = synthetic_trace(600, seed=seed, image_rate=0)[0]['steps']
+    position = rng.randint(0, 20)
+    client = _read(_body(steps[:position]))
+    delta_bytes = full_bytes = 0
+    while position < len(steps):
+        position += rng.randint(0, 40)
+        full = _read(_body(steps[:position]))
+        client, delta = _poll(client, _body(steps[:position]))
+        assert not delta['reset']
+        assert client == full
+        delta_bytes += len(json.dumps(delta))
+        full_bytes += len(json.dumps(full))
+    # Closed entries are not sent again
+    assert delta_bytes < full_bytes / 5
+
+
+def test_changed_last_event_resets():
+    steps = synthetic_trace(300, seed=1, image_rate=0)[0]['steps']
+    client = _read(_body(steps[:200]))
+    # The client's last event was rewritten (older events are assumed final)
+    changed = copy.deepcopy(steps)
+    changed[199]['text'] = changed[199]['text'] + ' edited'
+    client, delta = _poll(client, _body(changed[:250]))
+    assert delta['reset']
+    assert client == _read(_body(changed[:250]))
+
+
+def test_library_change_resets():
+    steps = synthetic_trace(300, seed=2, image_rate=0)[0]['steps']
+    client = _read(_body(steps[:200]))
+    client, delta = _poll(client, _body(steps[:220]), library='default@2:ba9876543210')
+    assert delta['reset']
+    assert client == _read(_body(steps[:220]), library='default@2:ba9876543210')
+
+
+def test_invalid_tokens():
+    with pytest.raises(ResponseOptionsError):
+        ReadOptions.from_params({'since': 'not-a-token'})
+    version = _read(_body([]))['version']
+    with pytest.raises(ResponseOptionsError):
+        ReadOptions.from_params({'since': version, 'limit': '5'})
@@ -0,0 +1,68 @@
+"""
+Tests of the ShareFlow search index (shareflow_search): the threshold
+algorithm must return what scoring every match would.
+"""
+
+import random
+
+from shareflow_search import SearchIndex
+
+WORDS = ['search', 'flight', 'hotel', 'booking', 'form', 'price', 'review', 'map']
+
+
+def _records(rng, count):
+    # Few words over short fields, so that many documents tie on their score
+    for rid in range(count):
+        yield 'r%d' % rid, {
+            'task_name': ' '.join(rng.sample(WORDS, rng.randint(1, 3))),
+            'description': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 4))),
+            'target_uri': rng.choice(['', 'https://e.test/' + rng.choice(WORDS)]),
+            'session_id': 's%d' % rng.randrange(50),
+            'userid': rng.choice(['u1', 'u2', 'u3']),
+            'groupid': 'g',
+            'shared': rng.randint(0, 1),
+        }
+
+
+def test_threshold_matches_exhaustive():
+    rng = random.Random(7)
+    threshold, exhaustive = SearchIndex(exhaustive_limit=0), SearchIndex(exhaustive_limit=10 ** 9)
+    for rid, record in _records(rng, 3000):
+        threshold.add_record(rid, record)
+        exhaustive.add_record(rid, record)
+    for index in (threshold, exhaustive):
+        index.optimize()
+    # Later additions and removals are scored up front and skipped in the ordered lists
+    for rid, record in _records(random.Random(8), 200):
+        threshold.add_record(rid, record)
+        exhaustive.add_record(rid, record)
+    for rid in rng.sample(range(3000), 100):
+        threshold.remove('r%d' % rid)
+        exhaustive.remove('r%d' % rid)
+
+    for _ in range(500):
+        query = ' '.join(rng.sample(WORDS, rng.randint(1, 2)))
+        k = rng.choice([1, 3, 10, 25])
+        filters = rng.choice([{}, {'userid': 'u2'}, {'visible_to': 'u1'}])
+        assert threshold.search(query, k, **filters) == exhaustive.search(query, k, **filters), (query, k, filters)
+
+
+def test_threshold_ties():
+    # Each document has a mirror with the counts of the two query tokens swapped:
+    # both tokens get the same idf, so scores tie exactly, and an unseen document
+    # scoring the threshold must still win the tie-break on its id
+    for seed in range(230, 250):
+        rng = random.Random(seed)
+        counts = [(rng.randint(1, 3), rng.randint(1, 3), rng.randint(0, 4)) for _ in range(rng.randint(20, 200))]
+        rng.shuffle(counts)
+        records = [(a, b, other) for first, second, other in counts for a, b in ((first, second), (second, first))]
+        rng.shuffle(records)
+        threshold, exhaustive = SearchIndex(exhaustive_limit=0), SearchIndex(exhaustive_limit=10 ** 9)
+        for rid, (a, b, other) in enumerate(records):
+            record = {'task_name': ' '.join(['alpha'] * a + ['beta'] * b + ['other'] * other)}
+            threshold.add_record('r%d' % rid, record)
+            exhaustive.add_record('r%d' % rid, record)
+        threshold.optimize()
+        exhaustive.optimize()
+        for k in (1, 2, 3, 5, 10):
+            assert threshold.search('alpha beta', k) == exhaustive.search('alpha beta', k), (seed, k)
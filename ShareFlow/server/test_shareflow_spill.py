@@ -0,0 +1,57 @@
+"""
+Tests of memory-bounded ShareFlow generation (shareflow_spill): spilled lists
+and documents must read back as the in-memory ones.
+"""
+
+import copy
+import json
+import pickle
+
+from shareflow_benchmark import synthetic_trace
+from shareflow_process import shareflows_process
+from shareflow_response import iter_json
+from shareflow_spill import MemoryBudget, SpillDirectory, SpillList, hold_steps, is_spilled
+
+
+def _json(document):
+    return json.loads(b''.join(iter_json(document)))
+
+
+def test_spill_list_round_trip(tmp_path):
+    items = [{'text': 'x' * (i % 50), 'index': i} for i in range(500)]
+    budget = MemoryBudget(20000)
+    spill_list = SpillList(SpillDirectory(str(tmp_path)), budget)
+    for item in items:
+        spill_list.append(item)
+    assert budget.spills and spill_list.spilled
+    assert budget.used <= budget.limit
+    assert list(spill_list) == items and spill_list == items
+    assert spill_list[0] == items[0] and spill_list[-1] == items[-1] and spill_list[123] == items[123]
+    assert spill_list[10:20] == items[10:20]
+
+    copied = pickle.loads(pickle.dumps(spill_list))
+    assert list(copied) == items
+
+
+def test_hold_steps(tmp_path):
+    steps = synthetic_trace(300, seed=3, image_rate=0.2)[0]['steps']
+    assert hold_steps(iter(steps), 10 ** 9, str(tmp_path)) == steps
+    assert isinstance(hold_steps(iter(steps), 10 ** 9, str(tmp_path)), list)
+    held = hold_steps(iter(steps), 50000, str(tmp_path))
+    assert isinstance(held, SpillList) and held.spilled
+    assert list(held) == steps
+
+
+def test_spilled_document_equals_in_memory_one(tmp_path):
+    for seed, events in ((1, 50), (2, 2000), (3, 5000)):
+        trace = synthetic_trace(events, seed=seed, image_rate=0.1)
+        expected = _json(shareflows_process(copy.deepcopy(trace)))
+        # The steps themselves spilled, as read holds them, then a tiny pipeline budget
+        held = [{**entry, 'steps': hold_steps(iter(copy.deepcopy(entry['steps'])), 20000, str(tmp_path))}
+                for entry in trace]
+        document = shareflows_process(held, memory_budget=20000, spill_dir=str(tmp_path))
+        assert is_spilled(document)
+        assert _json(document) == expected
+        # Within the budget, the same plain lists
+        assert shareflows_process(copy.deepcopy(trace), memory_budget=10 ** 9) == shareflows_process(
+            copy.deepcopy(trace))